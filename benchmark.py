@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of WikiExtractor components.
+
+Usage:
+  python benchmark.py reader dump.xml[.bz2]
+  python benchmark.py subst templates.xml
+  python benchmark.py braces [dump.xml[.bz2]]
+  python benchmark.py bulk [dump.xml[.bz2]]
+  python benchmark.py scaling
+  python benchmark.py stages dump.xml[.bz2] [--templates templates.xml]
+  python benchmark.py discarded dump.xml[.bz2] templates.xml
+
+A slice of a real dump, for instance the first 100MB of an uncompressed
+dump completed with a closing </mediawiki>, gives representative figures.
+A templates file is the one saved by WikiExtractor.py --templates.
+Without a dump, the braces benchmark uses synthetic pages of nested
+templates, links and tplargs, the bulk benchmark long synthetic lists.
+"""
+
+import argparse
+import fileinput
+import random
+import sys
+from io import StringIO
+from time import process_time
+from timeit import default_timer
+
+import wikiextractor.wikiextractor as wikiextractor
+from wikiextractor.wikiextractor import (Extractor, Template, classifyTemplates,
+                                         load_templates, options, pages_from)
+import wikiextractor.brace as brace
+from wikiextractor.brace import BraceTokens, findMatchingBraces
+from wikiextractor.reader import pages_from_chunks
+from wikiextractor.wikiextractor import (bold, bold_italic, dropNested, dropSpans,
+                                         findBalanced, italic, italic_quote,
+                                         magicWordsRE, partSpans, quote_quote,
+                                         replaceExternalLinks, replaceInternalLinks,
+                                         syntaxhighlight, unescape, unescapeExceptCode)
+
+
+def timed(label, pages):
+    """Consumes :param pages:, reporting the time taken."""
+    start = default_timer()
+    count = 0
+    size = 0
+    for page in pages:
+        count += 1
+        size += sum(len(line) for line in page[4])
+    elapsed = default_timer() - start
+    print("%-10s %8d pages %12d chars %8.2fs %8.0f pages/s" %
+          (label, count, size, elapsed, count / elapsed if elapsed else 0))
+    return count, size
+
+
+def bench_reader(args):
+    """Compares the line scanner pages_from() with pages_from_chunks()."""
+    for _ in range(args.repeat):
+        file = fileinput.FileInput(args.input, openhook=fileinput.hook_compressed)
+        lines = timed('lines', pages_from(file))
+        file.close()
+        with fileinput.hook_compressed(args.input, 'rb') as file:
+            chunks = timed('chunks', pages_from_chunks(file, args.chunk_size))
+        if lines != chunks:
+            print("readers differ", file=sys.stderr)
+
+
+def bench_subst(args):
+    """Compares substituting template parameters part by part or by plan."""
+    file = fileinput.FileInput(args.templates, openhook=fileinput.hook_compressed)
+    load_templates(file)
+    file.close()
+    templates = [Template.parse(body) for body in options.templates.values()]
+    # pass a value for every parameter with a fixed name
+    invocations = []
+    for template in templates:
+        params = {step[0]: 'x' for step in template.compile()
+                  if type(step) is tuple and step[0] is not None}
+        invocations.append((template, params))
+    print("%d templates, %d parameters" %
+          (len(templates), sum(len(params) for _, params in invocations)))
+    extractor = Extractor('0', '0', 'Benchmark', [])
+    for label, subst in (('parts', Template.substParts),
+                         ('plan', Template.substPlan)):
+        start = default_timer()
+        for _ in range(args.repeat):
+            results = [subst(template, params, extractor, 0)
+                       for template, params in invocations]
+        elapsed = default_timer() - start
+        print("%-10s %8.2fs %8.1f us/template" %
+              (label, elapsed, 1e6 * elapsed / (args.repeat * len(invocations) or 1)))
+        if label == 'parts':
+            expected = results
+        elif results != expected:
+            print("substitutions differ", file=sys.stderr)
+
+
+def nested_text(rng, depth):
+    """:return: random wikitext with templates nested up to :param depth:."""
+    if depth == 0:
+        return rng.choice(['word', 'a b c', '{{PAGENAME}}', '{{{1|}}}', ''])
+    parts = [nested_text(rng, depth - 1) for _ in range(rng.randint(1, 4))]
+    form = rng.choice(['{{T%d|%s}}', '{{#if:%d|%s}}', '{{{p%d|%s}}}', '[[L%d|%s]]'])
+    return 'x ' + form % (depth, '|'.join(parts)) + ' y'
+
+
+def decompose(text, tokens=None):
+    """
+    Splits the templates of :param text: into parts, and these recursively,
+    as expansion does: rescanning each part, or slicing the tokens of the
+    text when :param tokens: are given.
+    :return: the number of parts.
+    """
+    count = 0
+    for s, e in findMatchingBraces(text, 2, tokens):
+        body = text[s + 2:e - 2]
+        body_tokens = tokens.slice(s + 2, e - 2) if tokens is not None else None
+        for start, end in partSpans(body, body_tokens):
+            count += 1 + decompose(body[start:end], body_tokens.slice(start, end)
+                                   if body_tokens is not None else None)
+    return count
+
+
+def bench_braces(args):
+    """Compares rescanning nested templates with sharing brace tokens."""
+    if args.input:
+        file = fileinput.FileInput(args.input, openhook=fileinput.hook_compressed)
+        texts = [''.join(page[4]) for page in pages_from(file)]
+        file.close()
+        # the pages richest in templates
+        texts.sort(key=lambda text: text.count('{{'), reverse=True)
+        texts = texts[:args.pages]
+    else:
+        rng = random.Random(0)
+        texts = [' '.join(nested_text(rng, args.depth) for _ in range(20))
+                 for _ in range(args.pages)]
+    print("%d pages, %d chars, %d braces" %
+          (len(texts), sum(len(text) for text in texts),
+           sum(text.count('{{') for text in texts)))
+    for label, tokenize in (('rescan', lambda text: None),
+                            ('shared', BraceTokens)):
+        start = default_timer()
+        for _ in range(args.repeat):
+            parts = sum(decompose(text, tokenize(text)) for text in texts)
+        elapsed = default_timer() - start
+        print("%-10s %8d parts %8.2fs %8.1f ms/page" %
+              (label, parts, elapsed, 1e3 * elapsed / (args.repeat * len(texts) or 1)))
+
+
+def list_text(rng, rows):
+    """:return: a random list of :param rows: rows with templates."""
+    return ''.join(rng.choice(['|-\n| {{flag|X%d}} || {{convert|%d|km}} || text\n',
+                               '* {{cite web|title={{lang|fr|T%d}}|n=%d}} }} stray\n',
+                               '# plain item %d %d\n']) % (i, i)
+                   for i in range(rows))
+
+
+def bench_bulk(args):
+    """Compares matching the braces of large pages in Python or with NumPy."""
+    if brace.numpy is None:
+        print("NumPy is not installed", file=sys.stderr)
+        return
+    if args.input:
+        file = fileinput.FileInput(args.input, openhook=fileinput.hook_compressed)
+        texts = [''.join(page[4]) for page in pages_from(file)]
+        file.close()
+        # the largest pages
+        texts.sort(key=len, reverse=True)
+        texts = texts[:args.pages]
+    else:
+        rng = random.Random(0)
+        texts = [list_text(rng, args.rows) for _ in range(args.pages)]
+    print("%d pages, %d chars" % (len(texts), sum(len(text) for text in texts)))
+    numpy = brace.numpy
+    for label, engine in (('python', None), ('numpy', numpy)):
+        brace.numpy = engine
+        start = default_timer()
+        for _ in range(args.repeat):
+            spans = [list(findMatchingBraces(text, 2)) for text in texts]
+        elapsed = default_timer() - start
+        print("%-10s %8d spans %8.2fs %8.1f ms/page" %
+              (label, sum(len(s) for s in spans), elapsed,
+               1e3 * elapsed / (args.repeat * len(texts) or 1)))
+        if label == 'python':
+            expected = spans
+        elif spans != expected:
+            print("spans differ", file=sys.stderr)
+    brace.numpy = numpy
+
+
+# a line with something for each pass to rebuild
+scaling_line = ("Text with {{lc:SOME WORDS}} and [[Target|label]]s, "
+                "[http://example.org a site], <nowiki>{{raw}}</nowiki> and "
+                "<syntaxhighlight>x = {{y}}</syntaxhighlight>. {{#if:x|yes|no}}\n")
+
+
+def bench_scaling(args):
+    """Checks that the cost per byte of text rebuilding passes stays flat."""
+    # no page is too large here
+    options.max_expansions = options.max_expanded_chars = options.max_expansion_time = 0
+    extractor = Extractor('0', '0', 'Benchmark', [])
+    passes = (
+        ('expand', extractor.expand),
+        ('transform', extractor.transform),
+        ('internal', replaceInternalLinks),
+        ('external', replaceExternalLinks),
+        ('dropSpans', lambda text: dropSpans(list(findBalanced(text)), text)),
+        ('wiki2text', extractor.wiki2text),
+    )
+    print("%-10s" % 'ns/byte' + ''.join("%10s" % label for label, _ in passes))
+    size = args.min_size
+    while size <= args.max_size:
+        text = scaling_line * (size // len(scaling_line) + 1)
+        times = []
+        for _, run in passes:
+            start = default_timer()
+            for _ in range(args.repeat):
+                run(text)
+            times.append((default_timer() - start) / args.repeat)
+        print("%-10s" % ('%dKB' % (len(text) // 1024)) +
+              ''.join("%10.1f" % (1e9 * t / len(text)) for t in times))
+        size *= 10
+
+
+def quotes(text):
+    """The quote stage of Extractor.wiki2text(), for text output."""
+    text = bold_italic.sub(r'\1', text)
+    text = bold.sub(r'\1', text)
+    text = italic_quote.sub(r'"\1"', text)
+    text = italic.sub(r'"\1"', text)
+    text = quote_quote.sub(r'"\1"', text)
+    return text.replace("'''", '').replace("''", '"')
+
+
+def unescape_split(text):
+    """Unescapes around <syntaxhighlight> in separate scans, as before."""
+    res = []
+    cur = 0
+    for m in syntaxhighlight.finditer(text):
+        res.append(unescape(text[cur:m.start()]))
+        res.append(m.group(1))
+        cur = m.end()
+    res.append(unescape(text[cur:]))
+    return ''.join(res)
+
+
+def bench_stages(args):
+    """Times each stage of Extractor.wiki2text() on expanded pages."""
+    if args.templates:
+        file = fileinput.FileInput(args.templates, openhook=fileinput.hook_compressed)
+        load_templates(file)
+        file.close()
+    file = fileinput.FileInput(args.input, openhook=fileinput.hook_compressed)
+    texts = []
+    for id, revid, title, ns, page in pages_from(file):
+        if len(texts) == args.pages:
+            break
+        extractor = Extractor(id, revid, title, page)
+        texts.append(extractor.transform(''.join(page)))
+    file.close()
+    print("%d pages, %d chars" % (len(texts), sum(len(text) for text in texts)))
+    stages = (
+        ('tables', lambda text: dropNested(dropNested(text, r'{{', r'}}'), r'{\|', r'\|}')),
+        ('quotes', quotes),
+        ('internal', replaceInternalLinks),
+        ('external', replaceExternalLinks),
+        ('magic', lambda text: magicWordsRE.sub('', text)),
+        ('html', unescapeExceptCode),
+    )
+    total = 0
+    for label, stage in stages:
+        elapsed, texts = time_stage(stage, texts, args.repeat)
+        total += elapsed
+        print("%-10s %8.3fs" % (label, elapsed))
+        if label == 'magic':
+            # the previous, unfused html stage
+            split, expected = time_stage(unescape_split, texts, args.repeat)
+            print("%-10s %8.3fs" % ('html split', split))
+    print("%-10s %8.3fs" % ('total', total))
+    if texts != expected:
+        print("html stages differ", file=sys.stderr)
+
+
+def time_stage(stage, texts, repeat):
+    """:return: the time taken to apply :param stage: to :param texts:, and its results."""
+    start = default_timer()
+    for _ in range(repeat):
+        results = [stage(text) for text in texts]
+    return (default_timer() - start) / repeat, results
+
+
+def bench_discarded(args):
+    """Compares extracting pages expanding or skipping the templates whose output is discarded."""
+    file = fileinput.FileInput(args.templates, openhook=fileinput.hook_compressed)
+    load_templates(file)
+    file.close()
+    start = process_time()
+    titles = classifyTemplates()
+    print("%d templates, %d always discarded, classified in %.2fs CPU" %
+          (len(options.templates) + len(options.templateCache), len(titles),
+           process_time() - start))
+    file = fileinput.FileInput(args.input, openhook=fileinput.hook_compressed)
+    pages = [(id, revid, title, page) for id, revid, title, ns, page in pages_from(file)
+             if ns == '0'][:args.pages]
+    file.close()
+    discardedShell = wikiextractor.discardedShell
+    for label, shell in (('expanded', lambda title: None), ('skipped', discardedShell)):
+        wikiextractor.discardedShell = shell
+        outputs = []
+        expansions = skipped = 0
+        start = process_time()
+        for id, revid, title, page in pages:
+            extractor = Extractor(id, revid, title, page)
+            out = StringIO()
+            extractor.extract(out)
+            outputs.append(out.getvalue())
+            expansions += extractor.expansions
+            skipped += extractor.discarded_templates
+        elapsed = process_time() - start
+        print("%-10s %8d pages %8d expansions %8d skipped %8.2fs CPU" %
+              (label, len(pages), expansions, skipped, elapsed))
+        if label == 'expanded':
+            expected = outputs
+        elif outputs != expected:
+            print("outputs differ", file=sys.stderr)
+    wikiextractor.discardedShell = discardedShell
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark.py', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    reader = subparsers.add_parser('reader', help=bench_reader.__doc__)
+    reader.add_argument("input", help="XML wiki dump file")
+    reader.add_argument("--chunk-size", type=int, default=1024 * 1024,
+                        help="bytes read at a time by the chunk reader")
+    reader.add_argument("--repeat", type=int, default=1)
+    reader.set_defaults(run=bench_reader)
+    subst = subparsers.add_parser('subst', help=bench_subst.__doc__)
+    subst.add_argument("templates", help="file of templates, as saved by --templates")
+    subst.add_argument("--repeat", type=int, default=10)
+    subst.set_defaults(run=bench_subst)
+    braces = subparsers.add_parser('braces', help=bench_braces.__doc__)
+    braces.add_argument("input", nargs='?', help="XML wiki dump file")
+    braces.add_argument("--pages", type=int, default=100,
+                        help="number of pages, those with most templates from a dump")
+    braces.add_argument("--depth", type=int, default=5,
+                        help="nesting depth of synthetic pages")
+    braces.add_argument("--repeat", type=int, default=3)
+    braces.set_defaults(run=bench_braces)
+    bulk = subparsers.add_parser('bulk', help=bench_bulk.__doc__)
+    bulk.add_argument("input", nargs='?', help="XML wiki dump file")
+    bulk.add_argument("--pages", type=int, default=10,
+                      help="number of pages, the largest from a dump")
+    bulk.add_argument("--rows", type=int, default=20000,
+                      help="rows of synthetic lists")
+    bulk.add_argument("--repeat", type=int, default=3)
+    bulk.set_defaults(run=bench_bulk)
+    scaling = subparsers.add_parser('scaling', help=bench_scaling.__doc__)
+    scaling.add_argument("--min-size", type=int, default=10 * 1024,
+                         help="size of the smallest page, grown tenfold up to --max-size")
+    scaling.add_argument("--max-size", type=int, default=10 * 1024 * 1024)
+    scaling.add_argument("--repeat", type=int, default=1)
+    scaling.set_defaults(run=bench_scaling)
+    stages = subparsers.add_parser('stages', help=bench_stages.__doc__)
+    stages.add_argument("input", help="XML wiki dump file")
+    stages.add_argument("--templates", help="file of templates, as saved by --templates")
+    stages.add_argument("--pages", type=int, default=1000)
+    stages.add_argument("--repeat", type=int, default=3)
+    stages.set_defaults(run=bench_stages)
+    discarded = subparsers.add_parser('discarded', help=bench_discarded.__doc__)
+    discarded.add_argument("input", help="XML wiki dump file")
+    discarded.add_argument("templates", help="file of templates, as saved by --templates")
+    discarded.add_argument("--pages", type=int, default=1000)
+    discarded.set_defaults(run=bench_discarded)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
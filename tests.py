@@ -4,11 +4,35 @@ from __future__ import unicode_literals
 
 import sys
 import os.path
+import bz2
+import io
+import pickle
+import random
+import shutil
+import tempfile
 import unittest
 
 from wikiextractor.wikiextractor import (
     normalizeTitle, unescape, ucfirst, lcfirst, splitParts,
-    fullyQualifiedTemplateTitle, NextFile
+    fullyQualifiedTemplateTitle, NextFile, pages_from, options, Extractor,
+    ExpansionCache, TemplateStubs, Template, sharp_switch, dropSpans, unescapeExceptCode,
+    pruneDiscarded, discardedShell, classifyTemplates, foldTemplates,
+    define_template, resolveRedirects, indexNamespaces, qualifiedTitle
+)
+import wikiextractor.wikiextractor as wikiextractor
+import wikiextractor.brace as brace
+from wikiextractor.brace import BraceTokens, findMatchingBraces
+from wikiextractor.expr import expr, ifexpr, ExprError
+from wikiextractor.multistream import (
+    read_index, stream_offsets, stream_spans, read_stream, read_header, locate,
+    locate_prefixes
+)
+from wikiextractor.tags import tagScanner, tagSpans
+from wikiextractor.templatestore import (
+    dump_fingerprint, save_store, load_store, write_table, TemplateTable
+)
+from wikiextractor.reader import (
+    byte_ranges, read_range, pages_from_chunks, page_blocks
 )
 
 
@@ -43,6 +67,13 @@ class TestStringUtils(unittest.TestCase):
             self.assertEqual(unescape('&#x1D546;'), '&#x1D546;')
             self.assertEqual(unescape('&#x1d4c1;'), '&#x1d4c1;')
 
+    def test_unescape_except_code(self):
+        self.assertEqual(unescapeExceptCode('a &lt;b&gt; &amp;nbsp; &#x3042; &bogus;'),
+                         'a <b> &nbsp; \u3042 &bogus;')
+        self.assertEqual(unescapeExceptCode('&lt;syntaxhighlight lang="c"&gt;a &amp;&amp; b'
+                                            '&lt;/syntaxhighlight&gt; &amp;&amp;'),
+                         'a &amp;&amp; b &&')
+
     def test_ucfirst(self):
         self.assertEqual(ucfirst('python'), 'Python')
 
@@ -74,6 +105,87 @@ class TestSplitParts(unittest.TestCase):
      }}'''])
 
 
+class TestBraceTokens(unittest.TestCase):
+
+    text = ('{{Infobox|name={{{name|{{PAGENAME}}}}}|image=[[File:A.png|{{{size|}}}]]}}'
+            ' {{{{{|safesubst:}}}#if:{{{1|}}}|[[a|b]]}}}} {{x}}} ]] [[y {{z}}')
+
+    def test_matching(self):
+        tokens = BraceTokens(self.text)
+        for ldelim in (0, 2, 3):
+            self.assertEqual(list(findMatchingBraces(self.text, ldelim, tokens)),
+                             list(findMatchingBraces(self.text, ldelim)))
+        self.assertEqual(list(findMatchingBraces('{{{{ }}}}', 3)), [(0, 9)])
+        self.assertEqual(list(findMatchingBraces('{{a}}} [[b]] {{c')), [(0, 5), (7, 12)])
+
+    def test_slice(self):
+        tokens = BraceTokens(self.text)
+        random.seed(0)
+        for _ in range(500):
+            start = random.randrange(len(self.text))
+            end = random.randrange(start, len(self.text) + 1)
+            part = tokens.slice(start, end)
+            expected = BraceTokens(self.text[start:end])
+            self.assertEqual(part.spans(), expected.spans())
+            for ldelim in (0, 2, 3):
+                self.assertEqual(list(findMatchingBraces(self.text[start:end], ldelim, part)),
+                                 list(findMatchingBraces(self.text[start:end], ldelim)))
+
+    def test_split(self):
+        body = self.text[2:self.text.index('}} ')]
+        tokens = BraceTokens(self.text).slice(2, 2 + len(body))
+        self.assertEqual(splitParts(body, tokens), splitParts(body))
+        self.assertEqual(splitParts(body),
+                         ['Infobox', 'name={{{name|{{PAGENAME}}}}}',
+                          'image=[[File:A.png|{{{size|}}}]]'])
+
+    @unittest.skipIf(brace.numpy is None, "NumPy not available")
+    def test_bulk(self):
+        random.seed(0)
+        for _ in range(2000):
+            alphabet = random.choice(['{{}}a', '{{}}}a|', '{{}}[[]]a', '{{{}}}a'])
+            text = ''.join(random.choice(alphabet) for _ in range(random.randrange(60)))
+            tokens = BraceTokens(text)
+            if text:
+                self.assertEqual(brace.bulkTokens(text),
+                                 (tokens.starts, tokens.ends, tokens.kinds))
+            start = random.randrange(len(text) + 1)
+            part = tokens.slice(start, len(text))
+            for ldelim in (0, 2, 3):
+                spans = brace.bulkMatchingBraces(part, ldelim)
+                if spans is not None:
+                    self.assertEqual(spans, list(findMatchingBraces(text[start:], ldelim)))
+        # the ambiguous cases are left to the general matcher
+        self.assertIsNone(brace.bulkMatchingBraces(BraceTokens('{{{{{a}}}}}'), 2))
+        self.assertIsNone(brace.bulkMatchingBraces(BraceTokens('{{a|[[b]]}}'), 0))
+        self.assertEqual(brace.bulkMatchingBraces(BraceTokens('{{a|[[b]]}}'), 2), [(0, 11)])
+
+
+class TestTagSpans(unittest.TestCase):
+
+    scanner = tagScanner(('br', 'ref'), (r'<b\b.*?>', r'</\s*b>'), ('table', 'ref', 'div'))
+
+    def drop(self, text):
+        return dropSpans(tagSpans(text, self.scanner), text)
+
+    def test_tags(self):
+        self.assertEqual(self.drop('a<!-- <b> -->b<br/>c<ref name="x" />d'), 'abcd')
+        self.assertEqual(self.drop('a <B class="x">bold</b> c'), 'a bold c')
+
+    def test_discarded(self):
+        self.assertEqual(self.drop('a<table><tr><table>x</table></tr></table>b'), 'ab')
+        self.assertEqual(self.drop('a<ref>x<div>y</div></ref>b<div>z</div>c'), 'abc')
+        # stray closing tags are kept, unclosed elements end at the last one
+        self.assertEqual(self.drop('a</div>b'), 'a</div>b')
+        self.assertEqual(self.drop('a<div>x<div>y</div>b'), 'ab')
+        self.assertEqual(self.drop('a<div>b'), 'a<div>b')
+
+    def test_overlapping(self):
+        # an unclosed element ending past another is merged with it
+        self.assertEqual(self.drop('a <div><ref></div><ref>q</ref> b'), 'a  b')
+        self.assertEqual(self.drop('a<ref><div></ref>x<div>y</div>b'), 'ab')
+
+
 class TestFullyQualifiedTemplateTitle(unittest.TestCase):
 
     def test_main_namespace(self):
@@ -84,6 +196,196 @@ class TestFullyQualifiedTemplateTitle(unittest.TestCase):
         self.assertEqual(fullyQualifiedTemplateTitle('User:Orange'), 'User:Orange')
 
 
+class TestTitleCaches(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (options.knownNamespaces, options.templatePrefix)
+        options.knownNamespaces = {'Template': '10', 'User talk': '3', None: '0'}
+        options.templatePrefix = 'Template:'
+        indexNamespaces()
+
+    def tearDown(self):
+        (options.knownNamespaces, options.templatePrefix) = self.saved
+        indexNamespaces()
+
+    def test_namespace_case(self):
+        self.assertEqual(normalizeTitle('TEMPLATE:  infobox_person'), 'Template:Infobox person')
+        self.assertEqual(normalizeTitle('user talk:Orange'), 'User talk:Orange')
+        self.assertEqual(fullyQualifiedTemplateTitle('template:infobox'), 'Template:infobox')
+        self.assertEqual(fullyQualifiedTemplateTitle('USER TALK:Orange'), 'User talk:Orange')
+
+    def test_name_kept(self):
+        # only the namespace is normalized, the name keeps its case
+        for _ in range(2):
+            self.assertEqual(fullyQualifiedTemplateTitle('Template:infobox'), 'Template:infobox')
+            self.assertEqual(fullyQualifiedTemplateTitle(':main page'), 'Main page')
+            self.assertEqual(fullyQualifiedTemplateTitle('x:y'), 'Template:X:y')
+
+    def test_hits(self):
+        for _ in range(3):
+            self.assertEqual(fullyQualifiedTemplateTitle('infobox'), 'Template:Infobox')
+        info = qualifiedTitle.cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+
+    def test_prefix(self):
+        self.assertEqual(fullyQualifiedTemplateTitle('x'), 'Template:X')
+        options.templatePrefix = 'Vorlage:'
+        self.assertEqual(fullyQualifiedTemplateTitle('x'), 'Vorlage:X')
+
+    def test_reindex(self):
+        self.assertEqual(normalizeTitle('category: births'), 'Category: Births')
+        options.knownNamespaces['Category'] = '14'
+        indexNamespaces()
+        self.assertEqual(normalizeTitle('category: births'), 'Category:Births')
+
+
+class TestPruneDiscarded(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (options.templates, options.redirects, options.templateCache,
+                      options.templatePrefix, options.markupCache, options.keep_tables)
+        options.templates = {'Template:Cite': '{{{title}}}, {{{year|}}}',
+                             'Template:Rclose': '&lt;/ref&gt;',
+                             'Template:Loop': '{{loop}}',
+                             'Template:Q': "''",
+                             'Template:H': '<ref>',
+                             'Template:Hdiv': '<div><ref></div>',
+                             'Template:Close': '}'}
+        options.redirects = {}
+        options.templateCache = {}
+        options.templatePrefix = 'Template:'
+        options.markupCache = {}
+        options.keep_tables = False
+
+    def tearDown(self):
+        (options.templates, options.redirects, options.templateCache,
+         options.templatePrefix, options.markupCache, options.keep_tables) = self.saved
+
+    def test_ref(self):
+        text = 'a&lt;ref name="n"&gt;{{cite|title=T}}&lt;/ref&gt; {{b}}'
+        self.assertEqual(pruneDiscarded(text), 'a&lt;ref name="n"&gt;&lt;/ref&gt; {{b}}')
+
+    def test_unsafe(self):
+        for inner in ('{{rclose}}', '{{loop}}', '{{{{x}}}}'):
+            text = 'a&lt;ref&gt;x' + inner + '&lt;/ref&gt;'
+            self.assertEqual(pruneDiscarded(text), text)
+
+    def test_table(self):
+        text = 'a\n{|\n| {{cite|title=T}}\n|}\nb {{cite|title=U}}'
+        self.assertEqual(pruneDiscarded(text), 'a\n{|\n|}\nb {{cite|title=U}}')
+        options.keep_tables = True
+        self.assertEqual(pruneDiscarded(text), text)
+
+    def test_inside_template(self):
+        text = '{{cite|title=&lt;ref&gt;{{b}}&lt;/ref&gt;}}'
+        self.assertEqual(pruneDiscarded(text), text)
+
+    def test_unbalanced(self):
+        text = '}} &lt;ref&gt;{{cite|title=T}}&lt;/ref&gt;'
+        self.assertEqual(pruneDiscarded(text), text)
+
+    def test_quotes(self):
+        # quotes and newlines within elements pair with those around them
+        for text in ("x '''a&lt;ref&gt;{{cite|title=X}}''&lt;/ref&gt; c",
+                     "x '''a&lt;gallery&gt;\n&lt;/gallery&gt;{{cite|title=X}}'' c",
+                     "a&lt;ref&gt;{{q}}&lt;/ref&gt;",
+                     "a&lt;ref&gt;{{cite|title=''T''}}&lt;/ref&gt;"):
+            self.assertEqual(pruneDiscarded(text), text)
+
+    def extract(self, text):
+        out = io.StringIO()
+        Extractor(1, 1, 'A', [text]).extract(out)
+        return out.getvalue()
+
+    def test_unbalanced_output(self):
+        # relies on dropSpans() merging the spans of unbalanced elements
+        prune = wikiextractor.pruneDiscarded
+        for text in ('&lt;gallery&gt;{{h}}&lt;/gallery&gt;&lt;ref&gt;,&lt;/ref&gt;',
+                     '{{hdiv}}&lt;ref&gt;{{close}}&lt;/ref&gt;'):
+            pruned = self.extract(text)
+            wikiextractor.pruneDiscarded = lambda text: text
+            try:
+                self.assertEqual(pruned, self.extract(text))
+            finally:
+                wikiextractor.pruneDiscarded = prune
+
+
+class TestDiscardedTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (options.templates, options.redirects, options.templateCache,
+                      options.templatePrefix, options.markupCache,
+                      options.discardedTemplates, options.keep_tables)
+        options.templates = {'Template:Navbox': '{|\n| {{flag|{{{1}}}}} <div>{{{2|}}}</div>\n|}',
+                             'Template:Flag': '[[{{{1}}}]]',
+                             'Template:Reflist': '<div class="reflist">{{{1|}}}</div>',
+                             'Template:Footer': '\n{{navbox|a}}\n{{reflist}}',
+                             'Template:Tend': '|}',
+                             'Template:Open': '{|\n| {{tend}}',
+                             'Template:Mixed': 'see {{navbox|b}}',
+                             'Template:Q': "''",
+                             'Template:Nl': '\n',
+                             'Template:Quoted': '<div>{{q}}</div>',
+                             'Template:Broken': '<div>a{{nl}}b</div>'}
+        options.redirects = {}
+        options.templateCache = {}
+        options.templatePrefix = 'Template:'
+        options.markupCache = {}
+        options.discardedTemplates = {}
+        options.keep_tables = False
+
+    def tearDown(self):
+        (options.templates, options.redirects, options.templateCache,
+         options.templatePrefix, options.markupCache,
+         options.discardedTemplates, options.keep_tables) = self.saved
+
+    def test_classify(self):
+        self.assertEqual(classifyTemplates(),
+                         ['Template:Footer', 'Template:Navbox', 'Template:Reflist'])
+
+    def test_shell(self):
+        self.assertEqual(discardedShell('Template:Navbox')[0], '{|\n|  <div></div>\n|}')
+        self.assertEqual(discardedShell('Template:Footer')[0],
+                         '\n{|\n|  <div></div>\n|}\n<div class="reflist"></div>')
+
+    def test_skipped(self):
+        e = Extractor(1, 1, 'A', [])
+        self.assertEqual(e.expand('x {{footer}} {{navbox|c|{{tend}}}}'),
+                         'x \n{|\n|  <div></div>\n|}\n<div class="reflist"></div> '
+                         '{|\n| [[c]] <div>|}</div>\n|}')
+        self.assertEqual(e.discarded_templates, 1)
+
+    def test_quotes(self):
+        # quotes and newlines within elements pair with those around them
+        self.assertIsNone(discardedShell('Template:Quoted'))
+        self.assertIsNone(discardedShell('Template:Broken'))
+        e = Extractor(1, 1, 'A', [])
+        self.assertEqual(e.expand("x {{reflist|''y''}} {{reflist|z}}"),
+                         'x <div class="reflist">\'\'y\'\'</div> <div class="reflist"></div>')
+        self.assertEqual(e.discarded_templates, 1)
+
+    def test_keep_tables(self):
+        options.keep_tables = True
+        self.assertEqual(classifyTemplates(), ['Template:Reflist'])
+
+    def test_unbalanced(self):
+        # an element left open in the page drops the whole shell with it,
+        # as it drops the full expansion
+        text = 'a &lt;gallery&gt;&lt;div&gt;&lt;/gallery&gt;{{reflist|y}} b'
+        out = io.StringIO()
+        e = Extractor(1, 1, 'A', [text])
+        e.extract(out)
+        self.assertEqual(e.discarded_templates, 1)
+        shell = wikiextractor.discardedShell
+        wikiextractor.discardedShell = lambda title: None
+        try:
+            full = io.StringIO()
+            Extractor(1, 1, 'A', [text]).extract(full)
+        finally:
+            wikiextractor.discardedShell = shell
+        self.assertEqual(out.getvalue(), full.getvalue())
+
+
 class TestNextFile(unittest.TestCase):
 
     def test_next(self):
@@ -96,5 +398,548 @@ class TestNextFile(unittest.TestCase):
         self.assertEqual(next(f), 'out{}AB/wiki_00'.format(os.path.sep))
 
 
+class TestExpansionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (options.templates, options.redirects, options.templateCache,
+                      options.templatePrefix, options.expansionCache)
+        options.templates = {'Template:Hi': 'hi {{{1}}}',
+                             'Template:Here': 'at {{PAGENAME}}',
+                             'Template:Twice': '{{hi|{{{1}}}}} {{here}}'}
+        options.redirects = {}
+        options.templateCache = {}
+        options.templatePrefix = 'Template:'
+        options.expansionCache = ExpansionCache(2)
+
+    def tearDown(self):
+        (options.templates, options.redirects, options.templateCache,
+         options.templatePrefix, options.expansionCache) = self.saved
+
+    def test_cached(self):
+        cache = options.expansionCache
+        self.assertEqual(Extractor(1, 1, 'A', []).expandTemplate('hi|x'), 'hi x')
+        self.assertEqual(Extractor(2, 2, 'B', []).expandTemplate('hi|x'), 'hi x')
+        self.assertEqual(Extractor(2, 2, 'B', []).expandTemplate('hi|y'), 'hi y')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_page_specific(self):
+        for title in ('A', 'B'):
+            e = Extractor(1, 1, title, [])
+            e.magicWords['PAGENAME'] = title
+            self.assertEqual(e.expandTemplate('here'), 'at ' + title)
+            self.assertEqual(e.expandTemplate('twice|x'), 'hi x at ' + title)
+        # only {{hi|x}} was cached
+        self.assertEqual(list(options.expansionCache.entries),
+                         [('Template:Hi', frozenset([('1', 'x')]))])
+
+    def test_eviction(self):
+        e = Extractor(1, 1, 'A', [])
+        for arg in ('x', 'y', 'z', 'x'):
+            e.expandTemplate('hi|' + arg)
+        self.assertEqual(options.expansionCache.hits, 0)
+        self.assertEqual(len(options.expansionCache.entries), 2)
+
+
+class TestTemplateStubs(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (options.templates, options.redirects, options.templateCache,
+                      options.templatePrefix, options.templateStubs)
+        options.templates = {'Template:Hi': 'hi {{{1}}}',
+                             'Template:Infobox country': '{{hi|country}}',
+                             'Template:Convert': '{{{1}}} {{{2}}}'}
+        options.redirects = {'Template:Infobox nation': 'Template:Infobox country'}
+        options.templateCache = {}
+        options.templatePrefix = 'Template:'
+        options.templateStubs = TemplateStubs(['infobox country', '/Coord.*/'],
+                                              [('Template:Convert', 'quantity')])
+
+    def tearDown(self):
+        (options.templates, options.redirects, options.templateCache,
+         options.templatePrefix, options.templateStubs) = self.saved
+
+    def test_match(self):
+        stubs = options.templateStubs
+        self.assertEqual(stubs.get('Template:Infobox country'), '')
+        self.assertEqual(stubs.get('Template:Coord missing'), '')
+        self.assertEqual(stubs.get('Coordinates'), '')
+        self.assertEqual(stubs.get('Template:Convert'), 'quantity')
+        self.assertIsNone(stubs.get('Template:Infobox'))
+        self.assertIsNone(stubs.get('Template:Hi'))
+
+    def test_expand(self):
+        e = Extractor(1, 1, 'A', [])
+        self.assertEqual(e.expand('{{hi|a}} {{Infobox nation}} {{coord|1|2}} {{convert|3|{{hi|b}}}}'),
+                         'hi a   quantity')
+        # the parameters of {{convert}} were not expanded
+        self.assertEqual(e.expansions, 4)
+
+    def test_parse(self):
+        self.assertEqual(TemplateStubs.parse('Infobox, /Coord{1,2}/,,/a,b/'),
+                         ['Infobox', '/Coord{1,2}/', '/a,b/'])
+        self.assertEqual(TemplateStubs.parse('Convert=a=b,/Lang|IPA{1,2}/=x', True),
+                         [('Convert', 'a=b'), ('/Lang|IPA{1,2}/', 'x')])
+        self.assertEqual(TemplateStubs.parse(''), [])
+        for text in ('Convert', '=x', 'Convert=quantity,Lang'):
+            self.assertRaises(ValueError, TemplateStubs.parse, text, True)
+        self.assertRaises(ValueError, TemplateStubs.parse, 'Infobox=x')
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, TemplateStubs, ['/Coord(/'])
+        self.assertRaises(ValueError, TemplateStubs, [], [('/[a/', 'x')])
+
+
+class TestResolveRedirects(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (options.templates, options.redirects, options.templatePrefix)
+        options.templates = {}
+        options.redirects = {}
+        options.templatePrefix = 'Template:'
+
+    def tearDown(self):
+        (options.templates, options.redirects, options.templatePrefix) = self.saved
+
+    def test_define(self):
+        define_template('Template:Flagicon', '#REDIRECT [[Template:Flag]]\n')
+        define_template('Template:Flag', '[[{{{1}}}]]')
+        self.assertEqual(options.redirects, {'Template:Flagicon': 'Template:Flag'})
+        self.assertEqual(list(options.templates), ['Template:Flag'])
+
+    def test_chains(self):
+        options.redirects = {'Template:Flag icon': 'template:flagicon#top',
+                             'Template:Flagicon': 'Template:Flag_country|flag',
+                             'Template:Flag country': 'Template:Flag',
+                             'Template:Article': ':Some page',
+                             'Template:Loop': 'Template:Loop 2',
+                             'Template:Loop 2': 'Template:Loop',
+                             'Template:Into loop': 'Template:Loop',
+                             'Template:Self': 'Template:Self'}
+        self.assertEqual(resolveRedirects(), 4)
+        self.assertEqual(options.redirects,
+                         {'Template:Flag icon': 'Template:Flag',
+                          'Template:Flagicon': 'Template:Flag',
+                          'Template:Flag country': 'Template:Flag',
+                          'Template:Article': 'Some page'})
+
+
+class TestFoldTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (options.templates, options.redirects, options.templateCache,
+                      options.templatePrefix, options.foldedTemplates)
+        options.templates = {'Template:Ndash': '&ndash;',
+                             'Template:Nbsp': '&nbsp;',
+                             'Template:Snd': '{{nbsp}}{{ndash}} ',
+                             'Template:Spaced': '{{snd}}{{#expr:1+1}}',
+                             'Template:Here': 'at {{PAGENAME}}',
+                             'Template:There': '{{here}}',
+                             'Template:Hi': 'hi {{{1}}}',
+                             'Template:Loop': '{{loop}}',
+                             'Template:Dash': 'x'}
+        options.redirects = {'Template:Dash': 'Template:Ndash'}
+        options.templateCache = {}
+        options.templatePrefix = 'Template:'
+        options.foldedTemplates = {}
+
+    def tearDown(self):
+        (options.templates, options.redirects, options.templateCache,
+         options.templatePrefix, options.foldedTemplates) = self.saved
+
+    def test_fold(self):
+        self.assertEqual(foldTemplates(), 4)
+        self.assertEqual(options.foldedTemplates,
+                         {'Template:Ndash': '&ndash;', 'Template:Nbsp': '&nbsp;',
+                          'Template:Snd': '&nbsp;&ndash; ', 'Template:Spaced': '&nbsp;&ndash; 2'})
+
+    def test_expand(self):
+        e = Extractor(1, 1, 'A', [])
+        e.magicWords['PAGENAME'] = 'A'
+        expected = e.expand('{{spaced}} {{dash}} {{there}}')
+        foldTemplates()
+        e = Extractor(1, 1, 'A', [])
+        e.magicWords['PAGENAME'] = 'A'
+        self.assertEqual(e.expand('{{spaced}} {{dash}} {{there}}'), expected)
+        self.assertEqual(expected, '&nbsp;&ndash; 2 &ndash; at A')
+
+
+class TestExpansionBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (options.templates, options.templatePrefix, options.max_expansions,
+                      options.max_expanded_chars, options.max_expansion_time)
+        options.templates = {'Template:Hi': 'hi {{{1}}}', 'Template:Nest': '{{hi|{{{1}}}}}!'}
+        options.templatePrefix = 'Template:'
+
+    def tearDown(self):
+        (options.templates, options.templatePrefix, options.max_expansions,
+         options.max_expanded_chars, options.max_expansion_time) = self.saved
+
+    def test_expansions(self):
+        options.max_expansions = 3
+        e = Extractor(1, 1, 'A', [])
+        self.assertEqual(e.expand('{{hi|a}} {{nest|b}} {{hi|c}} {{hi|d}}'), 'hi a hi b!  ')
+        self.assertEqual(e.budget_exceeded_errs, 2)
+        self.assertEqual(e.errors()[-1], 2)
+
+    def test_chars(self):
+        options.max_expanded_chars = 8
+        e = Extractor(1, 1, 'A', [])
+        self.assertEqual(e.expand('{{hi|a}}{{hi|b}}{{hi|c}}'), 'hi ahi b')
+
+    def test_time(self):
+        options.max_expansion_time = 10
+        e = Extractor(1, 1, 'A', [])
+        self.assertEqual(e.expand('{{hi|a}}'), 'hi a')
+        e.start_time -= 10
+        self.assertEqual(e.expand('{{hi|a}}'), '')
+
+    def test_unlimited(self):
+        options.max_expansions = options.max_expanded_chars = options.max_expansion_time = 0
+        e = Extractor(1, 1, 'A', [])
+        self.assertEqual(e.expand('{{hi|a}}' * 100), 'hi a' * 100)
+        self.assertEqual(e.expansions, 100)
+
+
+class TestTemplatePlan(unittest.TestCase):
+
+    bodies = ['plain text',
+              '',
+              '{{{1}}} and {{{name|default}}}',
+              '{{{1|}}}{{{2|{{{1|none}}}}}}',
+              'a{{{x{{{1|}}}|}}}b',
+              '{{{{{{p}}}}}}',
+              '{{{missing}}}']
+
+    def test_same_as_parts(self):
+        e = Extractor(1, 1, 'A', [])
+        for params in ({}, {'1': 'one', 'name': 'N', 'p': 'q', 'q': 'r', 'xone': 'X'}):
+            for body in self.bodies:
+                template = Template.parse(body)
+                self.assertEqual(template.subst(params, e),
+                                 template.substParts(params, e, 0), body)
+
+    def test_plan(self):
+        plan = Template.parse('a{{{1}}}b{{{x{{{1}}}|d}}}').compile()
+        self.assertEqual(plan[0], 'a')
+        self.assertEqual(plan[1][:2], ('1', None))
+        self.assertEqual(plan[2], 'b')
+        self.assertEqual(plan[3][:2], (None, 'd'))
+
+
+class TestSwitch(unittest.TestCase):
+
+    def linear_switch(self, e, primary, *params):
+        index = wikiextractor.switch_index
+        wikiextractor.switch_index = lambda params: None
+        try:
+            return sharp_switch(e, primary, *params)
+        finally:
+            wikiextractor.switch_index = index
+
+    def test_same_as_linear(self):
+        e = Extractor(1, 1, 'A', [])
+        labels = ['a', 'b', ' c ', '#default', 'a|b', 'd']
+        rnd = random.Random(1)
+        for _ in range(500):
+            params = []
+            for i in range(rnd.randint(0, 6)):
+                label = rnd.choice(labels)
+                params.append(label + ('= v%d ' % i if rnd.random() < 0.7 else ''))
+            for primary in ('a', 'b', 'c', 'd', 'z', '#default', ' a '):
+                self.assertEqual(sharp_switch(e, primary, *params),
+                                 self.linear_switch(e, primary, *params), params)
+
+    def test_templates_in_labels(self):
+        e = Extractor(1, 1, 'A', [])
+        e.magicWords['PAGENAME'] = 'A'
+        params = ('B=no', '{{PAGENAME}}=yes', '#default=other')
+        self.assertEqual(sharp_switch(e, 'A', *params), 'yes')
+        self.assertEqual(sharp_switch(e, 'C', *params), 'other')
+
+
+class TestExpr(unittest.TestCase):
+
+    def test_arithmetic(self):
+        self.assertEqual(expr('1 + 2 * 3'), '7')
+        self.assertEqual(expr('(1 + 2) * 3'), '9')
+        self.assertEqual(expr('10 / 4'), '2.5')
+        self.assertEqual(expr('7 mod 3'), '1')
+        self.assertEqual(expr('-7 mod 3'), '-1')
+        self.assertEqual(expr('2^10'), '1024')
+        self.assertEqual(expr('-2^2'), '4')
+        self.assertEqual(expr('1/3'), '0.33333333333333')
+        self.assertEqual(expr('2e3'), '2000')
+        self.assertEqual(expr('1e20'), '1.0E+20')
+        self.assertEqual(expr(' '), '')
+
+    def test_functions(self):
+        self.assertEqual(expr('2.5 round 0'), '3')
+        self.assertEqual(expr('-2.5 round 0'), '-3')
+        self.assertEqual(expr('pi round 2'), '3.14')
+        self.assertEqual(expr('floor 2.7 + ceil 2.2'), '5')
+        self.assertEqual(expr('abs -3'), '3')
+        self.assertEqual(expr('sqrt 16'), '4')
+
+    def test_logic(self):
+        self.assertEqual(expr('3 > 2 and 2 >= 2'), '1')
+        self.assertEqual(expr('1 = 2 or not 0'), '1')
+        self.assertEqual(expr('1 <> 1'), '0')
+        self.assertTrue(ifexpr('2 > 1'))
+        self.assertFalse(ifexpr('0'))
+        self.assertFalse(ifexpr(''))
+
+    def test_errors(self):
+        for invalid in ('1/0', '1 +', '(1', '1)', 'foo', '1 2', '__import__("os")'):
+            self.assertRaises(ExprError, expr, invalid)
+
+    def test_limits(self):
+        self.assertEqual(expr('1 round 400'), '1')
+        self.assertEqual(expr('1.5 round 1e300'), '1.5')
+        self.assertEqual(expr('123 round -400'), '0')
+        self.assertEqual(expr('1e300 round 100'), '1.0E+300')
+        self.assertEqual(expr('sin(1e400)'), 'NAN')
+        self.assertEqual(expr('tan(1e400)'), 'NAN')
+        self.assertEqual(expr('1e400 fmod 2'), 'NAN')
+        nested = '(' * 3000 + '1' + ')' * 3000
+        self.assertRaises(ExprError, expr, nested)
+        self.assertRaises(ExprError, ifexpr, nested)
+        e = Extractor(1, 1, 'A', [])
+        self.assertEqual(e.expand('{{#expr: 1 round 400}}'), '1')
+        self.assertEqual(e.expand('{{#ifexpr: %s | yes | no}}' % nested),
+                         '<span class="error">%s</span>' % nested)
+
+    def test_parser_functions(self):
+        e = Extractor(1, 1, 'A', [])
+        self.assertEqual(e.expand('{{#expr: 2 * 21}}'), '42')
+        self.assertEqual(e.expand('{{#ifexpr: 1 > 2 | yes | no}}'), 'no')
+        self.assertEqual(e.expand('{{#ifexpr: 1 < 2 | yes | no}}'), 'yes')
+        self.assertEqual(e.expand('{{#expr: 1 +}}'), '<span class="error">1 +</span>')
+
+
+def make_page(id, title, text, ns='0'):
+    return ('<page>\n<title>%s</title>\n<ns>%s</ns>\n<id>%d</id>\n'
+            '<revision>\n<id>%d</id>\n<text xml:space="preserve">%s</text>\n'
+            '</revision>\n</page>\n') % (title, ns, id, id * 10, text)
+
+
+class TestMultistream(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dump = os.path.join(self.dir, 'dump-multistream.xml.bz2')
+        self.index = os.path.join(self.dir, 'dump-multistream-index.txt.bz2')
+        streams = [['<mediawiki>\n<siteinfo>\n</siteinfo>\n'],
+                   [make_page(1, 'A: one', 'first'), make_page(2, 'B', 'second')],
+                   [make_page(3, 'C', 'third')],
+                   ['</mediawiki>\n']]
+        with open(self.dump, 'wb') as dump, bz2.open(self.index, 'wt') as index:
+            for stream in streams:
+                offset = dump.tell()
+                dump.write(bz2.compress(''.join(stream).encode('utf-8')))
+                for page in stream:
+                    if '<page>' in page:
+                        m = page.split('<title>')[1].split('</title>')[0]
+                        id = page.split('<id>')[1].split('</id>')[0]
+                        index.write('%d:%s:%s\n' % (offset, id, m))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_index(self):
+        entries = list(read_index(self.index))
+        self.assertEqual([(id, title) for _, id, title in entries],
+                         [('1', 'A: one'), ('2', 'B'), ('3', 'C')])
+        offsets = stream_offsets(self.index)
+        self.assertEqual(len(offsets), 2)
+        self.assertEqual(offsets[0], entries[0][0])
+
+    def test_streams(self):
+        offsets = stream_offsets(self.index)
+        spans = stream_spans(self.dump, offsets)
+        self.assertEqual(spans[-1][1], os.path.getsize(self.dump))
+        with open(self.dump, 'rb') as dump:
+            self.assertIn('<siteinfo>', read_header(dump, offsets))
+            titles = []
+            for start, end in spans:
+                lines = read_stream(dump, start, end).splitlines(True)
+                titles.append([page[2] for page in pages_from(lines)])
+        self.assertEqual(titles, [['A: one', 'B'], ['C']])
+
+    def test_locate(self):
+        spans = stream_spans(self.dump, stream_offsets(self.index))
+        self.assertEqual(locate(self.dump, self.index, ids=['2']), spans[:1])
+        self.assertEqual(locate(self.dump, self.index, ids=['1'], titles=['B']), spans[:1])
+        self.assertEqual(locate(self.dump, self.index, titles=['C', 'A: one']), spans)
+        self.assertEqual(locate(self.dump, self.index, ids=['4']), [])
+
+    def test_locate_prefixes(self):
+        spans = stream_spans(self.dump, stream_offsets(self.index))
+        self.assertEqual(locate_prefixes(self.dump, self.index, ['A:']), spans[:1])
+        self.assertEqual(locate_prefixes(self.dump, self.index, ['B', 'C']), spans)
+        self.assertEqual(locate_prefixes(self.dump, self.index, ['C']), spans[1:])
+        self.assertEqual(locate_prefixes(self.dump, self.index, ['Z:']), [])
+
+
+class TestReadRange(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dump = os.path.join(self.dir, 'dump.xml')
+        with open(self.dump, 'w', encoding='utf-8') as dump:
+            dump.write('<mediawiki>\n<siteinfo>\n</siteinfo>\n')
+            for id in range(1, 21):
+                dump.write(make_page(id, 'Pàge %d' % id, 'text\nof %d' % id))
+            dump.write('</mediawiki>\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_every_page_once(self):
+        expected = [str(id) for id in range(1, 21)]
+        with open(self.dump, 'rb') as dump:
+            for count in (1, 2, 7, 50, 5000):
+                ids = []
+                for start, end in byte_ranges(self.dump, count):
+                    lines = read_range(dump, start, end).splitlines(True)
+                    ids.extend(page[0] for page in pages_from(lines))
+                self.assertEqual(ids, expected)
+
+    def test_bounded(self):
+        size = os.path.getsize(self.dump)
+        for count in (1, 3):
+            ranges = byte_ranges(self.dump, count, 100)
+            self.assertEqual(len(ranges), -(-size // 100))
+            self.assertTrue(all(end - start <= 100 for start, end in ranges))
+            self.assertEqual((ranges[0][0], ranges[-1][1]), (0, size))
+        self.assertEqual(len(byte_ranges(self.dump, 50, size)), 50)
+
+    def test_chunks(self):
+        with open(self.dump, encoding='utf-8') as dump:
+            text = dump.read()
+        # a redirect, an empty text, a page repeated
+        text = text.replace('<ns>0</ns>\n<id>3</id>',
+                            '<ns>0</ns>\n<id>3</id>\n<redirect title="B" />')
+        text = text.replace('<text xml:space="preserve">text\nof 5</text>',
+                            '<text xml:space="preserve" />')
+        text = text.replace('</mediawiki>', make_page(20, 'Pàge 20', '') + '</mediawiki>')
+        expected = list(pages_from(text.splitlines(True)))
+        self.assertEqual(len(expected), 19)
+        for size in (1, 10, 100, 1 << 20):
+            pages = pages_from_chunks(io.BytesIO(text.encode('utf-8')), size)
+            self.assertEqual(list(pages), expected)
+
+    def test_blocks(self):
+        expected = [str(id) for id in range(1, 21)]
+        with open(self.dump, 'rb') as dump:
+            for size in (1, 10, 100, 1 << 20):
+                dump.seek(0)
+                ids = []
+                for block in page_blocks(dump, size):
+                    self.assertTrue(block.endswith(b'</page>'))
+                    ids.extend(page[0] for page in pages_from_chunks(io.BytesIO(block)))
+                self.assertEqual(ids, expected)
+
+
+
+class TestLoadTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict(vars(options))
+        # as set by main() for the workers
+        options.quiet = True
+        options.debug = False
+        self.dir = tempfile.mkdtemp()
+        self.dump = os.path.join(self.dir, 'dump.xml')
+        # no namespaces in siteinfo
+        with open(self.dump, 'w', encoding='utf-8') as dump:
+            dump.write('<mediawiki>\n<siteinfo>\n</siteinfo>\n')
+            for id in range(1, 31):
+                dump.write(make_page(id, 'Page %d' % id, 'text of %d' % id))
+                dump.write(make_page(100 + id, 'Vorlage:T%d' % id,
+                                     '{{{1}}} &lt;noinclude&gt;%d&lt;/noinclude&gt;' % id, '10'))
+            dump.write(make_page(200, 'Vorlage:R', '#REDIRECT [[Vorlage:T1]]', '10'))
+            dump.write(make_page(201, 'Modul:M', 'return {}', '828'))
+            dump.write(make_page(202, 'Vorlage:T2', 'redefined', '10'))
+            dump.write('</mediawiki>\n')
+
+    def tearDown(self):
+        vars(options).clear()
+        vars(options).update(self.saved)
+        shutil.rmtree(self.dir)
+
+    def load(self, loader, *args):
+        options.templates = {}
+        options.redirects = {}
+        options.templateNamespace = options.moduleNamespace = ''
+        loader(*args)
+        return (options.templates, options.redirects,
+                options.templateNamespace, options.templatePrefix,
+                options.moduleNamespace, options.modulePrefix)
+
+    def test_parallel(self):
+        with open(self.dump, encoding='utf-8') as dump:
+            expected = self.load(wikiextractor.load_templates, dump)
+        self.assertEqual(len(expected[0]), 31)
+        self.assertEqual(expected[0]['Vorlage:T2'], 'redefined')
+        self.assertEqual(expected[1], {'Vorlage:R': 'Vorlage:T1'})
+        self.assertEqual(expected[2:], ('Vorlage', 'Vorlage:', 'Modul', 'Modul:'))
+        self.assertEqual(self.load(wikiextractor.load_templates_parallel, self.dump, 2),
+                         expected)
+        self.assertEqual(self.load(wikiextractor.load_templates_parallel, self.dump, 3,
+                                   None, read_range, byte_ranges(self.dump, 7)),
+                         expected)
+
+
+class TestTemplateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dump = os.path.join(self.dir, 'dump.xml')
+        self.store = os.path.join(self.dir, 'templates.pkl')
+        with open(self.dump, 'w') as dump:
+            dump.write('<mediawiki>\n</mediawiki>\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        fingerprint = dump_fingerprint(self.dump)
+        save_store(self.store, fingerprint, {'Template:A': 'a'},
+                   {'Template:B': 'Template:A'}, ('Template', 'Module'))
+        store = load_store(self.store, fingerprint)
+        self.assertEqual(store['templates'], {'Template:A': 'a'})
+        self.assertEqual(store['redirects'], {'Template:B': 'Template:A'})
+        self.assertEqual(store['namespaces'], ('Template', 'Module'))
+        self.assertIsNotNone(load_store(self.store, None))
+
+    def test_stale(self):
+        save_store(self.store, dump_fingerprint(self.dump), {}, {}, ('', ''))
+        with open(self.dump, 'a') as dump:
+            dump.write('\n')
+        self.assertIsNone(load_store(self.store, dump_fingerprint(self.dump)))
+        with open(self.store, 'wb') as store:
+            store.write(b'garbage')
+        self.assertIsNone(load_store(self.store, None))
+
+    def test_table(self):
+        path = os.path.join(self.dir, 'table')
+        mapping = {'Template:T%d' % i: 'body {{{%d}}}' % i for i in range(500)}
+        mapping['Template:Città'] = 'è'
+        mapping['Template:Empty'] = ''
+        write_table(path, mapping)
+        table = TemplateTable(path)
+        self.assertEqual(len(table), len(mapping))
+        self.assertEqual(dict(table), mapping)
+        self.assertEqual(table['Template:Città'], 'è')
+        self.assertIn('Template:Empty', table)
+        self.assertNotIn('Template:Missing', table)
+        self.assertIsNone(table.get('Template:Missing'))
+        copy = pickle.loads(pickle.dumps(table))
+        self.assertEqual(copy['Template:T7'], 'body {{{7}}}')
+        copy.close()
+        table.close()
+
+
 if __name__ == '__main__':
     unittest.main()
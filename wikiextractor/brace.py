@@ -1,8 +1,151 @@
 import re
+from array import array
+from bisect import bisect_left, bisect_right
 
-def findMatchingBraces(text, ldelim=0):
+try:
+    import numpy
+except ImportError:             # optional, for very large pages
+    numpy = None
+
+# runs of at least two braces or brackets, the only ones that matter
+tokenRE = re.compile(r'([{}\[\]])\1+')
+
+# with NumPy, texts of at least so many characters are tokenized, and
+# tokens at least so many are matched, in bulk
+bulk_size = 64 * 1024
+bulk_tokens = 1024
+
+
+class BraceTokens(object):
+    """
+    The runs of two or more braces or brackets in a text, found in a single
+    scan: their start and end offsets, and the character they repeat.
+
+    Expansion matches braces in a text, then splits the parts of each
+    template and expands each part in turn: slicing the tokens of the whole
+    text gives those of any part, instead of scanning it again.
+    A slice shares the arrays of the whole text, restricted to the tokens
+    between its bounds, with runs cut by the bounds shortened.
+    """
+
+    __slots__ = ('starts', 'ends', 'kinds', 'base', 'limit', 'lo', 'hi')
+
+    def __init__(self, text=''):
+        if numpy is not None and len(text) >= bulk_size:
+            self.starts, self.ends, self.kinds = bulkTokens(text)
+        else:
+            spans = [m.span() for m in tokenRE.finditer(text)]
+            if spans:
+                starts, ends = zip(*spans)
+            else:
+                starts = ends = ()
+            self.starts = array('l', starts)
+            self.ends = array('l', ends)
+            self.kinds = ''.join(map(text.__getitem__, starts))
+        self.base = 0
+        self.limit = len(text)
+        self.lo = 0
+        self.hi = len(self.kinds)
+
+    def slice(self, start, end):
+        """
+        :return: the tokens of text[start:end], with offsets relative to
+        :param start:.
+        """
+        tokens = BraceTokens.__new__(BraceTokens)
+        tokens.starts = self.starts
+        tokens.ends = self.ends
+        tokens.kinds = self.kinds
+        tokens.base = self.base + start
+        tokens.limit = self.base + end
+        tokens.lo = bisect_right(self.ends, tokens.base, self.lo, self.hi)
+        tokens.hi = bisect_left(self.starts, tokens.limit, tokens.lo, self.hi)
+        return tokens
+
+    def spans(self):
+        """
+        :return: the list of tokens (start, end, character), relative to the
+        start of the text. Runs cut by the bounds of a slice are shortened,
+        and dropped if less than two characters are left.
+        """
+        spans = []
+        for i in range(self.lo, self.hi):
+            start = max(self.starts[i], self.base)
+            end = min(self.ends[i], self.limit)
+            if end - start >= 2:
+                spans.append((start - self.base, end - self.base, self.kinds[i]))
+        return spans
+
+
+def bulkTokens(text):
+    """
+    Finds the runs of braces and brackets of :param text: with NumPy, on
+    the array of its code points.
+    :return: the arrays of the starts and ends of the runs, and the string
+    of their characters, as in BraceTokens.
+    """
+    codes = numpy.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+    # boundaries of the runs of equal characters
+    bounds = numpy.concatenate(([0], numpy.flatnonzero(codes[1:] != codes[:-1]) + 1,
+                                [len(codes)]))
+    starts = bounds[:-1]
+    ends = bounds[1:]
+    chars = codes[starts]
+    keep = (numpy.isin(chars, [ord('{'), ord('}'), ord('['), ord(']')]) &
+            (ends - starts >= 2))
+    return (array('l', starts[keep].astype('l').tobytes()),
+            array('l', ends[keep].astype('l').tobytes()),
+            chars[keep].astype(numpy.uint8).tobytes().decode('ascii'))
+
+
+def bulkMatchingBraces(tokens, ldelim):
+    """
+    Matches templates in bulk with NumPy. When all openings are double
+    braces, the nesting depth at each token is a cumulative sum, and
+    templates span from an opening at depth 0 to the next return to it.
+    :param tokens: BraceTokens.
+    :return: the list of spans, as by findMatchingBraces(), or None when the
+    lengths of runs decide the matching: with brackets, tplargs or longer
+    runs of opening braces, like {{{{{.
+    """
+    lo, hi = tokens.lo, tokens.hi
+    starts = numpy.frombuffer(tokens.starts, dtype='l')[lo:hi]
+    ends = numpy.frombuffer(tokens.ends, dtype='l')[lo:hi]
+    kinds = numpy.frombuffer(tokens.kinds[lo:hi].encode('ascii'), dtype=numpy.uint8)
+    # clip the runs cut by the bounds of a slice
+    starts = numpy.maximum(starts, tokens.base) - tokens.base
+    ends = numpy.minimum(ends, tokens.limit) - tokens.base
+    lengths = ends - starts
+    opening = (kinds == ord('{')) & (lengths >= 2)
+    closing = (kinds == ord('}')) & (lengths >= 2)
+    if numpy.any(opening & (lengths > 2)):
+        return None
+    if ldelim > 2:
+        return []               # no opening long enough
+    if not ldelim and numpy.any(((kinds == ord('[')) | (kinds == ord(']'))) &
+                                (lengths >= 2)):
+        return None
+    # a run of closing braces closes up to half its length templates:
+    # split runs into units, one per opening or closing
+    counts = numpy.where(opening, 1, numpy.where(closing, lengths // 2, 0))
+    token = numpy.repeat(numpy.arange(len(counts)), counts)
+    unit = numpy.arange(len(token)) - (numpy.cumsum(counts) - counts)[token]
+    positions = starts[token] + 2 * unit
+    steps = numpy.where(opening[token], 1, -1)
+    depth = numpy.cumsum(steps)
+    # closings outside templates are plain text: the depth stays at 0
+    depth -= numpy.minimum.accumulate(numpy.minimum(depth, 0))
+    previous = numpy.concatenate(([0], depth[:-1]))
+    begins = positions[(steps == 1) & (previous == 0)]
+    finishes = positions[(steps == -1) & (previous == 1) & (depth == 0)] + 2
+    # an unclosed template ends the matching
+    return list(zip(begins[:len(finishes)].tolist(), finishes.tolist()))
+
+
+def findMatchingBraces(text, ldelim=0, tokens=None):
     """
     :param ldelim: number of braces to match. 0 means match [[]], {{}} and {{{}}}.
+    :param tokens: the BraceTokens of :param text:, if already computed.
     """
     # Parsing is done with respect to pairs of double braces {{..}} delimiting
     # a template, and pairs of triple braces {{{..}}} delimiting a tplarg.
@@ -39,31 +182,60 @@ def findMatchingBraces(text, ldelim=0):
     # as well as expressions with stray }:
     #   {{{link|{{ucfirst:{{{1}}}}}} interchange}}}
 
+    if tokens is None:
+        tokens = BraceTokens(text)
+    if numpy is not None and tokens.hi - tokens.lo >= bulk_tokens:
+        spans = bulkMatchingBraces(tokens, ldelim)
+        if spans is not None:
+            yield from spans
+            return
+    starts = tokens.starts
+    ends = tokens.ends
+    kinds = tokens.kinds
+    base = tokens.base
+    limit = tokens.limit
+    count = tokens.hi
     if ldelim:  # 2-3
-        reOpen = re.compile('[{]{%d,}' % ldelim)  # at least ldelim
-        reNext = re.compile('[{]{2,}|}{2,}')  # at least 2
+        opening = '{'           # at least ldelim
+        following = '{}'
     else:
-        reOpen = re.compile('{{2,}|\[{2,}')
-        reNext = re.compile('{{2,}|}{2,}|\[{2,}|]{2,}')  # at least 2
+        opening = '{['
+        following = '{}[]'
+    least = max(ldelim, 2)
 
-    cur = 0
+    # offsets are clipped to the bounds of a slice, and made relative to it
+    cur = tokens.lo
     while True:
-        m1 = reOpen.search(text, cur)
-        if not m1:
+        # next opening run
+        while cur < count:
+            if kinds[cur] in opening:
+                start = max(starts[cur], base)
+                end = min(ends[cur], limit)
+                if end - start >= least:
+                    break
+            cur += 1
+        if cur == count:
             return
-        lmatch = m1.end() - m1.start()
-        if m1.group()[0] == '{':
+        lmatch = end - start
+        start -= base
+        if kinds[cur] == '{':
             stack = [lmatch]  # stack of opening braces lengths
         else:
             stack = [-lmatch]  # negative means [
-        end = m1.end()
         while True:
-            m2 = reNext.search(text, end)
-            if not m2:
+            cur += 1
+            while cur < count:
+                if kinds[cur] in following:
+                    # only the last run can be cut
+                    end = min(ends[cur], limit)
+                    lmatch = end - starts[cur]
+                    if lmatch >= 2:
+                        break
+                cur += 1
+            if cur == count:
                 return  # unbalanced
-            end = m2.end()
-            brac = m2.group()[0]
-            lmatch = m2.end() - m2.start()
+            end -= base
+            brac = kinds[cur]
 
             if brac == '{':
                 stack.append(lmatch)
@@ -81,13 +253,13 @@ def findMatchingBraces(text, ldelim=0):
                         stack.append(openCount - lmatch)
                         break
                 if not stack:
-                    yield m1.start(), end - lmatch
-                    cur = end
+                    yield start, end - lmatch
+                    cur += 1
                     break
                 elif len(stack) == 1 and 0 < stack[0] < ldelim:
                     # ambiguous {{{{{ }}} }}
-                    #yield m1.start() + stack[0], end
-                    cur = end
+                    #yield start + stack[0], end
+                    cur += 1
                     break
             elif brac == '[':  # [[
                 stack.append(-lmatch)
@@ -103,8 +275,7 @@ def findMatchingBraces(text, ldelim=0):
                         stack.append(lmatch - openCount)
                         break
                 if not stack:
-                    yield m1.start(), end - lmatch
-                    cur = end
+                    yield start, end - lmatch
+                    cur += 1
                     break
                 # unmatched ]] are discarded
-                cur = end
@@ -0,0 +1,303 @@
+"""
+Evaluator of the expressions of #expr and #ifexpr.
+
+Follows the syntax and precedences of the ParserFunctions extension:
+@see https://www.mediawiki.org/wiki/Help:Extension:ParserFunctions##expr
+
+Expressions are parsed by precedence climbing into trees of tuples
+(operator, operands...), which are cached by expression string, since the
+same expressions recur in the same templates.
+"""
+
+import math
+import re
+from functools import lru_cache
+
+
+class ExprError(Exception):
+    """An invalid expression, or one that cannot be evaluated."""
+
+
+tokenRE = re.compile(r'\s*(?:([0-9]*\.?[0-9]+\.?|[0-9]+\.)|([a-zA-Z]+)|'
+                     r'(<>|!=|<=|>=|[-+*/^()=<>−]))')
+
+# binary operators and their precedence
+binary = {
+    'e': 10,
+    '^': 8,
+    '*': 7, '/': 7, 'div': 7, 'mod': 7, 'fmod': 7,
+    '+': 6, '-': 6,
+    'round': 5,
+    '=': 4, '<>': 4, '!=': 4, '<': 4, '>': 4, '<=': 4, '>=': 4,
+    'and': 3,
+    'or': 2,
+}
+
+# unary operators and their precedence
+unary = {
+    '-': 10, '+': 10,
+    'not': 9,
+    'abs': 9, 'floor': 9, 'ceil': 9, 'trunc': 9, 'ln': 9, 'exp': 9,
+    'sqrt': 9, 'sin': 9, 'cos': 9, 'tan': 9, 'asin': 9, 'acos': 9, 'atan': 9,
+}
+
+constants = {'e': math.e, 'pi': math.pi}
+
+
+def tokenize(expr):
+    """
+    :return: the list of tokens of :param expr:, numbers as floats and
+    words in lower case.
+    """
+    tokens = []
+    pos = 0
+    end = len(expr.rstrip())
+    while pos < end:
+        m = tokenRE.match(expr, pos)
+        if not m:
+            raise ExprError('Unrecognized punctuation character "%s"' % expr[pos:].lstrip()[0])
+        number, word, op = m.groups()
+        if number:
+            if number.count('.') > 1:
+                raise ExprError('Unexpected number')
+            tokens.append(float(number))
+        elif word:
+            word = word.lower()
+            if word not in binary and word not in unary and word not in constants:
+                raise ExprError('Unrecognized word "%s"' % word)
+            tokens.append(word)
+        else:
+            tokens.append('-' if op == '−' else op)
+        pos = m.end()
+    return tokens
+
+
+@lru_cache(maxsize=4096)
+def parse(expr):
+    """
+    Parses an expression.
+    :return: its tree, or None for an empty expression.
+    :raise ExprError: if the expression is invalid.
+    """
+    tokens = tokenize(expr)
+    if not tokens:
+        return None
+    tree, pos = parse_binary(tokens, 0, 0)
+    if pos < len(tokens):
+        if tokens[pos] == ')':
+            raise ExprError('Unexpected closing bracket')
+        raise ExprError('Unexpected number' if isinstance(tokens[pos], float)
+                        else 'Unexpected operator %s' % tokens[pos])
+    return tree
+
+
+def parse_binary(tokens, pos, min_prec):
+    """
+    Parses the operations of precedence at least :param min_prec: starting
+    at :param pos:.
+    :return: the tree and the position following it.
+    """
+    tree, pos = parse_unary(tokens, pos)
+    while pos < len(tokens):
+        op = tokens[pos]
+        prec = binary.get(op) if isinstance(op, str) else None
+        if prec is None or prec < min_prec:
+            break
+        # all operators associate to the left
+        right, pos = parse_binary(tokens, pos + 1, prec + 1)
+        tree = (op, tree, right)
+    return tree, pos
+
+
+def parse_unary(tokens, pos):
+    """
+    Parses a number, a constant, a parenthesized expression or a unary
+    operation.
+    :return: the tree and the position following it.
+    """
+    if pos >= len(tokens):
+        raise ExprError('Missing operand')
+    token = tokens[pos]
+    if isinstance(token, float):
+        return token, pos + 1
+    if token == '(':
+        tree, pos = parse_binary(tokens, pos + 1, 0)
+        if pos >= len(tokens) or tokens[pos] != ')':
+            raise ExprError('Unclosed bracket')
+        return tree, pos + 1
+    if token in constants:
+        return constants[token], pos + 1
+    if token in unary:
+        operand, pos = parse_binary(tokens, pos + 1, unary[token])
+        return (token, operand), pos
+    raise ExprError('Unexpected operator %s' % token)
+
+
+def truncate(x):
+    """Converts to an integer as PHP does, checking the range."""
+    if math.isnan(x) or math.isinf(x):
+        raise ExprError('Invalid integer')
+    return int(x)
+
+
+def round_half_up(x, digits):
+    """Rounds halves away from zero, as PHP round()."""
+    digits = truncate(digits)
+    if not math.isfinite(x) or digits > 308:
+        return x
+    if digits < -308:
+        return math.copysign(0.0, x)
+    scale = 10.0 ** digits
+    scaled = abs(x) * scale
+    if scaled >= 2.0 ** 52:
+        # no fractional digits left at that precision
+        return x
+    return math.copysign(math.floor(scaled + 0.5) / scale, x)
+
+
+def power(x, y):
+    try:
+        return math.pow(x, y)
+    except OverflowError:
+        return math.inf
+    except ValueError:
+        return math.nan
+
+
+def divide(x, y):
+    if y == 0:
+        raise ExprError('Division by zero')
+    return x / y
+
+
+def modulo(x, y):
+    x, y = truncate(x), truncate(y)
+    if y == 0:
+        raise ExprError('Division by zero')
+    return float(int(math.fmod(x, y)))
+
+
+def fmodulo(x, y):
+    if y == 0:
+        raise ExprError('Division by zero')
+    return math.fmod(x, y) if math.isfinite(x) else math.nan
+
+
+def finite(function):
+    """Extends :param function: to infinities, where it is NAN as in PHP."""
+    return lambda x: function(x) if math.isfinite(x) else math.nan
+
+
+def checked(function, name, valid):
+    def apply(x):
+        if not valid(x):
+            raise ExprError('Invalid argument for %s' % name)
+        return function(x)
+    return apply
+
+
+binary_functions = {
+    'e': lambda x, y: x * power(10.0, y),
+    '^': power,
+    '*': lambda x, y: x * y,
+    '/': divide,
+    'div': divide,
+    'mod': modulo,
+    'fmod': fmodulo,
+    '+': lambda x, y: x + y,
+    '-': lambda x, y: x - y,
+    'round': round_half_up,
+    '=': lambda x, y: float(x == y),
+    '<>': lambda x, y: float(x != y),
+    '!=': lambda x, y: float(x != y),
+    '<': lambda x, y: float(x < y),
+    '>': lambda x, y: float(x > y),
+    '<=': lambda x, y: float(x <= y),
+    '>=': lambda x, y: float(x >= y),
+    'and': lambda x, y: float(bool(x) and bool(y)),
+    'or': lambda x, y: float(bool(x) or bool(y)),
+}
+
+unary_functions = {
+    '-': lambda x: -x,
+    '+': lambda x: x,
+    'not': lambda x: float(not x),
+    'abs': abs,
+    'floor': lambda x: float(math.floor(x)) if math.isfinite(x) else x,
+    'ceil': lambda x: float(math.ceil(x)) if math.isfinite(x) else x,
+    'trunc': lambda x: float(math.trunc(x)) if math.isfinite(x) else x,
+    'ln': checked(math.log, 'ln', lambda x: x > 0),
+    'exp': lambda x: power(math.e, x),
+    'sqrt': lambda x: math.sqrt(x) if x >= 0 else math.nan,
+    'sin': finite(math.sin),
+    'cos': finite(math.cos),
+    'tan': finite(math.tan),
+    'asin': checked(math.asin, 'arcsine', lambda x: -1 <= x <= 1),
+    'acos': checked(math.acos, 'arccosine', lambda x: -1 <= x <= 1),
+    'atan': math.atan,
+}
+
+
+def evaluate(tree):
+    """
+    :return: the value of the expression :param tree:, as a float.
+    """
+    if isinstance(tree, float):
+        return tree
+    if len(tree) == 3:
+        return binary_functions[tree[0]](evaluate(tree[1]), evaluate(tree[2]))
+    return unary_functions[tree[0]](evaluate(tree[1]))
+
+
+def format_number(x):
+    """Formats a number as PHP does, with 14 significant digits."""
+    if math.isnan(x):
+        return 'NAN'
+    if math.isinf(x):
+        return 'INF' if x > 0 else '-INF'
+    if x == int(x) and abs(x) < 1e15:
+        return str(int(x))
+    text = '%.14G' % x
+    if 'E' in text:
+        mantissa, exponent = text.split('E')
+        if '.' not in mantissa:
+            mantissa += '.0'
+        text = '%sE%+d' % (mantissa, int(exponent))
+    return text
+
+
+def value(expression):
+    """
+    :return: the value of :param expression:, None if it is empty.
+    :raise ExprError: for an invalid expression, including one that is too
+    deeply nested or whose value is out of the range of floats.
+    """
+    try:
+        tree = parse(expression)
+        return None if tree is None else evaluate(tree)
+    except RecursionError:
+        raise ExprError('Expression too deeply nested')
+    except (ValueError, OverflowError, ZeroDivisionError) as e:
+        raise ExprError(str(e))
+
+
+def expr(expression):
+    """
+    Evaluates the expression of #expr.
+    :return: the formatted result, '' for an empty expression.
+    :raise ExprError: for an invalid expression.
+    """
+    result = value(expression)
+    if result is None:
+        return ''
+    return format_number(result)
+
+
+def ifexpr(expression):
+    """
+    Evaluates the condition of #ifexpr.
+    :return: whether it is true, i.e. not zero. An empty one is false.
+    :raise ExprError: for an invalid expression.
+    """
+    result = value(expression)
+    return result is not None and result != 0
@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 from urllib.parse import quote
 from wikiextractor.options import options
 
@@ -26,6 +27,18 @@ EXT_IMAGE_REGEX = re.compile(
 # match tail after wikilink
 tailRE = re.compile('\w+')
 
+@lru_cache(maxsize=32)
+def balancedPatterns(openDelim, closeDelim):
+    """
+    :return: the patterns for findBalanced() with tuples :param openDelim:
+    and :param closeDelim:, compiled once.
+    """
+    openPat = '|'.join([re.escape(x) for x in openDelim])
+    # pattern for delimiters expected after each opening delimiter
+    afterPat = {o: re.compile(openPat + '|' + c, re.DOTALL) for o, c in zip(openDelim, closeDelim)}
+    return re.compile(openPat), afterPat
+
+
 def findBalanced(text, openDelim=['[['], closeDelim=[']]']):
     """
     Assuming that text contains a properly balanced expression using
@@ -34,15 +47,12 @@ def findBalanced(text, openDelim=['[['], closeDelim=[']]']):
     :return: an iterator producing pairs (start, end) of start and end
     positions in text containing a balanced expression.
     """
-    openPat = '|'.join([re.escape(x) for x in openDelim])
-    # pattern for delimiters expected after each opening delimiter
-    afterPat = {o: re.compile(openPat + '|' + c, re.DOTALL) for o, c in zip(openDelim, closeDelim)}
+    startPat, afterPat = balancedPatterns(tuple(openDelim), tuple(closeDelim))
     stack = []
     start = 0
     cur = 0
     # end = len(text)
     startSet = False
-    startPat = re.compile(openPat)
     nextPat = startPat
     while True:
         next = nextPat.search(text, cur)
@@ -93,7 +103,7 @@ def replaceInternalLinks(text):
     # call this after removal of external links, so we need not worry about
     # triple closing ]]].
     cur = 0
-    res = ''
+    res = []
     for s, e in findBalanced(text):
         m = tailRE.match(text, e)
         if m:
@@ -111,26 +121,30 @@ def replaceInternalLinks(text):
         else:
             title = inner[:pipe].rstrip()
             # find last |
-            curp = pipe + 1
-            for s1, e1 in findBalanced(inner):
-                last = inner.rfind('|', curp, s1)
-                if last >= 0:
-                    pipe = last  # advance
-                curp = e1
+            if '[[' in inner:
+                curp = pipe + 1
+                for s1, e1 in findBalanced(inner):
+                    last = inner.rfind('|', curp, s1)
+                    if last >= 0:
+                        pipe = last  # advance
+                    curp = e1
             label = inner[pipe + 1:].strip()
-        res += text[cur:s] + makeInternalLink(title, label) + trail
+        res.append(text[cur:s])
+        res.append(makeInternalLink(title, label))
+        res.append(trail)
         cur = end
-    return res + text[cur:]
+    res.append(text[cur:])
+    return ''.join(res)
 
 def replaceExternalLinks(text):
     """
     https://www.mediawiki.org/wiki/Help:Links#External_links
     [URL anchor text]
     """
-    s = ''
+    s = []
     cur = 0
     for m in ExtLinkBracketedRegex.finditer(text):
-        s += text[cur:m.start()]
+        s.append(text[cur:m.start()])
         cur = m.end()
 
         url = m.group(1)
@@ -154,9 +168,10 @@ def replaceExternalLinks(text):
         # This means that users can paste URLs directly into the text
         # Funny characters like ö aren't valid in URLs anyway
         # This was changed in August 2004
-        s += makeExternalLink(url, label)  # + trail
+        s.append(makeExternalLink(url, label))  # + trail
 
-    return s + text[cur:]
+    s.append(text[cur:])
+    return ''.join(s)
 
 
 def makeExternalLink(url, anchor):
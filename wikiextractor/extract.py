@@ -2,6 +2,8 @@ import fileinput
 import re
 import sys
 
+import wikiextractor.multistream as multistream
+import wikiextractor.utils as wutils
 from wikiextractor.extractor import Extractor
 
 def pages_from(input):
@@ -74,3 +76,28 @@ def extract(input_file):
         for page_data in pages_from(input_stream):
             id, revid, title, ns, page = page_data
             yield Extractor(id, revid, title, page).extract_to_json()
+
+
+def extract_pages(input_file, index_file, ids=(), titles=()):
+    """
+    Extracts selected pages from a multistream dump, decompressing only the
+    bz2 streams that contain them, as found through the dump index.
+    :param ids: page ids.
+    :param titles: page titles.
+    :return: an iterator of json data of the pages, in dump order.
+    """
+    ids = set(str(id) for id in ids)
+    titles = set(title.replace('_', ' ') for title in titles)
+    spans = multistream.locate(input_file, index_file, ids, titles)
+    if not spans:
+        return
+    with open(input_file, 'rb') as dump:
+        # the header precedes the first stream of pages
+        header = multistream.read_stream(dump, 0, multistream.first_offset(index_file))
+        wutils.collect_siteinfo(header.splitlines(True))
+        # pages in the same stream are extracted from a single decompression
+        for start, end in spans:
+            lines = multistream.read_stream(dump, start, end).splitlines(True)
+            for id, revid, title, ns, page in pages_from(lines):
+                if id in ids or title in titles:
+                    yield Extractor(id, revid, title, page).extract_to_json()
@@ -25,15 +25,17 @@
 
 """Wikipedia Page Extractor:
 Extracts a single page from a Wikipedia dump file.
+
+With --index, pages are looked up by id or title in the index of a
+multistream dump, and only the bz2 streams containing them are decompressed.
+The extracted text of each page is printed as a json object per line.
 """
 
 import sys, os.path
-import re, random
+import re
 import argparse
-import logging, traceback
-import urllib
-import bz2, gzip
-import Queue, threading, multiprocessing
+import bz2
+import json
 
 
 # Program version
@@ -54,11 +56,11 @@ def process_data(input_file, ids, templates=False):
     """
 
     if input_file.lower().endswith("bz2"):
-        opener = bz2.BZ2File
+        opener = bz2.open
     else:
         opener = open
 
-    input = opener(input_file)
+    input = opener(input_file, 'rt', encoding='utf-8')
     print('<mediawiki>')
 
     rang = ids.split('-')
@@ -70,7 +72,6 @@ def process_data(input_file, ids, templates=False):
     page = []
     curid = 0
     for line in input:
-        line = line.decode('utf-8')
         if '<' not in line:         # faster than doing re.search()
             if page:
                 page.append(line)
@@ -103,7 +104,7 @@ def process_data(input_file, ids, templates=False):
         elif tag == '/page':
             if page:
                 page.append(line)
-                print(''.join(page).encode('utf-8'))
+                print(''.join(page), end='')
                 if not templates and curid == last:
                     break
             curid = 0
@@ -114,6 +115,24 @@ def process_data(input_file, ids, templates=False):
     print('</mediawiki>')
     input.close()
 
+def lookup_pages(input_file, index_file, ids, titles):
+    """
+    :param input_file: name of the multistream dump file.
+    :param index_file: name of its index file.
+    :param ids: article ids (comma separated, or range first-last).
+    :param titles: article titles.
+    """
+    from wikiextractor.extract import extract_pages
+
+    if '-' in ids:
+        first, last = ids.split('-')
+        ids = range(int(first), int(last) + 1)
+    elif ids:
+        ids = ids.split(',')
+    for json_data in extract_pages(input_file, index_file, ids, titles):
+        if json_data:
+            print(json.dumps(json_data, ensure_ascii=False))
+
 def main():
     parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]),
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -121,16 +140,25 @@ def main():
     parser.add_argument("input",
                         help="XML wiki dump file")
     parser.add_argument("--id", default="",
-                        help="article number, or range first-last")
+                        help="article number, or range first-last"
+                        " (comma separated numbers with --index)")
     parser.add_argument("--template", action="store_true",
                         help="extract also all templates")
+    parser.add_argument("--index",
+                        help="index file of the multistream input dump,"
+                        " used to extract the text of the pages")
+    parser.add_argument("--title", action="append", default=[],
+                        help="article title, with --index (may be repeated)")
     parser.add_argument("-v", "--version", action="version",
                         version='%(prog)s ' + version,
                         help="print program version")
 
     args = parser.parse_args()
 
-    process_data(args.input, args.id, args.template)
+    if args.index:
+        lookup_pages(args.input, args.index, args.id, args.title)
+    else:
+        process_data(args.input, args.id, args.template)
 
 if __name__ == '__main__':
     main()
@@ -12,6 +12,7 @@ import wikiextractor.utils as wutils
 from wikiextractor.frame import Frame
 from wikiextractor.magicwords import MagicWords
 from wikiextractor.options import options
+from wikiextractor.tags import tagScanner, tagSpans
 from wikiextractor.template import Template
 
 logger = logging.getLogger(__name__)
@@ -106,9 +107,10 @@ class Extractor(object):
                 templateParams[str(unnamedParameterCounter)] = param
         return templateParams
 
-    def expandTemplate(self, body):
+    def expandTemplate(self, body, tokens=None):
         """Expands template invocation.
         :param body: the parts of a template.
+        :param tokens: the BraceTokens of :param body:, if already computed.
 
         :see http://meta.wikimedia.org/wiki/Help:Expansion for an explanation
         of the process.
@@ -158,7 +160,7 @@ class Extractor(object):
             return ''
 
         logger.debug('%*sEXPAND %s', self.frame.depth, '', body)
-        parts = split_utils.splitParts(body)
+        parts = split_utils.splitParts(body, tokens)
         # title is the portion before the first |
         title = parts[0].strip()
         title = self.expand(title)
@@ -303,20 +305,23 @@ class Extractor(object):
         # https://en.wikipedia.org/wiki/Special:ExpandTemplates
         # https://it.wikipedia.org/wiki/Speciale:EspandiTemplate
 
-        res = ''
         if self.frame.depth >= self.maxTemplateRecursionLevels:
             self.recursion_exceeded_1_errs += 1
-            return res
+            return ''
 
+        # the braces of the text serve for those of all its templates
+        tokens = brace_utils.BraceTokens(wikitext)
+        res = []
         cur = 0
         # look for matching {{...}}
-        for s, e in brace_utils.findMatchingBraces(wikitext, 2):
-            res = '{}{}{}'.format(res, wikitext[cur:s], self.expandTemplate(wikitext[s + 2:e - 2]))
-            #res += wikitext[cur:s] + self.expandTemplate(wikitext[s + 2:e - 2])
+        for s, e in brace_utils.findMatchingBraces(wikitext, 2, tokens):
+            res.append(wikitext[cur:s])
+            res.append(self.expandTemplate(wikitext[s + 2:e - 2],
+                                           tokens.slice(s + 2, e - 2)))
             cur = e
         # leftover
-        res += wikitext[cur:]
-        return res
+        res.append(wikitext[cur:])
+        return ''.join(res)
 
     def clean(self, text):
         """
@@ -332,36 +337,13 @@ class Extractor(object):
             (re.compile(r'<\s*%s(\s*| [^>]+?)>.*?<\s*/\s*%s\s*>' % (tag, tag), re.DOTALL | re.IGNORECASE),
              repl) for tag, repl in placeholder_tags.items()
         ]
-        # Match selfClosing HTML tags
-        selfClosing_tag_patterns = [
-            re.compile(r'<\s*%s\b[^>]*/\s*>' % tag, re.DOTALL | re.IGNORECASE) for tag in selfClosingTags
-        ]
-        comment = re.compile(r'<!--.*?-->', re.DOTALL)
-        # Collect spans
-        spans = []
-        # Drop HTML comments
-        for m in comment.finditer(text):
-            spans.append((m.start(), m.end()))
-
-        # Drop self-closing tags
-        for pattern in selfClosing_tag_patterns:
-            for m in pattern.finditer(text):
-                spans.append((m.start(), m.end()))
-
-        # Drop ignored tags
-        for left, right in options.ignored_tag_patterns:
-            for m in left.finditer(text):
-                spans.append((m.start(), m.end()))
-            for m in right.finditer(text):
-                spans.append((m.start(), m.end()))
-
-        # Bulk remove all spans
-        text = wutils.dropSpans(spans, text)
-
-        # Drop discarded elements
-        for tag in options.discardElements:
-            text = wutils.dropNested(
-                text, r'<\s*%s\b[^>/]*>' % tag, r'<\s*/\s*%s>' % tag)
+        # Drop HTML comments, self-closing tags, ignored tags and
+        # discarded elements, all found in a single scan
+        scanner = tagScanner(selfClosingTags,
+                             tuple(pattern.pattern for pair in options.ignored_tag_patterns
+                                   for pattern in pair),
+                             tuple(options.discardElements))
+        text = wutils.dropSpans(tagSpans(text, scanner), text)
 
         if not options.toHTML:
             # Turn into text what is left (&amp;nbsp;) and <syntaxhighlight>
@@ -463,13 +445,14 @@ class Extractor(object):
         # ############### Process HTML ###############
 
         # turn into HTML, except for the content of <syntaxhighlight>
-        res = ''
+        res = []
         cur = 0
         for m in syntaxhighlight.finditer(text):
-            res += wutils.unescape(text[cur:m.start()]) + m.group(1)
+            res.append(wutils.unescape(text[cur:m.start()]))
+            res.append(m.group(1))
             cur = m.end()
-        text = res + wutils.unescape(text[cur:])
-        return text
+        res.append(wutils.unescape(text[cur:]))
+        return ''.join(res)
 
     def transform1(self, text):
         """Transform text not containing <nowiki>"""
@@ -487,16 +470,16 @@ class Extractor(object):
         @see https://www.mediawiki.org/wiki/Help:Formatting
         """
         # look for matching <nowiki>...</nowiki>
-        res = ''
+        res = []
         cur = 0
         nowiki = re.compile(r'<nowiki>.*?</nowiki>')
         for m in nowiki.finditer(wikitext, cur):
-            res += self.transform1(wikitext[cur:m.start()]) + \
-                wikitext[m.start():m.end()]
+            res.append(self.transform1(wikitext[cur:m.start()]))
+            res.append(m.group())
             cur = m.end()
         # leftover
-        res += self.transform1(wikitext[cur:])
-        return res
+        res.append(self.transform1(wikitext[cur:]))
+        return ''.join(res)
 
     def extract_to_json(self):
         """
@@ -0,0 +1,136 @@
+"""
+Support for bz2 multistream dumps.
+
+A multistream dump (pages-articles-multistream.xml.bz2) is the concatenation
+of independent bz2 streams: the first one holds the <siteinfo> header, each of
+the following ones holds up to 100 pages.
+It comes with an index file (pages-articles-multistream-index.txt.bz2), made
+of lines of the form:
+
+    offset:page_id:page_title
+
+where offset is the position in the dump of the stream containing the page.
+Each stream can therefore be decompressed on its own.
+"""
+
+import bz2
+import os.path
+
+
+def read_index(index_file):
+    """
+    Scans a multistream index file.
+    :return: an iterator of triples (offset, id, title).
+    """
+    if index_file.endswith('.bz2'):
+        input = bz2.open(index_file, 'rt', encoding='utf-8')
+    else:
+        input = open(index_file, 'r', encoding='utf-8')
+    with input:
+        for line in input:
+            # titles may contain colons, ids and offsets cannot
+            offset, id, title = line.rstrip('\n').split(':', 2)
+            yield int(offset), id, title
+
+
+def stream_offsets(index_file):
+    """
+    :return: the sorted list of the offsets of the streams in the dump.
+    """
+    offsets = []
+    last = None
+    for offset, _, _ in read_index(index_file):
+        # the index lists pages in dump order, i.e. grouped by stream
+        if offset != last:
+            offsets.append(offset)
+            last = offset
+    offsets.sort()
+    return offsets
+
+
+def stream_spans(input_file, offsets):
+    """
+    :param offsets: the stream offsets, as returned by stream_offsets().
+    :return: a list of pairs (start, end) delimiting the streams with pages.
+    The last span extends to the end of file, and includes the stream
+    closing </mediawiki>.
+    """
+    ends = offsets[1:] + [os.path.getsize(input_file)]
+    return list(zip(offsets, ends))
+
+
+def read_stream(file, start, end):
+    """
+    Decompresses the bz2 streams found between :param start: and :param end:.
+    :param file: the dump, open in binary mode.
+    :return: the decompressed text.
+    """
+    file.seek(start)
+    # bz2.decompress() handles concatenated streams as well
+    return bz2.decompress(file.read(end - start)).decode('utf-8')
+
+
+def read_header(file, offsets):
+    """
+    :return: the text preceding the first page, i.e. the <siteinfo> header.
+    """
+    return read_stream(file, 0, offsets[0])
+
+
+def locate(input_file, index_file, ids=(), titles=()):
+    """
+    Finds the streams containing the pages with the given ids or titles.
+    :param input_file: the multistream dump.
+    :param ids: page ids, as strings.
+    :param titles: page titles.
+    :return: the sorted list of pairs (start, end) of the streams to read.
+    """
+    ids = set(ids)              # those still to be found
+    titles = set(titles)
+    spans = {}
+    start = None
+    for offset, id, title in read_index(index_file):
+        if offset != start:
+            # a new stream starts, where the previous one ends
+            if start in spans:
+                spans[start] = offset
+            if not ids and not titles:
+                break
+            start = offset
+        if id in ids or title in titles:
+            ids.discard(id)
+            titles.discard(title)
+            spans[offset] = None
+    else:
+        if start in spans:
+            spans[start] = os.path.getsize(input_file)
+    return sorted(spans.items())
+
+
+def locate_prefixes(input_file, index_file, prefixes):
+    """
+    Finds the streams containing pages whose titles start with one of
+    :param prefixes:, e.g. those of the template and module namespaces.
+    :return: the sorted list of pairs (start, end) of the streams to read.
+    """
+    prefixes = tuple(prefixes)
+    spans = {}
+    start = None
+    for offset, id, title in read_index(index_file):
+        if offset != start:
+            if start in spans:
+                spans[start] = offset
+            start = offset
+        if offset not in spans and title.startswith(prefixes):
+            spans[offset] = None
+    if start in spans:
+        spans[start] = os.path.getsize(input_file)
+    return sorted(spans.items())
+
+
+def first_offset(index_file):
+    """
+    :return: the offset of the first stream of pages, where the header ends.
+    """
+    for offset, _, _ in read_index(index_file):
+        return offset
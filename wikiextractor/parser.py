@@ -1,23 +1,32 @@
 import logging
 import re
+from functools import lru_cache
 from urllib.parse import quote
 
 import wikiextractor.template_utils as template_utils
+from wikiextractor.expr import ExprError, expr as evaluateExpr, ifexpr as evaluateCondition
 from wikiextractor.modules import modules
 
 def sharp_expr(extr, expr):
-    """Tries converting a lua expr into a Python expr."""
+    """Evaluates an expression, the value of {{#expr:}}."""
+    expr = extr.expand(expr)
     try:
-        expr = extr.expand(expr)
-        expr = re.sub('(?<![!<>])=', '==', expr) # negative lookbehind
-        expr = re.sub('mod', '%', expr)          # no \b here
-        expr = re.sub('\bdiv\b', '/', expr)
-        expr = re.sub('\bround\b', '|ROUND|', expr)
-        return str(eval(expr))
-    except:
+        return evaluateExpr(expr)
+    except ExprError:
         return '<span class="error">%s</span>' % expr
 
 
+def sharp_ifexpr(extr, expr, valueIfTrue='', valueIfFalse='', *args):
+    # The first argument has been evaluated in expandTemplate().
+    try:
+        true = evaluateCondition(expr)
+    except ExprError:
+        return '<span class="error">%s</span>' % expr
+    if true:
+        return extr.expand(valueIfTrue.strip())
+    return extr.expand(valueIfFalse.strip())
+
+
 def sharp_if(extr, testValue, valueIfTrue, valueIfFalse=None, *args):
     # In theory, we should evaluate the first argument here,
     # but it was evaluated while evaluating part[0] in expandTemplate().
@@ -71,6 +80,15 @@ def sharp_switch(extr, primary, *params):
     # }}
 
     primary = primary.strip()
+    if extr.frame.depth < extr.maxTemplateRecursionLevels:
+        # where labels expand to themselves, use an index
+        index = switch_index(params)
+        if index is not None:
+            cases, default = index
+            case = cases.get(primary, default)
+            if case is None:
+                return ''
+            return extr.expand(params[case].split('=', 1)[1].strip())
     found = False  # for fall through cases
     default = None
     rvalue = None
@@ -103,6 +121,37 @@ def sharp_switch(extr, primary, *params):
     return ''
 
 
+@lru_cache(maxsize=4096)
+def switch_index(params):
+    """
+    Indexes the cases of a #switch whose labels contain no templates.
+    :param params: the cases, unexpanded.
+    :return: a pair (dict from label to the position of the case with the
+    value for it, position of the #default case or None), or None if some
+    label must be expanded.
+    """
+    cases = {}
+    default = None
+    pending = []                # labels falling through to the next value
+    for i, param in enumerate(params):
+        pair = param.split('=', 1)
+        lvalue = pair[0].strip()
+        if '{' in lvalue:
+            return None
+        if len(pair) > 1:
+            # the first case for a label wins
+            for label in pending:
+                cases.setdefault(label, i)
+            pending = []
+            for label in lvalue.split('|'):
+                cases.setdefault(label.strip(), i)
+            if lvalue == '#default':
+                default = i
+        else:
+            pending.append(lvalue)
+    return cases, default
+
+
 # Extension Scribunto: https://www.mediawiki.org/wiki/Extension:Scribunto
 def sharp_invoke(module, function, args):
     functions = modules.get(module)
@@ -122,7 +171,7 @@ parserFunctions = {
 
     '#iferror': sharp_iferror,
 
-    '#ifexpr': lambda *args: '',  # not supported
+    '#ifexpr': sharp_ifexpr,
 
     '#ifexist': lambda extr, title, ifex, ifnex: extr.expand(ifnex), # assuming title is not present
 
@@ -0,0 +1,180 @@
+"""
+Readers of XML dumps working on large blocks of bytes.
+
+In a dump each <page> tag starts a line, and page text is XML escaped, so
+page boundaries can be found without parsing.
+"""
+
+import os.path
+import re
+
+# Largest byte range read at once by a worker
+range_size = 16 * 1024 * 1024
+
+
+def byte_ranges(input_file, count, max_size=range_size):
+    """
+    Splits a file in :param count: ranges of about the same size, or in more
+    ranges if needed so that none is larger than :param max_size: bytes.
+    :return: a list of pairs (start, end).
+    """
+    size = os.path.getsize(input_file)
+    count = max(1, min(max(count, -(-size // max_size)), size))
+    bounds = [size * i // count for i in range(count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_range(file, start, end):
+    """
+    Reads the pages whose <page> line starts between :param start: and
+    :param end:, the last one possibly extending past end.
+    A page that starts before start belongs to the previous range.
+    :param file: the dump, open in binary mode.
+    :return: the text of the pages.
+    """
+    if start:
+        # skip the line in progress, it belongs to the previous range
+        file.seek(start - 1)
+        file.readline()
+    else:
+        file.seek(0)
+    begin = file.tell()
+    if begin >= end:
+        return ''
+    data = file.read(end - begin)
+    if not data.endswith(b'\n'):
+        data += file.readline()  # complete the last line
+    first = data.find(b'<page>')
+    if first < 0:
+        return ''
+    # resync on the line of the first page
+    data = data[data.rfind(b'\n', 0, first) + 1:]
+    if data.rfind(b'<page>') > data.rfind(b'</page>'):
+        # complete the last page
+        tail = [data]
+        for line in file:
+            tail.append(line)
+            if b'</page>' in line:
+                break
+        data = b''.join(tail)
+    return data.decode('utf-8')
+
+
+# ----------------------------------------------------------------------
+# Chunked page scanner
+
+chunk_size = 1024 * 1024
+
+titleRE = re.compile(r'<title>([^<]*)</title>')
+nsRE = re.compile(r'<ns>([^<]*)</ns>')
+idRE = re.compile(r'<id>([^<]*)</id>')
+textRE = re.compile(r'<text\b[^>]*?(/?)>')
+
+
+def page_spans(input, size=chunk_size):
+    """
+    Scans input in chunks of :param size: bytes.
+    :param input: a file open in binary mode.
+    :return: an iterator of the bytes of each <page>...</page> element.
+    """
+    buf = b''
+    scan = 0                    # where to look for </page> in buf
+    while True:
+        chunk = input.read(size)
+        if not chunk:
+            return
+        buf += chunk
+        cur = 0
+        while True:
+            start = buf.find(b'<page>', cur)
+            if start < 0:
+                # keep what might be the start of a split <page>
+                cur = max(cur, len(buf) - 5)
+                break
+            end = buf.find(b'</page>', max(start, scan))
+            if end < 0:
+                cur = start
+                scan = max(start, len(buf) - 6)
+                break
+            end += 7
+            yield buf[start:end]
+            cur = end
+        scan -= cur
+        buf = buf[cur:]
+
+
+def page_blocks(input, size=chunk_size):
+    """
+    Reads input in chunks of :param size: bytes, cut after the last </page>
+    in them, so that each holds whole pages.
+    :param input: a file open in binary mode.
+    :return: an iterator of blocks of bytes, the first one including the
+    header before the first page.
+    """
+    buf = b''
+    while True:
+        chunk = input.read(size)
+        if not chunk:
+            return
+        buf += chunk
+        # only the new bytes, and a </page> straddling them, need a look
+        end = buf.rfind(b'</page>', max(0, len(buf) - len(chunk) - 6))
+        if end < 0:
+            continue
+        end += 7
+        yield buf[:end]
+        buf = buf[end:]
+
+
+def split_lines(text):
+    """Splits :param text: at newlines only, as when reading a file."""
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def parse_page(data):
+    """
+    Parses the bytes of a <page> element.
+    :return: (id, revid, title, namespace key, page, redirect), page is a
+    list of lines.
+    """
+    data = data.decode('utf-8')
+    revision = data.find('<revision>')
+    if revision < 0:
+        revision = len(data)
+    m = titleRE.search(data, 0, revision)
+    title = m.group(1) if m else None
+    m = nsRE.search(data, 0, revision)
+    ns = m.group(1) if m else '0'
+    m = idRE.search(data, 0, revision)
+    id = m.group(1) if m else None
+    redirect = data.find('<redirect', 0, revision) >= 0
+    m = idRE.search(data, revision)
+    revid = m.group(1) if m else None
+    page = []
+    m = textRE.search(data, revision)
+    if m and not m.group(1):    # not self closing <text />
+        end = data.find('</text>', m.end())
+        if end < 0:
+            end = len(data)
+        page = split_lines(data[m.end():end])
+    return id, revid, title, ns, page, redirect
+
+
+def pages_from_chunks(input, size=chunk_size):
+    """
+    Scans input extracting pages, like pages_from() but reading blocks of
+    :param size: bytes rather than lines.
+    :param input: a file open in binary mode.
+    :return: (id, revid, title, namespace key, page), page is a list of lines.
+    """
+    last_id = None
+    for data in page_spans(input, size):
+        id, revid, title, ns, page, redirect = parse_page(data)
+        if id != last_id and not redirect:
+            yield id, revid, title, ns, page
+            last_id = id
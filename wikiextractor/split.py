@@ -1,8 +1,9 @@
 import wikiextractor.brace as braceutils
 
-def splitParts(paramsList):
+def splitParts(paramsList, tokens=None):
     """
     :param paramsList: the parts of a template or tplarg.
+    :param tokens: the BraceTokens of :param paramsList:, if already computed.
 
     Split template parameters at the separator "|".
     separator "=".
@@ -41,7 +42,7 @@ def splitParts(paramsList):
     parameters = []
     cur = 0
 
-    for s, e in braceutils.findMatchingBraces(paramsList):
+    for s, e in braceutils.findMatchingBraces(paramsList, 0, tokens):
         par = paramsList[cur:s].split(sep)
         if par:
             if parameters:
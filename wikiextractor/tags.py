@@ -0,0 +1,81 @@
+"""
+Single pass scanner for the tags that Extractor.clean() drops.
+
+Comments, self-closing tags, ignored tags and the tags of discarded
+elements are matched by a single regular expression, compiled once per
+configuration, and classified as they are found, so that a page is scanned
+once, whatever the number of tags configured.
+"""
+
+import re
+from functools import lru_cache
+
+
+@lru_cache(maxsize=16)
+def tagScanner(selfClosing, ignored, discarded, escaped=False):
+    """
+    Compiles the pattern matching at once all the tags to drop.
+    :param selfClosing: tuple of the names of self-closing tags.
+    :param ignored: tuple of the patterns of the tags to ignore, as in
+    options.ignored_tag_patterns. They are matched ignoring case, and with
+    '.' matching newlines.
+    :param discarded: tuple of the names of the elements to discard.
+    :param escaped: whether to match comments and the tags of discarded
+    elements as in a dump, with &lt; and &gt; for < and >.
+    :return: the compiled pattern. Group 'drop' matches comments,
+    self-closing and ignored tags; groups 'open' and 'close' the name in
+    the opening and closing tags of discarded elements.
+    """
+    if escaped:
+        lt, gt, attrs = '&lt;', '&gt;', '(?:(?!&gt;)[^/])*'
+    else:
+        lt, gt, attrs = '<', '>', '[^>/]*'
+    drop = [lt + '!--.*?--' + gt]
+    if selfClosing:
+        drop.append(r'<\s*(?:%s)\b[^>]*/\s*>' % '|'.join(selfClosing))
+    drop.extend(ignored)
+    pattern = '(?P<drop>%s)' % '|'.join(drop)
+    if discarded:
+        tags = '|'.join(discarded)
+        pattern += r'|%s\s*(?P<open>%s)\b%s%s|%s\s*/\s*(?P<close>%s)%s' % (
+            lt, tags, attrs, gt, lt, tags, gt)
+    return re.compile(pattern, re.IGNORECASE | re.DOTALL)
+
+
+def tagSpans(text, scanner):
+    """
+    Finds the spans to drop from :param text:: comments, self-closing and
+    ignored tags, and discarded elements with their content. Each discarded
+    element is matched with the closing tag of the same name, counting
+    nesting. One left unclosed extends to the last closing tag found, and
+    closing tags without opening ones are kept.
+    :param scanner: a pattern from tagScanner().
+    :return: the list of spans, possibly nested or overlapping, as for
+    dropSpans().
+    """
+    spans = []
+    elements = {}               # name -> [start, depth, end of last closing]
+    for m in scanner.finditer(text):
+        if m.group('drop') is not None:
+            spans.append(m.span())
+            continue
+        name = m.group('open')
+        if name is not None:
+            element = elements.get(name.lower())
+            if element is None or not element[1]:
+                elements[name.lower()] = [m.start(), 1, None]
+            else:
+                element[1] += 1
+            continue
+        element = elements.get(m.group('close').lower())
+        if element is None or not element[1]:
+            continue            # stray closing tag
+        element[1] -= 1
+        element[2] = m.end()
+        if not element[1]:
+            spans.append((element[0], element[2]))
+    # unclosed elements
+    for start, depth, end in elements.values():
+        if depth and end is not None:
+            spans.append((start, end))
+    return spans
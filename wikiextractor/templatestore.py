@@ -0,0 +1,195 @@
+"""
+Binary store of template definitions.
+
+Collecting templates means scanning a whole dump, and even reloading them
+from a --templates file means parsing XML and cleaning every body again.
+A store instead keeps the result of define_template(): the cleaned bodies
+and the redirects, resolved to their final targets, keyed by title,
+optionally with the parsed Templates, pickled in a single file that loads
+in one go.
+
+A store records the format version it was written with and a fingerprint of
+the dump it comes from, so that a store that does not match is rejected
+rather than silently used.
+
+For extraction, templates and redirects are moved into TemplateTables: files
+mapped in memory, whose pages all the extraction processes share, instead of
+each holding a copy of the dicts.
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import struct
+from bisect import bisect_left
+from collections.abc import Mapping
+
+# bump whenever the content of a store changes meaning
+format_version = 2
+
+# bytes hashed at each end of the dump
+fingerprint_size = 1024 * 1024
+
+
+def dump_fingerprint(input_file):
+    """
+    Identifies a dump by its size and the hash of its first and last bytes,
+    which hold the siteinfo and the last pages.
+    :return: a string, or None for stdin.
+    """
+    if input_file == '-':
+        return None
+    size = os.path.getsize(input_file)
+    digest = hashlib.sha1(str(size).encode('ascii'))
+    with open(input_file, 'rb') as file:
+        digest.update(file.read(fingerprint_size))
+        file.seek(max(0, size - fingerprint_size))
+        digest.update(file.read(fingerprint_size))
+    return digest.hexdigest()
+
+
+def save_store(path, fingerprint, templates, redirects, namespaces, parsed=None):
+    """
+    Writes a template store.
+    :param fingerprint: of the dump, as from dump_fingerprint().
+    :param templates: dict from title to cleaned body.
+    :param redirects: dict from title to the final title of its redirects.
+    :param namespaces: pair (template namespace, module namespace).
+    :param parsed: optional dict from title to parsed Template.
+    """
+    store = {
+        'version': format_version,
+        'fingerprint': fingerprint,
+        'namespaces': namespaces,
+        'templates': templates,
+        'redirects': redirects,
+        'parsed': parsed or {},
+    }
+    # write aside, so that an interrupted run does not leave a broken store
+    temp = path + '.tmp'
+    with open(temp, 'wb') as file:
+        pickle.dump(store, file, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, path)
+
+
+def load_store(path, fingerprint):
+    """
+    Reads a template store.
+    :param fingerprint: of the dump being extracted, None to skip the check.
+    :return: dict with keys 'namespaces', 'templates', 'redirects' and
+    'parsed', as given to save_store(), or None if the store is stale.
+    """
+    try:
+        with open(path, 'rb') as file:
+            store = pickle.load(file)
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+        logging.warning("Cannot read template store '%s': %s", path, e)
+        return None
+    if not isinstance(store, dict) or store.get('version') != format_version:
+        logging.warning("Template store '%s' has an obsolete format", path)
+        return None
+    if fingerprint and store['fingerprint'] != fingerprint:
+        logging.warning("Template store '%s' was built from another dump", path)
+        return None
+    return store
+
+
+# ----------------------------------------------------------------------
+# Table layout:
+#   header: magic, version, count
+#   hashes: count sorted 64 bit key hashes
+#   offsets: count 64 bit positions of the records, in the order of hashes
+# both arrays in native byte order, to be read in place through memoryview
+#   records: key length, value length, key, value, both UTF-8 encoded
+
+table_magic = b'WXTT'
+table_header = struct.Struct('<4sIQ')
+table_record = struct.Struct('<II')
+
+
+def key_hash(key):
+    """
+    :param key: bytes.
+    :return: a 64 bit hash, stable across processes unlike hash().
+    """
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def write_table(path, mapping):
+    """
+    Writes :param mapping: from str to str as a table for TemplateTable.
+    """
+    items = sorted((key_hash(key), key, value) for key, value in
+                   ((k.encode('utf-8'), v.encode('utf-8')) for k, v in mapping.items()))
+    count = len(items)
+    with open(path, 'wb') as file:
+        file.write(table_header.pack(table_magic, format_version, count))
+        offset = table_header.size + 16 * count
+        offsets = []
+        for _, key, value in items:
+            offsets.append(offset)
+            offset += table_record.size + len(key) + len(value)
+        file.write(struct.pack('=%dQ' % count, *(h for h, _, _ in items)))
+        file.write(struct.pack('=%dQ' % count, *offsets))
+        for _, key, value in items:
+            file.write(table_record.pack(len(key), len(value)))
+            file.write(key)
+            file.write(value)
+
+
+class TemplateTable(Mapping):
+    """
+    Read-only mapping from str to str, stored in a file mapped in memory.
+    Keys are found by bisection on their hashes, so nothing is loaded: the
+    pages of the file are shared by all processes that use the table.
+    It is pickled as its path, so that processes just map it again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = table_header.unpack_from(self.map)
+        if magic != table_magic or version != format_version:
+            raise ValueError("not a template table: %s" % path)
+        self.count = count
+        view = memoryview(self.map)
+        start = table_header.size
+        self.hashes = view[start:start + 8 * count].cast('Q')
+        self.offsets = view[start + 8 * count:start + 16 * count].cast('Q')
+
+    def __reduce__(self):
+        return TemplateTable, (self.path,)
+
+    def _record(self, i):
+        """:return: the key of the i-th record and the slice of its value."""
+        offset = self.offsets[i]
+        key_len, value_len = table_record.unpack_from(self.map, offset)
+        offset += table_record.size
+        return (self.map[offset:offset + key_len],
+                slice(offset + key_len, offset + key_len + value_len))
+
+    def __getitem__(self, key):
+        key = key.encode('utf-8')
+        h = key_hash(key)
+        i = bisect_left(self.hashes, h)
+        while i < self.count and self.hashes[i] == h:
+            k, value = self._record(i)
+            if k == key:
+                return self.map[value].decode('utf-8')
+            i += 1
+        raise KeyError(key.decode('utf-8'))
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._record(i)[0].decode('utf-8')
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.hashes.release()
+        self.offsets.release()
+        self.map.close()
@@ -132,6 +132,37 @@ def compact(text):
                 page.append(line)
     return page
 
+tagRE = re.compile(r'(.*?)<(/?\w+)[^>]*?>(?:([^<]*)(<.*?>)?)?')
+keyRE = re.compile(r'key="(\d*)"')
+
+def collect_siteinfo(input):
+    """
+    Scans the <siteinfo> header of a dump, setting urlbase and namespaces
+    in options.
+    :param input: the lines of the dump.
+    """
+    for line in input:
+        m = tagRE.search(line)
+        if not m:
+            continue
+        tag = m.group(2)
+        if tag == 'base':
+            # /mediawiki/siteinfo/base
+            base = m.group(3)
+            options.urlbase = base[:base.rfind("/")]
+        elif tag == 'namespace':
+            mk = keyRE.search(line)
+            nsid = mk.group(1) if mk else ''
+            options.knownNamespaces[m.group(3)] = nsid
+            if nsid == '10':
+                options.templateNamespace = m.group(3)
+                options.templatePrefix = options.templateNamespace + ':'
+            elif nsid == '828':
+                options.moduleNamespace = m.group(3)
+                options.modulePrefix = options.moduleNamespace + ':'
+        elif tag == '/siteinfo':
+            break
+
 def get_url(uid):
     return "%s?curid=%s" % (options.urlbase, uid)
 
@@ -140,15 +171,15 @@ def dropSpans(spans, text):
     Drop from text the blocks identified in :param spans:, possibly nested.
     """
     spans.sort()
-    res = ''
+    res = []
     offset = 0
     for s, e in spans:
         if offset <= s:         # handle nesting
             if offset < s:
-                res += text[offset:s]
+                res.append(text[offset:s])
             offset = e
-    res += text[offset:]
-    return res
+    res.append(text[offset:])
+    return ''.join(res)
 
 def dropNested(text, openDelim, closeDelim):
     """
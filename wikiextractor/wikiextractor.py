@@ -62,12 +62,30 @@ import fileinput
 import logging
 import os.path
 import re  # TODO use regex when it will be standard
+import shutil
+import tempfile
 import time
 import json
-from io import StringIO
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import lru_cache
+from io import BytesIO, StringIO
 from multiprocessing import Queue, Process, Value, cpu_count
+from queue import Empty
 from timeit import default_timer
 
+from wikiextractor.multistream import (
+    locate_prefixes, read_header, read_stream, stream_offsets, stream_spans
+)
+from wikiextractor.brace import BraceTokens, findMatchingBraces
+from wikiextractor.expr import ExprError, expr as evaluateExpr, ifexpr as evaluateCondition
+from wikiextractor.parser import switch_index
+from wikiextractor.tags import tagScanner, tagSpans
+from wikiextractor.templatestore import (TemplateTable, dump_fingerprint, load_store,
+                                         save_store, write_table)
+from wikiextractor.reader import (byte_ranges, page_blocks, pages_from_chunks,
+                                   read_range)
+
 
 PY2 = sys.version_info[0] == 2
 # Python 2.7 compatibiity
@@ -109,6 +127,8 @@ options = SimpleNamespace(
     # Defined in <siteinfo>
     # We include as default Template, when loading external template file.
     knownNamespaces = {'Template': 10},
+    # their names by case folded name, from indexNamespaces()
+    namespaceNames = {'template': 'Template'},
 
     ##
     # The namespace used for template definitions
@@ -176,12 +196,31 @@ options = SimpleNamespace(
     # Minimum expanded text length required to print document
     min_text_length = 0,
 
+    ##
+    # Budget of template expansion for each page: number of expansions,
+    # characters produced by them and seconds, 0 for no limit
+    max_expansions = 100000,
+    max_expanded_chars = 50 * 1024 * 1024,
+    max_expansion_time = 60,
+
     # Shared objects holding templates, redirects and cache
     templates = {},
     redirects = {},
     # cache of parser templates
     # FIXME: sharing this with a Manager slows down.
     templateCache = {},
+    # cache of template expansions, an ExpansionCache, one in each process
+    expansionCache = None,
+    # templates to skip or stub instead of expanding them, a TemplateStubs
+    templateStubs = None,
+    # expansions of the templates which do not depend on page or
+    # parameters, by title, from foldTemplates()
+    foldedTemplates = {},
+    # cache of whether templates may emit some markup, by title and markup
+    markupCache = {},
+    # cache of templates whose output is always discarded, by title and
+    # markup: their shells, as from discardedShell(), or None
+    discardedTemplates = {},
 
     # Elements to ignore/discard
 
@@ -263,6 +302,12 @@ selfClosingTags = ('br', 'hr', 'nobr', 'ref', 'references', 'nowiki')
 placeholder_tags = {'math': 'formula', 'code': 'codice'}
 
 
+# Distinct titles are few compared to their uses: normalizeTitle() and
+# fullyQualifiedTemplateTitle() memoize them, until namespaces change.
+titleCacheSize = 100000
+
+
+@lru_cache(maxsize=titleCacheSize)
 def normalizeTitle(title):
     """Normalize title"""
     # remove leading/trailing whitespace and underscores
@@ -311,21 +356,36 @@ def unescape(text):
 
     def fixup(m):
         text = m.group(0)
-        code = m.group(1)
-        try:
-            if text[1] == "#":  # character reference
-                if text[2] == "x":
-                    return chr(int(code[1:], 16))
-                else:
-                    return chr(int(code))
-            else:  # named entity
-                return chr(name2codepoint[code])
-        except:
-            return text  # leave as is
+        return entities.get(text) or fixupEntity(text, m.group(1))
 
     return re.sub("&#?(\w+);", fixup, text)
 
 
+# cache of the characters of the entities found, few distinct ones recurring
+entities = {}
+
+
+def fixupEntity(text, code):
+    """
+    :param text: a character reference or an entity, like &#62; or &gt;.
+    :param code: its number or name.
+    :return: the character it stands for, or :param text: if none.
+    """
+    try:
+        if text[1] == "#":  # character reference
+            if text[2] == "x":
+                char = chr(int(code[1:], 16))
+            else:
+                char = chr(int(code))
+        else:  # named entity
+            char = chr(name2codepoint[code])
+    except:
+        char = text  # leave as is
+    if len(entities) < 4096:
+        entities[text] = char
+    return char
+
+
 # Match HTML comments
 # The buggy template {{Template:T}} has a comment terminating with just "->"
 comment = re.compile(r'<!--.*?-->', re.DOTALL)
@@ -340,11 +400,6 @@ def ignoreTag(tag):
     right = re.compile(r'</\s*%s>' % tag, re.IGNORECASE)
     options.ignored_tag_patterns.append((left, right))
 
-# Match selfClosing HTML tags
-selfClosing_tag_patterns = [
-    re.compile(r'<\s*%s\b[^>]*/\s*>' % tag, re.DOTALL | re.IGNORECASE) for tag in selfClosingTags
-    ]
-
 # Match HTML placeholder tags
 placeholder_tag_patterns = [
     (re.compile(r'<\s*%s(\s*| [^>]+?)>.*?<\s*/\s*%s\s*>' % (tag, tag), re.DOTALL | re.IGNORECASE),
@@ -371,6 +426,17 @@ spaces = re.compile(r' {2,}')
 # Matches dots
 dots = re.compile(r'\.{4,}')
 
+# Matches spaces before closing and after opening punctuation
+spaceBeforePunct = re.compile(' (,:\.\)\]»)')
+spaceAfterPunct = re.compile('(\[\(«) ')
+
+# Matches lines with only punctuations
+punctLine = re.compile(r'\n\W+?\n', re.U)
+
+# Matches width styles of table headers, kept with --keep_tables
+tableHeaderStyle = re.compile(r'!(?:\s)?style=\"[a-z]+:(?:\d+)%;\"')
+tableHeaderColorStyle = re.compile(r'!(?:\s)?style="[a-z]+:(?:\d+)%;[a-z]+:(?:#)?(?:[0-9a-z]+)?"')
+
 
 # ======================================================================
 
@@ -380,6 +446,9 @@ class Template(list):
     A Template is a list of TemplateText or TemplateArgs
     """
 
+    # substitution plan, built by compile() on first use
+    plan = None
+
     @classmethod
     def parse(cls, body):
         tpl = Template()
@@ -418,8 +487,68 @@ class Template(list):
             extractor.recursion_exceeded_3_errs += 1
             return ''
 
+        # The plan assumes that names and defaults without braces transform
+        # to themselves, which does not hold close to the recursion limits.
+        if (depth < extractor.maxParameterRecursionLevels and
+            extractor.frame.depth < extractor.maxTemplateRecursionLevels):
+            return self.substPlan(params, extractor, depth)
+        return self.substParts(params, extractor, depth)
+
+    def substParts(self, params, extractor, depth):
+        """Substitutes each part in turn."""
         return ''.join([tpl.subst(params, extractor, depth) for tpl in self])
 
+    def compile(self):
+        """
+        Builds the substitution plan: a list of strings, for fixed text, and
+        of triples (name, default, arg) for TemplateArgs, where name is the
+        parameter name, or None if it must be computed, and default is
+        the default value, or None if absent or to be computed.
+        """
+        plan = []
+        for part in self:
+            if isinstance(part, TemplateText):
+                if part:
+                    plan.append(text_type(part))
+            else:
+                plan.append((part.name.constant(), part.default and part.default.constant(),
+                             part))
+        return plan
+
+    def constant(self):
+        """
+        :return: the text of the template, if it is just text without
+        templates, which is left unchanged by Extractor.transform(),
+        otherwise None.
+        """
+        if len(self) == 1 and '{' not in self[0]:
+            return text_type(self[0])
+        return None
+
+    def substPlan(self, params, extractor, depth):
+        """Substitutes following the plan, compiling it on first use."""
+        plan = self.plan
+        if plan is None:
+            plan = self.plan = self.compile()
+        if len(plan) == 1 and type(plan[0]) is text_type:
+            return plan[0]      # no arguments
+        res = []
+        for step in plan:
+            if type(step) is text_type:
+                res.append(step)
+                continue
+            name, default, arg = step
+            if name is None:
+                res.append(arg.subst(params, extractor, depth))
+            elif name in params:
+                res.append(params[name])
+            elif default is not None:
+                res.append(default)
+            elif arg.default:
+                defaultValue = arg.default.subst(params, extractor, depth + 1)
+                res.append(extractor.transform(defaultValue))
+        return ''.join(res)
+
     def __str__(self):
         return ''.join([text_type(x) for x in self])
 
@@ -485,6 +614,119 @@ class TemplateArg(object):
         return res
 
 
+class ExpansionCache(object):
+    """
+    Bounded cache of the results of template invocations, evicting the least
+    recently used. Keys are the template title and the expanded parameters.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        if lookups:
+            logging.info("Expansion cache: %d hits out of %d lookups (%.1f%%)",
+                         self.hits, lookups, 100.0 * self.hits / lookups)
+
+
+# An entry of --skip-templates or --stub-templates: a title or a /regular
+# expression/, whose commas do not separate entries, then =stub if any.
+templateEntryRE = re.compile(r'\s*(/.+?/(?=\s*(?:[,=]|$))|[^,=]*)\s*(?:=([^,]*))?(?:,|$)')
+
+
+class TemplateStubs(object):
+    """
+    Templates to skip or to replace with a fixed stub instead of expanding
+    them, given by title or by a regular expression between slashes, which
+    matches titles with or without the template namespace. They are compiled
+    into a single pattern on first use, once the template namespace is known.
+    """
+
+    def __init__(self, skip=(), stub=()):
+        """
+        :param skip: titles or /regular expressions/ of the templates to skip.
+        :param stub: pairs of title or /regular expression/ of templates and
+        of the stub to replace them with.
+        :raise ValueError: for an invalid regular expression.
+        """
+        self.entries = [(name, '') for name in skip] + list(stub)
+        for name, _ in self.entries:
+            if self.isPattern(name):
+                try:
+                    re.compile(name[1:-1])
+                except re.error as e:
+                    raise ValueError('invalid regular expression %s: %s' % (name, e))
+        self.pattern = None
+        self.stubs = {}         # title -> stub or None
+
+    @staticmethod
+    def parse(text, stubs=False):
+        """
+        Parses the argument of --skip-templates, or of --stub-templates if
+        :param stubs:.
+        :return: the list of titles, or of pairs of title and stub.
+        :raise ValueError: for a stub missing or not expected.
+        """
+        entries = []
+        pos = 0
+        while pos < len(text):
+            m = templateEntryRE.match(text, pos)
+            pos = m.end()
+            name, stub = m.group(1).strip(), m.group(2)
+            if not name and stub is None:
+                continue
+            if not name or stubs != (stub is not None):
+                raise ValueError('invalid entry %s' % m.group().rstrip(','))
+            entries.append((name, stub) if stubs else name)
+        return entries
+
+    @staticmethod
+    def isPattern(name):
+        return len(name) > 2 and name.startswith('/') and name.endswith('/')
+
+    def get(self, title):
+        """
+        :param title: a fully qualified template title.
+        :return: the stub for template :param title:, '' to skip it, or None
+        to expand it.
+        """
+        if title in self.stubs:
+            return self.stubs[title]
+        if self.pattern is None:
+            self.pattern = self.compile()
+        m = self.pattern.fullmatch(title)
+        stub = self.stubs[title] = self.entries[int(m.lastgroup[1:])][1] if m else None
+        return stub
+
+    def compile(self):
+        alternatives = []
+        for i, (name, _) in enumerate(self.entries):
+            if self.isPattern(name):
+                expr = '(?:%s)?(?:%s)' % (re.escape(options.templatePrefix), name[1:-1])
+            else:
+                expr = re.escape(fullyQualifiedTemplateTitle(name.strip()))
+            alternatives.append('(?P<e%d>%s)' % (i, expr))
+        return re.compile('|'.join(alternatives))
+
+
 class Frame(object):
 
     def __init__(self, title='', args=[], prev=None):
@@ -535,6 +777,15 @@ class Extractor(object):
         self.recursion_exceeded_2_errs = 0  # template recursion within expandTemplate()
         self.recursion_exceeded_3_errs = 0  # parameter recursion
         self.template_title_errs = 0
+        self.budget_exceeded_errs = 0       # templates dropped over budget
+        # expansion budget spent
+        self.expansions = 0
+        self.expanded_chars = 0
+        self.start_time = default_timer()
+        # uses of page specific values, making an expansion uncacheable
+        self.page_lookups = 0
+        # expansions skipped, their output being discarded
+        self.discarded_templates = 0
 
     def write_output(self, out, text):
         """
@@ -623,6 +874,8 @@ class Extractor(object):
         # $dom = $this->preprocessToDom( $text, $flag );
         # $text = $frame->expand( $dom );
         #
+        if options.expand_templates:
+            text = pruneDiscarded(text)
         text = self.transform(text)
         text = self.wiki2text(text)
         text = compact(self.clean(text))
@@ -633,37 +886,60 @@ class Extractor(object):
 
         self.write_output(out, text)
 
-        errs = (self.template_title_errs,
-                self.recursion_exceeded_1_errs,
-                self.recursion_exceeded_2_errs,
-                self.recursion_exceeded_3_errs)
+        errs = self.errors()
         if any(errs):
-            logging.warn("Template errors in article '%s' (%s): title(%d) recursion(%d, %d, %d)",
+            logging.warn("Template errors in article '%s' (%s): title(%d) recursion(%d, %d, %d) budget(%d)",
                          self.title, self.id, *errs)
 
+    def errors(self):
+        """
+        :return: the counts of template errors.
+        """
+        return (self.template_title_errs,
+                self.recursion_exceeded_1_errs,
+                self.recursion_exceeded_2_errs,
+                self.recursion_exceeded_3_errs,
+                self.budget_exceeded_errs)
 
-    def transform(self, wikitext):
+    def overBudget(self):
+        """
+        :return: whether the page has used up its budget of expansion, after
+        which templates are dropped.
+        """
+        return ((options.max_expansions and
+                 self.expansions >= options.max_expansions) or
+                (options.max_expanded_chars and
+                 self.expanded_chars >= options.max_expanded_chars) or
+                (options.max_expansion_time and
+                 default_timer() - self.start_time >= options.max_expansion_time))
+
+    def transform(self, wikitext, tokens=None):
         """
         Transforms wiki markup.
         @see https://www.mediawiki.org/wiki/Help:Formatting
+        :param tokens: the BraceTokens of :param wikitext:, if already computed.
         """
         # look for matching <nowiki>...</nowiki>
-        res = ''
+        res = []
         cur = 0
         for m in nowiki.finditer(wikitext, cur):
-            res += self.transform1(wikitext[cur:m.start()]) + wikitext[m.start():m.end()]
+            res.append(self.transform1(wikitext[cur:m.start()],
+                                       tokens and tokens.slice(cur, m.start())))
+            res.append(m.group())
             cur = m.end()
         # leftover
-        res += self.transform1(wikitext[cur:])
-        return res
+        if cur and tokens:
+            tokens = tokens.slice(cur, len(wikitext))
+        res.append(self.transform1(wikitext[cur:], tokens))
+        return ''.join(res)
 
 
-    def transform1(self, text):
+    def transform1(self, text, tokens=None):
         """Transform text not containing <nowiki>"""
         if options.expand_templates:
             # expand templates
             # See: http://www.mediawiki.org/wiki/Help:Templates
-            return self.expand(text)
+            return self.expand(text, tokens)
         else:
             # Drop transclusions (template, parser functions)
             return dropNested(text, r'{{', r'}}')
@@ -716,13 +992,7 @@ class Extractor(object):
         # ############### Process HTML ###############
 
         # turn into HTML, except for the content of <syntaxhighlight>
-        res = ''
-        cur = 0
-        for m in syntaxhighlight.finditer(text):
-            res += unescape(text[cur:m.start()]) + m.group(1)
-            cur = m.end()
-        text = res + unescape(text[cur:])
-        return text
+        return unescapeExceptCode(text)
 
 
     def clean(self, text):
@@ -730,30 +1000,13 @@ class Extractor(object):
         Removes irrelevant parts from :param: text.
         """
 
-        # Collect spans
-        spans = []
-        # Drop HTML comments
-        for m in comment.finditer(text):
-            spans.append((m.start(), m.end()))
-
-        # Drop self-closing tags
-        for pattern in selfClosing_tag_patterns:
-            for m in pattern.finditer(text):
-                spans.append((m.start(), m.end()))
-
-        # Drop ignored tags
-        for left, right in options.ignored_tag_patterns:
-            for m in left.finditer(text):
-                spans.append((m.start(), m.end()))
-            for m in right.finditer(text):
-                spans.append((m.start(), m.end()))
-
-        # Bulk remove all spans
-        text = dropSpans(spans, text)
-
-        # Drop discarded elements
-        for tag in options.discardElements:
-            text = dropNested(text, r'<\s*%s\b[^>/]*>' % tag, r'<\s*/\s*%s>' % tag)
+        # Drop HTML comments, self-closing tags, ignored tags and
+        # discarded elements, all found in a single scan
+        scanner = tagScanner(selfClosingTags,
+                             tuple(pattern.pattern for pair in options.ignored_tag_patterns
+                                   for pattern in pair),
+                             tuple(options.discardElements))
+        text = dropSpans(tagSpans(text, scanner), text)
 
         if not options.toHTML:
             # Turn into text what is left (&amp;nbsp;) and <syntaxhighlight>
@@ -774,16 +1027,16 @@ class Extractor(object):
         text = text.replace('\t', ' ')
         text = spaces.sub(' ', text)
         text = dots.sub('...', text)
-        text = re.sub(' (,:\.\)\]»)', r'\1', text)
-        text = re.sub('(\[\(«) ', r'\1', text)
-        text = re.sub(r'\n\W+?\n', '\n', text, flags=re.U)  # lines with only punctuations
+        text = spaceBeforePunct.sub(r'\1', text)
+        text = spaceAfterPunct.sub(r'\1', text)
+        text = punctLine.sub('\n', text)  # lines with only punctuations
         text = text.replace(',,', ',').replace(',.', '.')
         if options.keep_tables:
             # the following regular expressions are used to remove the wikiml chartacters around table strucutures
             # yet keep the content. The order here is imporant so we remove certain markup like {| and then
             # then the future html attributes such as 'style'. Finally we drop the remaining '|-' that delimits cells.
-            text = re.sub(r'!(?:\s)?style=\"[a-z]+:(?:\d+)%;\"', r'', text)
-            text = re.sub(r'!(?:\s)?style="[a-z]+:(?:\d+)%;[a-z]+:(?:#)?(?:[0-9a-z]+)?"', r'', text)
+            text = tableHeaderStyle.sub(r'', text)
+            text = tableHeaderColorStyle.sub(r'', text)
             text = text.replace('|-', '')
             text = text.replace('|', '')
         if options.toHTML:
@@ -801,9 +1054,10 @@ class Extractor(object):
     reOpen = re.compile('(?<!{){{(?!{)', re.DOTALL)
 
 
-    def expand(self, wikitext):
+    def expand(self, wikitext, tokens=None):
         """
         :param wikitext: the text to be expanded.
+        :param tokens: the BraceTokens of :param wikitext:, if already computed.
 
         Templates are frequently nested. Occasionally, parsing mistakes may
         cause template insertion to enter an infinite loop, for instance when
@@ -824,22 +1078,30 @@ class Extractor(object):
         # https://en.wikipedia.org/wiki/Special:ExpandTemplates
         # https://it.wikipedia.org/wiki/Speciale:EspandiTemplate
 
-        res = ''
         if self.frame.depth >= self.maxTemplateRecursionLevels:
             self.recursion_exceeded_1_errs += 1
-            return res
+            return ''
 
         # logging.debug('%*s<expand', self.frame.depth, '')
 
+        if '{{' not in wikitext:
+            return wikitext
+
+        # the braces of the text serve for those of all its templates
+        if tokens is None:
+            tokens = BraceTokens(wikitext)
+        res = []
         cur = 0
         # look for matching {{...}}
-        for s, e in findMatchingBraces(wikitext, 2):
-            res += wikitext[cur:s] + self.expandTemplate(wikitext[s + 2:e - 2])
+        for s, e in findMatchingBraces(wikitext, 2, tokens):
+            res.append(wikitext[cur:s])
+            res.append(self.expandTemplate(wikitext[s + 2:e - 2],
+                                           tokens.slice(s + 2, e - 2)))
             cur = e
         # leftover
-        res += wikitext[cur:]
+        res.append(wikitext[cur:])
         # logging.debug('%*sexpand> %s', self.frame.depth, '', res)
-        return res
+        return ''.join(res)
 
 
     def templateParams(self, parameters):
@@ -911,9 +1173,10 @@ class Extractor(object):
         return templateParams
 
 
-    def expandTemplate(self, body):
+    def expandTemplate(self, body, tokens=None):
         """Expands template invocation.
         :param body: the parts of a template.
+        :param tokens: the BraceTokens of :param body:, if already computed.
 
         :see http://meta.wikimedia.org/wiki/Help:Expansion for an explanation
         of the process.
@@ -961,11 +1224,28 @@ class Extractor(object):
             # logging.debug('%*sEXPAND> %s', self.frame.depth, '', body)
             return ''
 
+        # A page with many templates may take very long, even within the
+        # depth limit: drop what remains past its budget.
+        if self.overBudget():
+            self.budget_exceeded_errs += 1
+            return ''
+        self.expansions += 1
+
         logging.debug('%*sEXPAND %s', self.frame.depth, '', body)
-        parts = splitParts(body)
+        if '|' in body or '{' in body:
+            if tokens is None:
+                tokens = BraceTokens(body)
+            spans = partSpans(body, tokens)
+            parts = [body[s:e] for s, e in spans]
+        else:
+            # just a title, as for most folded templates
+            spans = [(0, len(body))]
+            parts = [body]
         # title is the portion before the first |
         title = parts[0].strip()
-        title = self.expand(title)
+        if '{{' in title:
+            start = len(parts[0]) - len(parts[0].lstrip())
+            title = self.expand(title, tokens.slice(start, start + len(title)))
 
         # SUBST
         # Apply the template tag to parameters without
@@ -978,6 +1258,8 @@ class Extractor(object):
             subst = True
 
         if title in self.magicWords.values:
+            if title != '!':
+                self.page_lookups += 1
             ret = self.magicWords[title]
             logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, ret)
             return ret
@@ -1010,9 +1292,27 @@ class Extractor(object):
             return ''
 
         redirected = options.redirects.get(title)
+
+        # Templates unwanted in the text, skipped or stubbed without even
+        # evaluating their parameters.
+        stubs = options.templateStubs
+        if stubs is not None:
+            stub = stubs.get(title)
+            if stub is None and redirected:
+                stub = stubs.get(redirected)
+            if stub is not None:
+                logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, stub)
+                return stub
+
         if redirected:
             title = redirected
 
+        value = options.foldedTemplates.get(title)
+        if value is not None:
+            self.expanded_chars += len(value)
+            logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, value)
+            return value
+
         # get the template
         if title in options.templateCache:
             template = options.templateCache[title]
@@ -1020,7 +1320,8 @@ class Extractor(object):
             template = Template.parse(options.templates[title])
             # add it to cache
             options.templateCache[title] = template
-            del options.templates[title]
+            if isinstance(options.templates, dict):  # not a shared TemplateTable
+                del options.templates[title]
         else:
             # The page being included could not be identified
             logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, '')
@@ -1028,6 +1329,16 @@ class Extractor(object):
 
         logging.debug('%*sTEMPLATE %s: %s', self.frame.depth, '', title, template)
 
+        # Templates whose output is discarded anyway, like navboxes, are
+        # replaced by the markup that gets it discarded.
+        discarded = discardedShell(title)
+        if discarded is not None:
+            shell, marks = discarded
+            if argumentsCannotEmit(parts[1:], marks):
+                self.discarded_templates += 1
+                logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, shell)
+                return shell
+
         # tplarg          = "{{{" parts "}}}"
         # parts           = [ title *( "|" part ) ]
         # part            = ( part-name "=" part-value ) / ( part-value )
@@ -1065,11 +1376,25 @@ class Extractor(object):
             # Evaluate parameters, since they may contain templates, including
             # the symbol "=".
             # {{#ifexpr: {{{1}}} = 1 }}
-            params = [self.transform(p) for p in params]
+            params = [self.transform(p, tokens.slice(s, e) if '{{' in p else None)
+                      for p, (s, e) in zip(params, spans[1:])]
 
         # build a dict of name-values for the parameter values
         params = self.templateParams(params)
 
+        # The same invocation, not using page specific values, gives the
+        # same result.
+        cache = options.expansionCache
+        if cache is not None:
+            key = (title, frozenset(params.items()))
+            value = cache.get(key)
+            if value is not None:
+                self.expanded_chars += len(value)
+                logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, value)
+                return value
+            lookups = self.page_lookups
+            errors = self.errors()
+
         # Perform parameter substitution.
         # Extend frame before subst, since there may be recursion in default
         # parameter value, e.g. {{OTRS|celebrative|date=April 2015}} in article
@@ -1078,6 +1403,10 @@ class Extractor(object):
         instantiated = template.subst(params, self)
         value = self.transform(instantiated)
         self.frame = self.frame.pop()
+        self.expanded_chars += len(value)
+        # results cut short by recursion limits depend on the depth
+        if cache is not None and self.page_lookups == lookups and self.errors() == errors:
+            cache.put(key, value)
         logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, value)
         return value
 
@@ -1086,9 +1415,10 @@ class Extractor(object):
 # parameter handling
 
 
-def splitParts(paramsList):
+def splitParts(paramsList, tokens=None):
     """
     :param paramsList: the parts of a template or tplarg.
+    :param tokens: the BraceTokens of :param paramsList:, if already computed.
 
     Split template parameters at the separator "|".
     separator "=".
@@ -1123,150 +1453,46 @@ def splitParts(paramsList):
     # and tpl parameters like:
     #    ||[[Category:People|{{#if:A|A|{{PAGENAME}}}}]]
 
-    sep = '|'
-    parameters = []
-    cur = 0
+    return [paramsList[s:e] for s, e in partSpans(paramsList, tokens)]
 
-    for s, e in findMatchingBraces(paramsList):
-        par = paramsList[cur:s].split(sep)
-        if par:
-            if parameters:
-                # portion before | belongs to previous parameter
-                parameters[-1] += par[0]
-                if len(par) > 1:
-                    # rest are new parameters
-                    parameters.extend(par[1:])
-            else:
-                parameters = par
-        elif not parameters:
-            parameters = ['']  # create first param
-        # add span to last previous parameter
-        parameters[-1] += paramsList[s:e]
+
+def partSpans(paramsList, tokens=None):
+    """
+    :param tokens: the BraceTokens of :param paramsList:, if already computed.
+    :return: the list of the (start, end) offsets of the parts of
+    :param paramsList:, split as by splitParts().
+    """
+    spans = []
+    start = 0
+    cur = 0
+    for s, e in findMatchingBraces(paramsList, 0, tokens):
+        # separators before the span, which belongs to the last part
+        sep = paramsList.find('|', cur, s)
+        while sep >= 0:
+            spans.append((start, sep))
+            start = sep + 1
+            sep = paramsList.find('|', start, s)
         cur = e
     # leftover
-    par = paramsList[cur:].split(sep)
-    if par:
-        if parameters:
-            # portion before | belongs to previous parameter
-            parameters[-1] += par[0]
-            if len(par) > 1:
-                # rest are new parameters
-                parameters.extend(par[1:])
-        else:
-            parameters = par
-
-    # logging.debug('splitParts %s %s\nparams: %s', sep, paramsList, text_type(parameters))
-    return parameters
-
-
-def findMatchingBraces(text, ldelim=0):
-    """
-    :param ldelim: number of braces to match. 0 means match [[]], {{}} and {{{}}}.
-    """
-    # Parsing is done with respect to pairs of double braces {{..}} delimiting
-    # a template, and pairs of triple braces {{{..}}} delimiting a tplarg.
-    # If double opening braces are followed by triple closing braces or
-    # conversely, this is taken as delimiting a template, with one left-over
-    # brace outside it, taken as plain text. For any pattern of braces this
-    # defines a set of templates and tplargs such that any two are either
-    # separate or nested (not overlapping).
-
-    # Unmatched double rectangular closing brackets can be in a template or
-    # tplarg, but unmatched double rectangular opening brackets cannot.
-    # Unmatched double or triple closing braces inside a pair of
-    # double rectangular brackets are treated as plain text.
-    # Other formulation: in ambiguity between template or tplarg on one hand,
-    # and a link on the other hand, the structure with the rightmost opening
-    # takes precedence, even if this is the opening of a link without any
-    # closing, so not producing an actual link.
-
-    # In the case of more than three opening braces the last three are assumed
-    # to belong to a tplarg, unless there is no matching triple of closing
-    # braces, in which case the last two opening braces are are assumed to
-    # belong to a template.
-
-    # We must skip individual { like in:
-    #   {{#ifeq: {{padleft:|1|}} | { | | &nbsp;}}
-    # We must resolve ambiguities like this:
-    #   {{{{ }}}} -> { {{{ }}} }
-    #   {{{{{ }}}}} -> {{ {{{ }}} }}
-    #   {{#if:{{{{{#if:{{{nominee|}}}|nominee|candidate}}|}}}|...}}
-    #   {{{!}} {{!}}}
-
-    # Handle:
-    #   {{{{{|safesubst:}}}#Invoke:String|replace|{{{1|{{{{{|safesubst:}}}PAGENAME}}}}}|%s+%([^%(]-%)$||plain=false}}
-    # as well as expressions with stray }:
-    #   {{{link|{{ucfirst:{{{1}}}}}} interchange}}}
-
-    if ldelim:  # 2-3
-        reOpen = re.compile('[{]{%d,}' % ldelim)  # at least ldelim
-        reNext = re.compile('[{]{2,}|}{2,}')  # at least 2
-    else:
-        reOpen = re.compile('{{2,}|\[{2,}')
-        reNext = re.compile('{{2,}|}{2,}|\[{2,}|]{2,}')  # at least 2
+    sep = paramsList.find('|', cur)
+    while sep >= 0:
+        spans.append((start, sep))
+        start = sep + 1
+        sep = paramsList.find('|', start)
+    spans.append((start, len(paramsList)))
+    return spans
 
-    cur = 0
-    while True:
-        m1 = reOpen.search(text, cur)
-        if not m1:
-            return
-        lmatch = m1.end() - m1.start()
-        if m1.group()[0] == '{':
-            stack = [lmatch]  # stack of opening braces lengths
-        else:
-            stack = [-lmatch]  # negative means [
-        end = m1.end()
-        while True:
-            m2 = reNext.search(text, end)
-            if not m2:
-                return  # unbalanced
-            end = m2.end()
-            brac = m2.group()[0]
-            lmatch = m2.end() - m2.start()
-
-            if brac == '{':
-                stack.append(lmatch)
-            elif brac == '}':
-                while stack:
-                    openCount = stack.pop()  # opening span
-                    if openCount == 0:  # illegal unmatched [[
-                        continue
-                    if lmatch >= openCount:
-                        lmatch -= openCount
-                        if lmatch <= 1:  # either close or stray }
-                            break
-                    else:
-                        # put back unmatched
-                        stack.append(openCount - lmatch)
-                        break
-                if not stack:
-                    yield m1.start(), end - lmatch
-                    cur = end
-                    break
-                elif len(stack) == 1 and 0 < stack[0] < ldelim:
-                    # ambiguous {{{{{ }}} }}
-                    #yield m1.start() + stack[0], end
-                    cur = end
-                    break
-            elif brac == '[':  # [[
-                stack.append(-lmatch)
-            else:  # ]]
-                while stack and stack[-1] < 0:  # matching [[
-                    openCount = -stack.pop()
-                    if lmatch >= openCount:
-                        lmatch -= openCount
-                        if lmatch <= 1:  # either close or stray ]
-                            break
-                    else:
-                        # put back unmatched (negative)
-                        stack.append(lmatch - openCount)
-                        break
-                if not stack:
-                    yield m1.start(), end - lmatch
-                    cur = end
-                    break
-                # unmatched ]] are discarded
-                cur = end
+
+@lru_cache(maxsize=32)
+def balancedPatterns(openDelim, closeDelim):
+    """
+    :return: the patterns for findBalanced() with tuples :param openDelim:
+    and :param closeDelim:, compiled once.
+    """
+    openPat = '|'.join([re.escape(x) for x in openDelim])
+    # pattern for delimiters expected after each opening delimiter
+    afterPat = {o: re.compile(openPat + '|' + c, re.DOTALL) for o, c in zip(openDelim, closeDelim)}
+    return re.compile(openPat), afterPat
 
 
 def findBalanced(text, openDelim=['[['], closeDelim=[']]']):
@@ -1277,15 +1503,12 @@ def findBalanced(text, openDelim=['[['], closeDelim=[']]']):
     :return: an iterator producing pairs (start, end) of start and end
     positions in text containing a balanced expression.
     """
-    openPat = '|'.join([re.escape(x) for x in openDelim])
-    # pattern for delimiters expected after each opening delimiter
-    afterPat = {o: re.compile(openPat + '|' + c, re.DOTALL) for o, c in zip(openDelim, closeDelim)}
+    startPat, afterPat = balancedPatterns(tuple(openDelim), tuple(closeDelim))
     stack = []
     start = 0
     cur = 0
     # end = len(text)
     startSet = False
-    startPat = re.compile(openPat)
     nextPat = startPat
     while True:
         next = nextPat.search(text, cur)
@@ -1671,6 +1894,15 @@ def fullyQualifiedTemplateTitle(templateTitle):
     Determine the namespace of the page being included through the template
     mechanism
     """
+    return qualifiedTitle(templateTitle, options.templatePrefix)
+
+
+@lru_cache(maxsize=titleCacheSize)
+def qualifiedTitle(templateTitle, templatePrefix):
+    """
+    :return: the fully qualified title of :param templateTitle:, with
+    :param templatePrefix: as the prefix of the Template namespace.
+    """
     if templateTitle.startswith(':'):
         # Leading colon by itself implies main namespace, so strip this colon
         return ucfirst(templateTitle[1:])
@@ -1694,63 +1926,62 @@ def fullyQualifiedTemplateTitle(templateTitle):
     # space]], but having in the system a redirect page with an empty title
     # causes numerous problems, so we'll live happier without it.
     if templateTitle:
-        return options.templatePrefix + ucfirst(templateTitle)
+        return templatePrefix + ucfirst(templateTitle)
     else:
         return ''  # caller may log as error
 
 
 def normalizeNamespace(ns):
-    return ucfirst(ns)
-
-
-# ----------------------------------------------------------------------
-# Parser functions
-# see http://www.mediawiki.org/wiki/Help:Extension:ParserFunctions
-# https://github.com/Wikia/app/blob/dev/extensions/ParserFunctions/ParserFunctions_body.php
-
-
-class Infix:
-    """Infix operators.
-    The calling sequence for the infix is:
-      x |op| y
     """
+    :return: the name of the known namespace :param ns: in any case, else
+    :param ns: capitalized.
+    """
+    return options.namespaceNames.get(ns.casefold()) or ucfirst(ns)
 
-    def __init__(self, function):
-        self.function = function
-
-    def __ror__(self, other):
-        return Infix(lambda x, self=self, other=other: self.function(other, x))
-
-    def __or__(self, other):
-        return self.function(other)
 
-    def __rlshift__(self, other):
-        return Infix(lambda x, self=self, other=other: self.function(other, x))
+def indexNamespaces():
+    """
+    Indexes options.knownNamespaces by case folded name, and forgets the
+    titles normalized with the previous ones.
+    """
+    options.namespaceNames = {ns.casefold(): ns for ns in options.knownNamespaces if ns}
+    normalizeTitle.cache_clear()
+    qualifiedTitle.cache_clear()
 
-    def __rshift__(self, other):
-        return self.function(other)
 
-    def __call__(self, value1, value2):
-        return self.function(value1, value2)
+def reportTitleCaches():
+    for name, function in (('Title', normalizeTitle), ('Template title', qualifiedTitle)):
+        info = function.cache_info()
+        lookups = info.hits + info.misses
+        if lookups:
+            logging.info("%s cache: %d hits out of %d lookups (%.1f%%)",
+                         name, info.hits, lookups, 100.0 * info.hits / lookups)
 
 
-ROUND = Infix(lambda x, y: round(x, y))
+# ----------------------------------------------------------------------
+# Parser functions
+# see http://www.mediawiki.org/wiki/Help:Extension:ParserFunctions
+# https://github.com/Wikia/app/blob/dev/extensions/ParserFunctions/ParserFunctions_body.php
 
 
-from math import floor, ceil, pi, e, trunc, exp, log as ln, sin, cos, tan, asin, acos, atan
+def sharp_expr(extr, expr):
+    """Evaluates an expression, the value of {{#expr:}}."""
+    expr = extr.expand(expr)
+    try:
+        return evaluateExpr(expr)
+    except ExprError:
+        return '<span class="error">%s</span>' % expr
 
 
-def sharp_expr(extr, expr):
-    """Tries converting a lua expr into a Python expr."""
+def sharp_ifexpr(extr, expr, valueIfTrue='', valueIfFalse='', *args):
+    # The first argument has been evaluated in expandTemplate().
     try:
-        expr = extr.expand(expr)
-        expr = re.sub('(?<![!<>])=', '==', expr) # negative lookbehind
-        expr = re.sub('mod', '%', expr)          # no \b here
-        expr = re.sub('\bdiv\b', '/', expr)
-        expr = re.sub('\bround\b', '|ROUND|', expr)
-        return text_type(eval(expr))
-    except:
+        true = evaluateCondition(expr)
+    except ExprError:
         return '<span class="error">%s</span>' % expr
+    if true:
+        return extr.expand(valueIfTrue.strip())
+    return extr.expand(valueIfFalse.strip())
 
 
 def sharp_if(extr, testValue, valueIfTrue, valueIfFalse=None, *args):
@@ -1806,6 +2037,15 @@ def sharp_switch(extr, primary, *params):
     # }}
 
     primary = primary.strip()
+    if extr.frame.depth < extr.maxTemplateRecursionLevels:
+        # where labels expand to themselves, use an index
+        index = switch_index(params)
+        if index is not None:
+            cases, default = index
+            case = cases.get(primary, default)
+            if case is None:
+                return ''
+            return extr.expand(params[case].split('=', 1)[1].strip())
     found = False  # for fall through cases
     default = None
     rvalue = None
@@ -1858,7 +2098,7 @@ parserFunctions = {
 
     '#iferror': sharp_iferror,
 
-    '#ifexpr': lambda *args: '',  # not supported
+    '#ifexpr': sharp_ifexpr,
 
     '#ifexist': lambda extr, title, ifex, ifnex: extr.expand(ifnex), # assuming title is not present
 
@@ -1915,6 +2155,7 @@ def callParserFunction(functionName, args, extractor):
                 if not templateTitle:
                     logging.warn("Template with empty title")
                 params = None
+                extractor.page_lookups += 1
                 frame = extractor.frame
                 while frame:
                     if frame.title == templateTitle:
@@ -1963,13 +2204,15 @@ def define_template(title, page):
     # sanity check (empty template, e.g. Template:Crude Oil Prices))
     if not page: return
 
-    # check for redirects
-    m = re.match('#REDIRECT.*?\[\[([^\]]*)]]', page[0], re.IGNORECASE)
+    text = ''.join(page)
+
+    # check for redirects, resolved by resolveRedirects()
+    m = re.match('#REDIRECT.*?\[\[([^\]]*)]]', text, re.IGNORECASE)
     if m:
-        options.redirects[title] = m.group(1)  # normalizeTitle(m.group(1))
+        options.redirects[title] = m.group(1)
         return
 
-    text = unescape(''.join(page))
+    text = unescape(text)
 
     # We're storing template text for future inclusion, therefore,
     # remove all <noinclude> text and keep all <includeonly> text
@@ -2003,6 +2246,589 @@ def define_template(title, page):
         options.templates[title] = text
 
 
+# ----------------------------------------------------------------------
+# Pruning
+
+# Extension tags, whose content MediaWiki sets aside before expanding the
+# templates around them.
+extensionTags = frozenset([
+    'gallery', 'timeline', 'imagemap', 'indicator', 'math', 'poem', 'pre',
+    'ref', 'references', 'score', 'source', 'syntaxhighlight'
+])
+
+tagName = re.compile(r'&lt;\s*(\w+)')
+
+# delimiters of tables, as dropped by wiki2text()
+tableRE = re.compile(r'{\||\|}')
+
+bracketRE = re.compile(r'[{}\[\]]')
+
+
+def pruneDiscarded(text):
+    """
+    Empties, before expanding their templates, the elements that clean()
+    discards and the tables that wiki2text() drops, so that templates whose
+    output is discarded are not expanded.
+    Elements of extension tags are pruned, and tables unless keeping them.
+    Only those are pruned whose templates cannot emit the markup delimiting
+    them or the tables and elements around them, so that the output does
+    not change. Elements, which wiki2text() still holds when pairing quotes
+    within lines, must also not hold apostrophes, double quotes or newlines.
+    :param text: the text of a page, with tags escaped as in the dump.
+    :return: the pruned text.
+    """
+    if '{{' not in text:
+        return text             # nothing to save
+    tags, marks = pruneMarks(tuple(sorted(options.discardElements)), options.keep_tables)
+    braces = list(findMatchingBraces(text, 2))
+    # blank templates, which are checked separately
+    blanked = blank(text, braces)
+    if '{{' in blanked or '}}' in blanked:
+        return text             # braces would match otherwise once pruned
+    spans = []
+    if tags and '&lt;' in text:
+        for s, e in tagSpans(text, tagScanner((), (), tags, True)):
+            if text.startswith('&lt;!--', s):
+                continue
+            begin = text.index('&gt;', s) + 4
+            end = text.rindex('&lt;', begin, e)
+            if emitsNoQuotes(text[begin:end]) and cannotEmit(text[begin:end], marks):
+                name = tagName.match(text, s).group(1)
+                spans.append((s, e, text[s:begin] + '&lt;/%s&gt;' % name))
+    if not options.keep_tables and '{|' in text:
+        spans.extend(tableSpans(text, blanked))
+    if not spans:
+        return text
+    # prune the outermost
+    spans.sort()
+    starts = [b for b, f in braces]
+    res = []
+    cur = 0
+    for s, e, shell in spans:
+        if s < cur:
+            continue
+        # never inside or across templates, the closest ones to either end
+        i = bisect_left(starts, s) - 1
+        j = bisect_left(starts, e) - 1
+        if i >= 0 and s < braces[i][1] or j >= 0 and s < starts[j] and e < braces[j][1]:
+            continue
+        res.append(text[cur:s])
+        res.append(shell)
+        cur = e
+    res.append(text[cur:])
+    return ''.join(res)
+
+
+@lru_cache(maxsize=16)
+def pruneMarks(discarded, keepTables):
+    """
+    :param discarded: the names of the elements to discard.
+    :param keepTables: whether tables are kept.
+    :return: the extension tags whose elements are pruned, and the markup
+    which their templates must not emit: the tags of discarded elements,
+    comments, <nowiki> and the delimiters of tables, if dropped.
+    """
+    marks = ['<!--', '-->', '<nowiki', '</nowiki']
+    marks.extend('<' + name for name in discarded)
+    marks.extend('</' + name for name in discarded)
+    # tags in templates, and in pages until unescaped by wiki2text()
+    marks.extend([mark.replace('<', '&lt;').replace('>', '&gt;') for mark in marks])
+    if not keepTables:
+        marks.extend(('{|', '|}'))
+    return tuple(extensionTags.intersection(discarded)), tuple(marks)
+
+
+def tableSpans(text, blanked):
+    """
+    Finds the tables of :param text: whose templates cannot emit table
+    delimiters.
+    :param blanked: :param text: with its templates blanked.
+    :return: the list of triples (start, end, empty table), none if tables
+    are unbalanced.
+    """
+    spans = []
+    depth = 0
+    for m in tableRE.finditer(blanked):
+        if m.group(0) == '{|':
+            if not depth:
+                start = m.start()
+            depth += 1
+        elif not depth:
+            return []
+        else:
+            depth -= 1
+            if not depth and cannotEmit(text[start + 2:m.start()], ('{|', '|}')):
+                spans.append((start, m.end(), '{|\n|}'))
+    return spans if not depth else []
+
+
+def blank(text, spans):
+    """
+    :return: :param text: with the non overlapping :param spans: replaced
+    by spaces.
+    """
+    pieces = []
+    cur = 0
+    for s, e in spans:
+        pieces.append(text[cur:s])
+        pieces.append(' ' * (e - s))
+        cur = e
+    pieces.append(text[cur:])
+    return ''.join(pieces)
+
+
+def cannotEmit(text, marks):
+    """
+    Checks statically that expanding :param text: cannot produce any of the
+    strings :param marks:, in lower case, nor unbalanced braces or brackets.
+    """
+    return balanced(text) and emitsNone(text, marks)
+
+
+def balanced(text):
+    """
+    :return: whether the braces and the brackets of :param text: balance.
+    """
+    depths = {'{': 0, '[': 0}
+    for m in bracketRE.finditer(text):
+        c = m.group(0)
+        if c in depths:
+            depths[c] += 1
+        else:
+            c = '{' if c == '}' else '['
+            depths[c] -= 1
+            if depths[c] < 0:
+                return False
+    return not any(depths.values())
+
+
+@lru_cache(maxsize=16)
+def markPattern(marks):
+    """
+    :return: the pattern matching where one of :param marks: may start.
+    """
+    return re.compile('[%s]' % ''.join(map(re.escape, sorted(set(mark[0] for mark in marks)))))
+
+
+# pipes next to braces, delimiting parts rather than tables
+bracePipeRE = re.compile(r'(?<={{)\||\|(?=}})')
+
+# the title of a template invocation, and the character after it
+invocationRE = re.compile(r'(?<!{){{(?!{)\s*([^{|}]*)(.?)', re.DOTALL)
+
+
+def emitsNone(text, marks):
+    """
+    Checks that neither the text of :param text: nor the expansion of its
+    templates contain any of :param marks:. The arguments of templates are
+    checked as part of :param text:.
+    Marks are assumed to be emitted whole, not formed by what templates emit
+    next to each other.
+    """
+    lowered = bracePipeRE.sub(' ', text.lower())
+    for m in markPattern(marks).finditer(lowered):
+        if lowered.startswith(marks, m.start()):
+            return False
+    if '{{' not in text:
+        return True
+    if '{{{{' in text:
+        return False            # ambiguous braces
+    for m in invocationRE.finditer(text):
+        if not invocationEmitsNone(m.group(1).strip(), m.group(2), marks):
+            return False
+    return True
+
+
+def invocationEmitsNone(title, after, marks):
+    """
+    Checks that the template or parser function with :param title: cannot
+    emit any of :param marks:, besides its arguments.
+    :param after: the character following the title.
+    """
+    title = re.sub(substWords, '', title, 1, re.IGNORECASE)
+    colon = title.find(':')
+    if colon > 1:
+        # a parser function emits its arguments, but for modules
+        if title[:colon].strip().lower() == '#invoke':
+            return after == '|' and title[colon + 1:].strip() not in modules
+        return True
+    if after == '{' or title == '!':
+        return False            # unknown template or a delimiter
+    title = fullyQualifiedTemplateTitle(title)
+    if not title:
+        return True
+    title = options.redirects.get(title, title)
+    key = (title, marks)
+    safe = options.markupCache.get(key)
+    if safe is None:
+        options.markupCache[key] = False  # recursive templates are unsafe
+        if title in options.templateCache:
+            source = str(options.templateCache[title])
+        else:
+            source = options.templates.get(title, '')
+        safe = options.markupCache[key] = emitsNone(source, marks)
+    return safe
+
+
+# what wiki2text() pairs within lines before clean() discards the elements
+# holding it: apostrophes, double quotes and line ends
+quoteRE = re.compile('[\'"\n]')
+quoteChars = ("'", '"', '\n')
+
+# a named parameter, as split by templateParams()
+namedParamRE = re.compile(' *([^=]*?) *?=(.*)', re.DOTALL)
+
+
+def emitsNoQuotes(text):
+    """
+    Checks that expanding :param text: cannot emit apostrophes, double quotes
+    or newlines, so that discarding it before wiki2text() does not change how
+    the quotes around it pair. Unlike for emitsNone(), only what can be
+    emitted counts, not the whitespace stripped around titles and parameters.
+    """
+    if '{{' not in text:
+        return not quoteRE.search(text)
+    if '{{{{' in text:
+        return False            # ambiguous braces
+    braces = list(findMatchingBraces(text, 2))
+    blanked = blank(text, braces)
+    if quoteRE.search(blanked) or '{{' in blanked or '}}' in blanked:
+        return False
+    return all(invocationEmitsNoQuotes(text[s:e]) for s, e in braces)
+
+
+def invocationEmitsNoQuotes(text):
+    """
+    Checks that the template, parser function or tplarg :param text:, between
+    braces, cannot emit apostrophes, double quotes or newlines, nor can its
+    arguments.
+    """
+    if text.startswith('{{{'):
+        # its value is checked where the template is invoked
+        parts = splitParts(text[3:-3])
+        return len(parts) < 2 or emitsNoQuotes(parts[1])
+    bar = text.find('|')
+    if bar < 0 or '{' in text[2:bar] or '[' in text[2:bar]:
+        parts = splitParts(text[2:-2])
+    else:
+        parts = None            # split only if needed
+    title = text[2:bar] if parts is None else parts[0]
+    title = re.sub(substWords, '', title.lstrip(), 1, re.IGNORECASE)
+    colon = title.find(':')
+    if colon > 1 and '{' not in title[:colon]:
+        function = title[:colon].strip().lower()
+        args = [title[colon + 1:]] + (parts or splitParts(text[2:-2]))[1:]
+        if function == '#invoke':
+            # unknown modules emit nothing
+            return '{' not in args[0] and args[0].strip() not in modules
+        if function in ('#expr', '#ifexpr'):
+            return False        # errors are quoted markup
+        if function == '#ifexist':
+            return all(emitsNoQuotes(arg) for arg in args)
+        return all(emitsNoQuotes(arg.strip()) for arg in args)
+    title = title.strip()
+    if '{' in title or title.lower() in MagicWords.names:
+        return title == '!'
+    title = fullyQualifiedTemplateTitle(title)
+    if not title:
+        return True
+    stubs = options.templateStubs
+    if stubs is not None:
+        stub = stubs.get(title)
+        if stub is None and title in options.redirects:
+            stub = stubs.get(options.redirects[title])
+        if stub is not None:
+            return not quoteRE.search(stub)
+    title = options.redirects.get(title, title)
+    key = (title, quoteChars)
+    safe = options.markupCache.get(key)
+    if safe is None:
+        options.markupCache[key] = False  # recursive templates are unsafe
+        if title in options.templateCache:
+            source = str(options.templateCache[title])
+        else:
+            source = options.templates.get(title, '')
+        safe = options.markupCache[key] = emitsNoQuotes(source)
+    return safe and all(emitsNoQuotes(argumentValue(part))
+                        for part in (parts or splitParts(text[2:-2]))[1:])
+
+
+def argumentValue(part):
+    """
+    :return: the text of the value of the template argument :param part:,
+    stripped if named, as by templateParams().
+    """
+    m = namedParamRE.match(part)
+    if not m:
+        return part
+    value = m.group(2)
+    return value if ']]' in value else value.strip()
+
+
+def argumentsCannotEmit(parts, marks):
+    """
+    Checks that the arguments :param parts: of an invocation replaced by its
+    shell cannot emit :param marks:, nor, unless they end up only in tables,
+    apostrophes, double quotes or newlines, as for emitsNoQuotes().
+    """
+    if not all(cannotEmit(part, marks) for part in parts):
+        return False
+    return marks is tableMarks or all(emitsNoQuotes(argumentValue(part)) for part in parts)
+
+
+# markup which templates within tables must not emit, since tables are
+# dropped before elements
+tableMarks = ('{|', '|}', '<!--', '-->', '<nowiki', '</nowiki',
+              '&lt;!--', '--&gt;', '&lt;nowiki', '&lt;/nowiki')
+
+
+def discardedShell(title):
+    """
+    Finds whether the output of template :param title: is always discarded:
+    its text is made only of elements that clean() discards, of tables that
+    wiki2text() drops and of invocations of templates of the same kind,
+    with blanks in between, and the templates and tplargs within those
+    elements and tables cannot emit the markup delimiting them, nor, within
+    elements, the quotes and newlines that wiki2text() pairs.
+    Its invocations can then be replaced by its shell, provided that their
+    arguments cannot emit such markup either.
+    :return: the pair of the shell of the template, its text without the
+    templates and tplargs within its elements and tables, which is discarded
+    in the same way, and of the markup its arguments must not emit, or None
+    if its output is not always discarded.
+    """
+    discarded = tuple(sorted(options.discardElements))
+    marks = pruneMarks(discarded, options.keep_tables)[1]
+    key = (title, marks)
+    if key in options.discardedTemplates:
+        return options.discardedTemplates[key]
+    options.discardedTemplates[key] = None  # recursive templates are kept
+    if title in options.templateCache:
+        source = str(options.templateCache[title])
+    else:
+        source = options.templates.get(title)
+    if source and source.strip() and balanced(source):
+        shell = templateShell(source, discarded, marks)
+    else:
+        shell = None
+    options.discardedTemplates[key] = shell
+    return shell
+
+
+def classifyTemplates():
+    """
+    Classifies all the templates loaded, as in discardedShell().
+    :return: the titles of the templates whose output is always discarded.
+    """
+    titles = set(options.templates)
+    titles.update(options.templateCache)
+    return sorted(title for title in titles if discardedShell(title) is not None)
+
+
+def templateShell(source, discarded, marks):
+    """
+    :return: the shell of the template with text :param source: and the
+    markup its arguments must not emit, or None, as for discardedShell().
+    """
+    braces = list(findMatchingBraces(source, 2))
+    blanked = blank(source, braces)
+    if '{{' in blanked or '}}' in blanked:
+        return None
+    units = [(s, e, marks) for s, e in tagSpans(blanked, tagScanner((), (), discarded))]
+    if not options.keep_tables and '{|' in blanked:
+        tables = tableUnits(blanked)
+        if tables is None:
+            return None
+        units.extend((s, e, tableMarks) for s, e in tables)
+    # the outermost, which must not cross
+    units.sort(key=lambda unit: (unit[0], -unit[1]))
+    outer = []
+    for unit in units:
+        if outer and unit[0] < outer[-1][1]:
+            if unit[1] > outer[-1][1]:
+                return None
+            continue
+        outer.append(unit)
+    outer.append((len(source), len(source), ()))  # sentinel
+    argMarks = tableMarks
+    res = []
+    cur = 0
+    i = 0
+    for s, e, unitMarks in outer:
+        # templates between elements and tables
+        for s1, e1 in braces[i:]:
+            if s1 >= s:
+                break
+            i += 1
+            inner = invocationShell(source[s1:e1])
+            if inner is None or source[cur:s1].strip():
+                return None
+            res.append(source[cur:s1])
+            res.append(inner[0])
+            if inner[1] is not tableMarks:
+                argMarks = marks
+            cur = e1
+        if source[cur:s].strip():
+            return None
+        # templates and tplargs within elements and tables
+        for s1, e1 in braces[i:]:
+            if s1 >= e:
+                break
+            i += 1
+            if not emitsNone(source[s1:e1], unitMarks):
+                return None
+            if unitMarks is not tableMarks:
+                # nor quotes, which would pair differently once dropped
+                if not emitsNoQuotes(source[s1:e1]) or \
+                   source[s1 - 1:s1] in ("'", '"') or source[e1:e1 + 1] in ("'", '"'):
+                    return None
+                if '{{{' in source[s1:e1]:
+                    argMarks = marks
+            res.append(source[cur:s1])
+            cur = e1
+        res.append(source[cur:e])
+        cur = e
+    return ''.join(res), argMarks
+
+
+def tableUnits(text):
+    """
+    :return: the spans of the outermost tables in :param text:, or None if
+    tables are unbalanced.
+    """
+    spans = []
+    depth = 0
+    for m in tableRE.finditer(text):
+        if m.group(0) == '{|':
+            if not depth:
+                start = m.start()
+            depth += 1
+        elif not depth:
+            return None
+        else:
+            depth -= 1
+            if not depth:
+                spans.append((start, m.end()))
+    return spans if not depth else None
+
+
+def invocationShell(text):
+    """
+    :param text: an invocation, between braces.
+    :return: the shell of the template invoked by :param text: and the
+    markup its arguments must not emit, if its output is always discarded
+    and its arguments cannot emit such markup, otherwise None.
+    """
+    if text.startswith('{{{'):
+        return None             # a tplarg
+    parts = splitParts(text[2:-2])
+    title = re.sub(substWords, '', parts[0].strip(), 1, re.IGNORECASE)
+    if title.find(':') > 1 or title.lower() in MagicWords.names:
+        return None
+    title = fullyQualifiedTemplateTitle(title)
+    if not title:
+        return None
+    shell = discardedShell(options.redirects.get(title, title))
+    if shell is None or not argumentsCannotEmit(parts[1:], shell[1]):
+        return None
+    return shell
+
+
+# ----------------------------------------------------------------------
+# Redirects
+
+def resolveRedirects():
+    """
+    Flattens options.redirects, as recorded by define_template(), so that
+    each title maps to the normalized title at the end of its chain of
+    redirects. Titles whose chain loops are dropped.
+    :return: the number of titles dropped.
+    """
+    targets = {title: redirectTarget(link) for title, link in options.redirects.items()}
+    resolved = {}
+    for title in targets:
+        chain = []
+        target = title
+        while target in targets and target not in resolved:
+            if target in chain:
+                break
+            chain.append(target)
+            target = targets[target]
+        final = None if target in chain else resolved.get(target, target)
+        for alias in chain:
+            resolved[alias] = final
+    options.redirects = {title: final for title, final in resolved.items()
+                         if final is not None}
+    return len(resolved) - len(options.redirects)
+
+
+def redirectTarget(link):
+    """
+    :param link: the link of a redirect, possibly to a section or labeled.
+    :return: the normalized title of the page it links to.
+    """
+    return normalizeTitle(link.split('|', 1)[0].split('#', 1)[0].strip().lstrip(':'))
+
+
+# ----------------------------------------------------------------------
+# Folding
+
+def foldTemplates():
+    """
+    Expands once the templates without tplargs whose expansion does not
+    depend on the page, such as {{ndash}}, so that their invocations just
+    return the result, kept in options.foldedTemplates. Templates invoking
+    only folded templates and parser functions are folded in turn, until no
+    more can be.
+    :return: the number of templates folded.
+    """
+    folded = options.foldedTemplates
+    pending = {}
+    for title, body in options.templates.items():
+        if '{{{' not in body and title not in folded and title not in options.redirects:
+            invoked = invokedTemplates(body)
+            if invoked is not None:
+                pending[title] = (body, invoked)
+    count = 0
+    while True:
+        ready = [title for title, (body, invoked) in pending.items()
+                 if all(t in folded or t not in options.templates for t in invoked)]
+        if not ready:
+            return count
+        for title in ready:
+            body = pending.pop(title)[0]
+            extractor = Extractor('0', '0', title, [])
+            extractor.frame = extractor.frame.push(title, {})
+            value = extractor.transform(body)
+            # as for the ExpansionCache
+            if not extractor.page_lookups and not any(extractor.errors()):
+                folded[title] = value
+                count += 1
+
+
+def invokedTemplates(body):
+    """
+    :return: the set of the titles of the templates invoked in :param body:,
+    redirects resolved, or None if some are computed or are magic words
+    specific to the page.
+    """
+    titles = set()
+    for m in invocationRE.finditer(body):
+        title = re.sub(substWords, '', m.group(1).strip(), 1, re.IGNORECASE)
+        if m.group(2) == '{':
+            return None
+        if title.find(':') > 1:
+            continue            # parser functions are checked when folding
+        if title.lower() in MagicWords.names:
+            if title != '!':
+                return None     # page specific
+            continue
+        title = fullyQualifiedTemplateTitle(title)
+        if title:
+            titles.add(options.redirects.get(title, title))
+    return titles
+
+
 # ----------------------------------------------------------------------
 
 def dropNested(text, openDelim, closeDelim):
@@ -2060,18 +2886,18 @@ def dropNested(text, openDelim, closeDelim):
 
 def dropSpans(spans, text):
     """
-    Drop from text the blocks identified in :param spans:, possibly nested.
+    Drop from text the blocks identified in :param spans:, possibly nested
+    or overlapping.
     """
     spans.sort()
-    res = ''
+    res = []
     offset = 0
     for s, e in spans:
-        if offset <= s:         # handle nesting
-            if offset < s:
-                res += text[offset:s]
-            offset = e
-    res += text[offset:]
-    return res
+        if offset < s:
+            res.append(text[offset:s])
+        offset = max(offset, e)  # merge nested and overlapping spans
+    res.append(text[offset:])
+    return ''.join(res)
 
 
 # ----------------------------------------------------------------------
@@ -2093,7 +2919,7 @@ def replaceInternalLinks(text):
     # call this after removal of external links, so we need not worry about
     # triple closing ]]].
     cur = 0
-    res = ''
+    res = []
     for s, e in findBalanced(text):
         m = tailRE.match(text, e)
         if m:
@@ -2111,16 +2937,20 @@ def replaceInternalLinks(text):
         else:
             title = inner[:pipe].rstrip()
             # find last |
-            curp = pipe + 1
-            for s1, e1 in findBalanced(inner):
-                last = inner.rfind('|', curp, s1)
-                if last >= 0:
-                    pipe = last  # advance
-                curp = e1
+            if '[[' in inner:
+                curp = pipe + 1
+                for s1, e1 in findBalanced(inner):
+                    last = inner.rfind('|', curp, s1)
+                    if last >= 0:
+                        pipe = last  # advance
+                    curp = e1
             label = inner[pipe + 1:].strip()
-        res += text[cur:s] + makeInternalLink(title, label) + trail
+        res.append(text[cur:s])
+        res.append(makeInternalLink(title, label))
+        res.append(trail)
         cur = end
-    return res + text[cur:]
+    res.append(text[cur:])
+    return ''.join(res)
 
 
 # the official version is a method in class Parser, similar to this:
@@ -2441,10 +3271,10 @@ def replaceExternalLinks(text):
     https://www.mediawiki.org/wiki/Help:Links#External_links
     [URL anchor text]
     """
-    s = ''
+    s = []
     cur = 0
     for m in ExtLinkBracketedRegex.finditer(text):
-        s += text[cur:m.start()]
+        s.append(text[cur:m.start()])
         cur = m.end()
 
         url = m.group(1)
@@ -2468,9 +3298,10 @@ def replaceExternalLinks(text):
         # This means that users can paste URLs directly into the text
         # Funny characters like ö aren't valid in URLs anyway
         # This was changed in August 2004
-        s += makeExternalLink(url, label)  # + trail
+        s.append(makeExternalLink(url, label))  # + trail
 
-    return s + text[cur:]
+    s.append(text[cur:])
+    return ''.join(s)
 
 
 def makeExternalLink(url, anchor):
@@ -2495,6 +3326,26 @@ tailRE = re.compile('\w+')
 
 syntaxhighlight = re.compile('&lt;syntaxhighlight .*?&gt;(.*?)&lt;/syntaxhighlight&gt;', re.DOTALL)
 
+# Matches either <syntaxhighlight> or an entity, factoring their leading '&'
+# for the scan to skip to it
+codeOrEntity = re.compile(r'&(?:lt;syntaxhighlight .*?&gt;(.*?)&lt;/syntaxhighlight&gt;|#?(\w+);)',
+                          re.DOTALL)
+
+
+def unescapeExceptCode(text):
+    """
+    Unescapes :param text:, except the content of <syntaxhighlight>, which is
+    kept as is while its tags are dropped, in a single scan.
+    """
+    def fixup(m):
+        code = m.group(1)
+        if code is not None:
+            return code
+        text = m.group(0)
+        return entities.get(text) or fixupEntity(text, m.group(2))
+
+    return codeOrEntity.sub(fixup, text)
+
 # skip level 1, it is page name level
 section = re.compile(r'(==+)\s*(.*?)\s*\1')
 
@@ -2731,28 +3582,13 @@ def load_templates(file, output_file=None):
                                 not options.moduleNamespace):  # do not know it yet
             # reconstruct templateNamespace and moduleNamespace from the first title
             if ns in templateKeys:
-                colon = title.find(':')
-                if colon > 1:
-                    if ns == '10':
-                        options.templateNamespace = title[:colon]
-                        options.templatePrefix = title[:colon + 1]
-                    elif ns == '828':
-                        options.moduleNamespace = title[:colon]
-                        options.modulePrefix = title[:colon + 1]
+                inferNamespace(title, ns)
         if ns in templateKeys:
             text = ''.join(page)
             define_template(title, text)
             # save templates and modules to file
             if output_file:
-                output.write('<page>\n')
-                output.write('   <title>%s</title>\n' % title)
-                output.write('   <ns>%s</ns>\n' % ns)
-                output.write('   <id>%s</id>\n' % id)
-                output.write('   <text>')
-                for line in page:
-                    output.write(line)
-                output.write('   </text>\n')
-                output.write('</page>\n')
+                save_template(output, id, title, ns, page)
         if page_count and page_count % 100000 == 0:
             logging.info("Preprocessed %d pages", page_count)
     if output_file:
@@ -2760,6 +3596,182 @@ def load_templates(file, output_file=None):
         logging.info("Saved %d templates to '%s'", len(options.templates), output_file)
 
 
+def inferNamespace(title, ns):
+    """
+    Sets the name of the template or module namespace :param ns: from the
+    :param title: of one of its pages, when siteinfo did not define it.
+    """
+    colon = title.find(':')
+    if colon > 1:
+        if ns == '10':
+            options.templateNamespace = title[:colon]
+            options.templatePrefix = title[:colon + 1]
+        elif ns == '828':
+            options.moduleNamespace = title[:colon]
+            options.modulePrefix = title[:colon + 1]
+
+
+def save_template(output, id, title, ns, page):
+    """
+    Writes a template page to :param output:, as read by load_templates().
+    """
+    output.write('<page>\n')
+    output.write('   <title>%s</title>\n' % title)
+    output.write('   <ns>%s</ns>\n' % ns)
+    output.write('   <id>%s</id>\n' % id)
+    output.write('   <text>')
+    for line in page:
+        output.write(line)
+    output.write('   </text>\n')
+    output.write('</page>\n')
+
+
+def load_templates_parallel(input_file, process_count, output_file=None,
+                            read_block=None, blocks=None):
+    """
+    Load templates from the dump :param input_file:, like load_templates()
+    but scanning blocks of pages in parallel.
+    :param process_count: number of processes to spawn.
+    :param output_file: file where to save templates and modules.
+    :param read_block: function returning the text of a block from the dump,
+        given its start and end, as for extract_block_process().
+    :param blocks: list of pairs (start, end) of the blocks to read. If None,
+        the dump is cut in blocks of whole pages by page_blocks().
+    """
+    prepass_start = default_timer()
+    options.templatePrefix = options.templateNamespace + ':'
+    options.modulePrefix = options.moduleNamespace + ':'
+
+    process_count = max(1, process_count)
+    jobs_queue = Queue(maxsize=10 * process_count)
+    # results are drained while jobs are queued, and are merged in block order
+    output_queue = Queue()
+    workers = []
+    for _ in range(process_count):
+        worker = Process(target=template_process,
+                         args=(options, input_file, read_block, jobs_queue,
+                               output_queue, bool(output_file)))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    output = codecs.open(output_file, 'wb', 'utf-8') if output_file else None
+    spool = {}
+    next_block = 0
+
+    def merge(result):
+        nonlocal next_block
+        spool[result[0]] = result[1:]
+        while next_block in spool:
+            templates, redirects, titles, pages = spool.pop(next_block)
+            # as load_templates(), from the first titles in dump order
+            for ns, title in titles:
+                if not output_file and (not options.templateNamespace or
+                                        not options.moduleNamespace):
+                    inferNamespace(title, ns)
+            for title in templates:
+                if title in options.templates:
+                    logging.warn('Redefining: %s', title)
+            options.templates.update(templates)
+            options.redirects.update(redirects)
+            for page in pages:
+                save_template(output, *page)
+            next_block += 1
+
+    if blocks is None:
+        input = fileinput.hook_compressed(input_file, 'rb')
+        jobs = ((block_num, data) for block_num, data in enumerate(page_blocks(input)))
+    else:
+        input = None
+        jobs = ((block_num, start, end) for block_num, (start, end) in enumerate(blocks))
+    block_count = 0
+    for job in jobs:
+        jobs_queue.put(job)
+        block_count += 1
+        # keep up with results, which only workers would otherwise hold
+        while True:
+            try:
+                merge(output_queue.get_nowait())
+            except Empty:
+                break
+    if input:
+        input.close()
+    for _ in workers:
+        jobs_queue.put(None)
+    while next_block < block_count:
+        merge(output_queue.get())
+    for worker in workers:
+        worker.join()
+
+    if output:
+        output.close()
+        logging.info("Saved %d templates to '%s'", len(options.templates), output_file)
+    logging.info("Preprocessed %d blocks with %d processes in %.1fs",
+                 block_count, process_count, default_timer() - prepass_start)
+
+
+def template_spans(input_file, index_file, offsets):
+    """
+    Selects the streams of a multistream dump to scan for templates: those
+    whose pages, according to the index, include templates or modules.
+    :param offsets: the stream offsets, as returned by stream_offsets().
+    :return: a list of pairs (start, end) of streams.
+    """
+    if not options.templateNamespace:
+        # no siteinfo, prefixes unknown
+        return stream_spans(input_file, offsets)
+    prefixes = [options.templateNamespace + ':']
+    if options.moduleNamespace:
+        prefixes.append(options.moduleNamespace + ':')
+    spans = locate_prefixes(input_file, index_file, prefixes)
+    logging.info("Reading %d of %d streams, holding templates or modules",
+                 len(spans), len(offsets))
+    return spans
+
+
+def template_process(opts, input_file, read_block, jobs_queue, output_queue, save):
+    """Pull blocks of pages, collect the templates defined in them.
+    :param input_file: the dump.
+    :param read_block: function returning the text of a block from the
+        dump, or None if jobs carry the block itself.
+    :param jobs_queue: where to get jobs, (block_num, start, end) or
+        (block_num, data).
+    :param output_queue: where to queue (block_num, templates, redirects,
+        titles, template pages), with the first titles that name the
+        template and module namespaces as pairs (ns, title), and the pages
+        only if :param save:.
+    """
+    global options
+    options = opts
+
+    createLogger(options.quiet, options.debug)
+
+    with open(input_file, 'rb') as file:
+        while True:
+            job = jobs_queue.get()
+            if not job:
+                break
+            if read_block:
+                block_num, start, end = job
+                pages = pages_from(read_block(file, start, end).splitlines(True))
+            else:
+                block_num, data = job
+                pages = pages_from_chunks(BytesIO(data), len(data) or 1)
+            options.templates = {}
+            options.redirects = {}
+            titles = {}
+            saved = []
+            for id, revid, title, ns, page in pages:
+                if ns in templateKeys:
+                    if ns not in titles and title.find(':') > 1:
+                        titles[ns] = title
+                    define_template(title, ''.join(page))
+                    if save:
+                        saved.append((id, title, ns, page))
+            output_queue.put((block_num, options.templates, options.redirects,
+                              list(titles.items()), saved))
+
+
 def pages_from(input):
     """
     Scans input extracting pages.
@@ -2824,23 +3836,12 @@ def pages_from(input):
             page = []
 
 
-def process_dump(input_file, template_file, out_file, file_size, file_compress,
-                 process_count):
+def collect_siteinfo(input):
     """
-    :param input_file: name of the wikipedia dump file; '-' to read from stdin
-    :param template_file: optional file with template definitions.
-    :param out_file: directory where to store extracted data, or '-' for stdout
-    :param file_size: max size of each extracted file, or None for no max (one file)
-    :param file_compress: whether to compress files with bzip.
-    :param process_count: number of extraction processes to spawn.
+    Scans the <siteinfo> header of a dump, setting urlbase and namespaces
+    in options.
+    :param input: the lines of the dump.
     """
-
-    if input_file == '-':
-        input = sys.stdin
-    else:
-        input = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
-
-    # collect siteinfo
     for line in input:
         # When an input file is .bz2 or .gz, line can be a bytes even in Python 3.
         if not isinstance(line, text_type): line = line.decode('utf-8')
@@ -2868,12 +3869,70 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
                 options.modulePrefix = options.moduleNamespace + ':'
         elif tag == '/siteinfo':
             break
+    indexNamespaces()
+
+
+def process_dump(input_file, template_file, out_file, file_size, file_compress,
+                 process_count, index_file=None, shard_count=0, reader='lines',
+                 template_store=None, parsed_templates=False):
+    """
+    :param input_file: name of the wikipedia dump file; '-' to read from stdin
+    :param template_file: optional file with template definitions.
+    :param out_file: directory where to store extracted data, or '-' for stdout
+    :param file_size: max size of each extracted file, or None for no max (one file)
+    :param file_compress: whether to compress files with bzip.
+    :param process_count: number of extraction processes to spawn.
+    :param index_file: optional index of a multistream dump: its bz2 streams
+        are then decompressed in parallel by the extraction processes.
+    :param shard_count: if not 0, an uncompressed dump is split in this
+        number of byte ranges, or more to bound their size, read in parallel
+        by the extraction processes.
+    :param reader: how the mapper scans the dump for pages: 'lines' with
+        pages_from(), or 'chunks' with pages_from_chunks(), or 'spans' to
+        just cut blocks of whole pages, parsed by the extraction processes.
+    :param template_store: optional binary store of templates, used if it
+        matches the dump, otherwise (re)built.
+    :param parsed_templates: whether to store templates also parsed.
+    """
 
+    if (index_file or shard_count) and input_file == '-':
+        raise ValueError("parallel reading requires the dump file, not stdin")
+    if reader in ('chunks', 'spans') and input_file == '-':
+        raise ValueError("chunked reading requires the dump file, not stdin")
+    if index_file:
+        # the siteinfo header is in the first stream
+        offsets = stream_offsets(index_file)
+        with open(input_file, 'rb') as file:
+            collect_siteinfo(read_header(file, offsets).splitlines(True))
+        input = None
+    else:
+        if shard_count and input_file.endswith(('.bz2', '.gz')):
+            raise ValueError("sharded reading requires an uncompressed dump")
+        if input_file == '-':
+            input = sys.stdin
+        else:
+            input = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
+        collect_siteinfo(input)
+
+    table_dir = None            # mapped template tables, removed at the end
     if options.expand_templates:
         # preprocess
         template_load_start = default_timer()
-        if template_file:
-            if os.path.exists(template_file):
+        store = None
+        if template_store:
+            fingerprint = dump_fingerprint(input_file)
+            if os.path.exists(template_store):
+                store = load_store(template_store, fingerprint)
+        if store:
+            logging.info("Loading template store: %s", template_store)
+            options.templateNamespace, options.moduleNamespace = store['namespaces']
+            options.templatePrefix = options.templateNamespace + ':'
+            options.modulePrefix = options.moduleNamespace + ':'
+            options.templates = store['templates']
+            options.redirects = store['redirects']
+            options.templateCache = store['parsed']
+        elif template_file or template_store:
+            if template_file and os.path.exists(template_file):
                 logging.info("Loading template definitions from: %s", template_file)
                 # can't use with here:
                 file = fileinput.FileInput(template_file,
@@ -2885,90 +3944,197 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
                     # can't scan then reset stdin; must error w/ suggestion to specify template_file
                     raise ValueError("to use templates with stdin dump, must supply explicit template-file")
                 logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", input_file)
-                load_templates(input, template_file)
-                input.close()
-                input = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
+                if input is not None:
+                    input.close()
+                # read the dump in blocks as for extraction
+                if index_file:
+                    load_templates_parallel(input_file, process_count, template_file,
+                                            read_stream,
+                                            template_spans(input_file, index_file, offsets))
+                elif shard_count:
+                    load_templates_parallel(input_file, process_count, template_file,
+                                            read_range, byte_ranges(input_file, shard_count))
+                else:
+                    load_templates_parallel(input_file, process_count, template_file)
+                if not index_file:
+                    input = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
+        if not store:
+            # a store holds them resolved already
+            cycles = resolveRedirects()
+            if cycles:
+                logging.warning("Dropped %d template redirects in cycles", cycles)
+        if template_store and not store:
+            parsed = {}
+            if parsed_templates:
+                parsed = {title: Template.parse(body)
+                          for title, body in options.templates.items()}
+            save_store(template_store, fingerprint, options.templates,
+                       options.redirects,
+                       (options.templateNamespace, options.moduleNamespace),
+                       parsed)
+            logging.info("Saved %d templates to store '%s'",
+                         len(options.templates), template_store)
         template_load_elapsed = default_timer() - template_load_start
         logging.info("Loaded %d templates in %.1fs", len(options.templates), template_load_elapsed)
 
-    # process pages
-    logging.info("Starting page extraction from %s.", input_file)
-    extract_start = default_timer()
+        fold_start = default_timer()
+        folded = foldTemplates()
+        logging.info("Folded %d constant templates in %.1fs", folded,
+                     default_timer() - fold_start)
 
-    # Parallel Map/Reduce:
-    # - pages to be processed are dispatched to workers
-    # - a reduce process collects the results, sort them and print them.
-
-    process_count = max(1, process_count)
-    maxsize = 10 * process_count
-    # output queue
-    output_queue = Queue(maxsize=maxsize)
-
-    if out_file == '-':
-        out_file = None
-
-    worker_count = process_count
-
-    # load balancing
-    max_spool_length = 10000
-    spool_length = Value('i', 0, lock=False)
-
-    # reduce job that sorts and prints output
-    reduce = Process(target=reduce_process,
-                     args=(options, output_queue, spool_length,
-                           out_file, file_size, file_compress))
-    reduce.start()
-
-    # initialize jobs queue
-    jobs_queue = Queue(maxsize=maxsize)
+        # share templates among extraction processes, rather than copy them
+        table_dir = tempfile.mkdtemp(prefix='wikiextractor-')
+    try:
+        if table_dir:
+            for name in ('templates', 'redirects'):
+                path = os.path.join(table_dir, name)
+                write_table(path, getattr(options, name))
+                setattr(options, name, TemplateTable(path))
+
+        # Blocks of pages that workers read by themselves
+        if index_file:
+            read_block = read_stream
+            blocks = stream_spans(input_file, offsets)
+        elif shard_count:
+            read_block = read_range
+            blocks = byte_ranges(input_file, shard_count)
+        elif reader == 'spans':
+            # the header has been consumed through input, start over
+            input.close()
+            input = fileinput.hook_compressed(input_file, 'rb')
+            blocks = page_blocks(input)
+        else:
+            blocks = None
+        if (index_file or shard_count) and input is not None:
+            input.close()
+
+        # process pages
+        logging.info("Starting page extraction from %s.", input_file)
+        extract_start = default_timer()
+
+        # Parallel Map/Reduce:
+        # - pages to be processed are dispatched to workers
+        # - a reduce process collects the results, sort them and print them.
+
+        process_count = max(1, process_count)
+        maxsize = 10 * process_count
+        # output queue
+        output_queue = Queue(maxsize=maxsize)
+
+        if out_file == '-':
+            out_file = None
+
+        worker_count = process_count
+
+        # load balancing, by the number of documents spooled by the reducer
+        max_spool_length = 10000
+        spool_length = Value('i', 0, lock=False)
+
+        # reduce job that sorts and prints output
+        reduce = Process(target=reduce_process,
+                         args=(options, output_queue, spool_length,
+                               out_file, file_size, file_compress))
+        reduce.start()
+
+        # initialize jobs queue
+        jobs_queue = Queue(maxsize=maxsize)
+
+        # start worker processes
+        logging.info("Using %d extract processes.", worker_count)
+        workers = []
+        for i in range(worker_count):
+            if blocks is None:
+                extractor = Process(target=extract_process,
+                                    args=(options, i, jobs_queue, output_queue))
+            elif reader == 'spans':
+                extractor = Process(target=extract_span_process,
+                                    args=(options, i, jobs_queue, output_queue))
+            else:
+                extractor = Process(target=extract_block_process,
+                                    args=(options, i, input_file, read_block,
+                                          jobs_queue, output_queue))
+            extractor.daemon = True  # only live while parent process lives
+            extractor.start()
+            workers.append(extractor)
+
+        # Mapper process
+        page_num = 0
+        block_count = 0
+        if blocks is None:
+            if reader == 'chunks':
+                # the header has been consumed through input, start over
+                input.close()
+                input = fileinput.hook_compressed(input_file, 'rb')
+                pages = pages_from_chunks(input)
+            else:
+                pages = pages_from(input)
+            for page_data in pages:
+                id, revid, title, ns, page = page_data
+                if keepPage(ns, page):
+                    wait_spool(spool_length, max_spool_length)
+                    job = (id, revid, title, page, page_num)
+                    jobs_queue.put(job) # goes to any available extract_process
+                    page_num += 1
+                page = None             # free memory
+
+            input.close()
+        elif reader == 'spans':
+            # just hand out the blocks of pages, workers parse them
+            for block_num, data in enumerate(blocks):
+                wait_spool(spool_length, max_spool_length)
+                jobs_queue.put((block_num, data))
+                data = None             # free memory
+                block_count += 1
+            input.close()
+        else:
+            # just hand out the blocks, numbered in dump order, workers read them
+            for block_num, (start, end) in enumerate(blocks):
+                wait_spool(spool_length, max_spool_length)
+                jobs_queue.put((block_num, start, end))
+                block_count += 1
+
+        # signal termination
+        for _ in workers:
+            jobs_queue.put(None)
+        # wait for workers to terminate
+        for w in workers:
+            w.join()
+
+        # signal end of work to reduce process
+        output_queue.put(None)
+        # wait for it to finish
+        reduce.join()
+    finally:
+        if table_dir:
+            for name in ('templates', 'redirects'):
+                table = getattr(options, name)
+                if isinstance(table, TemplateTable):
+                    table.close()
+            shutil.rmtree(table_dir, ignore_errors=True)
 
-    # start worker processes
-    logging.info("Using %d extract processes.", worker_count)
-    workers = []
-    for i in range(worker_count):
-        extractor = Process(target=extract_process,
-                            args=(options, i, jobs_queue, output_queue))
-        extractor.daemon = True  # only live while parent process lives
-        extractor.start()
-        workers.append(extractor)
-
-    # Mapper process
-    page_num = 0
-    for page_data in pages_from(input):
-        id, revid, title, ns, page = page_data
-        if keepPage(ns, page):
-            # slow down
-            delay = 0
-            if spool_length.value > max_spool_length:
-                # reduce to 10%
-                while spool_length.value > max_spool_length/10:
-                    time.sleep(10)
-                    delay += 10
-            if delay:
-                logging.info('Delay %ds', delay)
-            job = (id, revid, title, page, page_num)
-            jobs_queue.put(job) # goes to any available extract_process
-            page_num += 1
-        page = None             # free memory
-
-    input.close()
-
-    # signal termination
-    for _ in workers:
-        jobs_queue.put(None)
-    # wait for workers to terminate
-    for w in workers:
-        w.join()
+    extract_duration = default_timer() - extract_start
+    if blocks is None:
+        extract_rate = page_num / extract_duration
+        logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s)",
+                     process_count, page_num, extract_duration, extract_rate)
+    else:
+        logging.info("Finished %d-process extraction of %d %s in %.1fs",
+                     process_count, block_count,
+                     'streams' if index_file else
+                     'byte ranges' if shard_count else 'blocks',
+                     extract_duration)
 
-    # signal end of work to reduce process
-    output_queue.put(None)
-    # wait for it to finish
-    reduce.join()
 
-    extract_duration = default_timer() - extract_start
-    extract_rate = page_num / extract_duration
-    logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s)",
-                 process_count, page_num, extract_duration, extract_rate)
+def wait_spool(spool_length, max_spool_length):
+    """Slow down the mapper while the reduce process has too much spooled."""
+    delay = 0
+    if spool_length.value > max_spool_length:
+        # reduce to 10%
+        while spool_length.value > max_spool_length/10:
+            time.sleep(10)
+            delay += 10
+    if delay:
+        logging.info('Delay %ds', delay)
 
 
 # ----------------------------------------------------------------------
@@ -3003,13 +4169,104 @@ def extract_process(opts, i, jobs_queue, output_queue):
                 text = ''
                 logging.exception('Processing page: %s %s', id, title)
 
-            output_queue.put((page_num, text))
+            output_queue.put((page_num, [text]))
             out.truncate(0)
             out.seek(0)
         else:
             logging.debug('Quit extractor')
             break
     out.close()
+    if options.expansionCache:
+        options.expansionCache.report()
+    reportTitleCaches()
+
+
+def extract_block_process(opts, i, input_file, read_block, jobs_queue, output_queue):
+    """Pull spans of blocks of pages, read them from the dump and extract
+    their pages, push the text of the whole block.
+    :param i: process id.
+    :param input_file: the dump.
+    :param read_block: function returning the text of a block from the
+        dump, given its start and end.
+    :param jobs_queue: where to get jobs.
+    :param output_queue: where to queue extracted text for output.
+    """
+
+    global options
+    options = opts
+
+    createLogger(options.quiet, options.debug)
+
+    out = StringIO()                 # memory buffer
+
+    with open(input_file, 'rb') as file:
+        while True:
+            job = jobs_queue.get()  # job is (block_num, start, end)
+            if job:
+                block_num, start, end = job
+                try:
+                    lines = read_block(file, start, end).splitlines(True)
+                except:
+                    lines = []
+                    logging.exception('Reading block at: %d', start)
+                output_queue.put((block_num, extract_texts(pages_from(lines), out)))
+            else:
+                logging.debug('Quit extractor')
+                break
+    out.close()
+    if options.expansionCache:
+        options.expansionCache.report()
+    reportTitleCaches()
+
+
+def extract_span_process(opts, i, jobs_queue, output_queue):
+    """Pull blocks of bytes holding whole pages, parse and extract them,
+    push the text of the whole block.
+    :param i: process id.
+    :param jobs_queue: where to get jobs.
+    :param output_queue: where to queue extracted text for output.
+    """
+
+    global options
+    options = opts
+
+    createLogger(options.quiet, options.debug)
+
+    out = StringIO()                 # memory buffer
+
+    while True:
+        job = jobs_queue.get()  # job is (block_num, data)
+        if job:
+            block_num, data = job
+            pages = pages_from_chunks(BytesIO(data), len(data) or 1)
+            output_queue.put((block_num, extract_texts(pages, out)))
+        else:
+            logging.debug('Quit extractor')
+            break
+    out.close()
+    if options.expansionCache:
+        options.expansionCache.report()
+    reportTitleCaches()
+
+
+def extract_texts(pages, out):
+    """Extract the pages to keep.
+    :param pages: iterator of (id, revid, title, ns, page), as from pages_from().
+    :param out: memory buffer.
+    :return: the list of the texts of the documents.
+    """
+    texts = []
+    for id, revid, title, ns, page in pages:
+        if not keepPage(ns, page):
+            continue
+        try:
+            Extractor(id, revid, title, page).extract(out)
+            texts.append(out.getvalue())
+        except:
+            logging.exception('Processing page: %s %s', id, title)
+        out.truncate(0)
+        out.seek(0)
+    return texts
 
 
 report_period = 10000           # progress report period
@@ -3017,8 +4274,9 @@ def reduce_process(opts, output_queue, spool_length,
                    out_file=None, file_size=0, file_compress=True):
     """Pull finished article text, write series of files (or stdout)
     :param opts: global parameters.
-    :param output_queue: text to be output.
-    :param spool_length: spool length.
+    :param output_queue: text to be output, as pairs (sequence number, list
+        of texts of the documents).
+    :param spool_length: number of documents in the spool.
     :param out_file: filename where to print.
     :param file_size: max file size.
     :param file_compress: whether to compress output.
@@ -3040,13 +4298,17 @@ def reduce_process(opts, output_queue, spool_length,
     interval_start = default_timer()
     # FIXME: use a heap
     spool = {}        # collected pages
+    spooled = 0       # documents in spool, blocks may hold many
     next_page = 0     # sequence numbering of page
     while True:
         if next_page in spool:
-            output.write(spool.pop(next_page).encode('utf-8'))
+            texts = spool.pop(next_page)
+            for text in texts:
+                output.write(text.encode('utf-8'))
             next_page += 1
             # tell mapper our load:
-            spool_length.value = len(spool)
+            spooled -= len(texts)
+            spool_length.value = spooled
             # progress report
             if next_page % report_period == 0:
                 interval_rate = report_period / (default_timer() - interval_start)
@@ -3058,10 +4320,11 @@ def reduce_process(opts, output_queue, spool_length,
             pair = output_queue.get()
             if not pair:
                 break
-            page_num, text = pair
-            spool[page_num] = text
+            page_num, texts = pair
+            spool[page_num] = texts
             # tell mapper our load:
-            spool_length.value = len(spool)
+            spooled += len(texts)
+            spool_length.value = spooled
             # FIXME: if an extractor dies, process stalls; the other processes
             # continue to produce pairs, filling up memory.
             if len(spool) > 200:
@@ -3108,6 +4371,48 @@ def main():
                         help="accepted namespaces in links")
     groupP.add_argument("--templates",
                         help="use or create file containing templates")
+    groupP.add_argument("--index",
+                        help="index file of a multistream input dump "
+                        "(pages-articles-multistream-index.txt.bz2), "
+                        "used to decompress its bz2 streams in parallel")
+    groupP.add_argument("--shards", type=int, default=0, metavar="N",
+                        help="split an uncompressed input dump in N byte ranges, "
+                        "or more so that none exceeds 16MB, read in parallel "
+                        "by the extract processes")
+    groupP.add_argument("--reader", choices=('lines', 'chunks', 'spans'), default='lines',
+                        help="scan the input dump for pages line by line, or in "
+                        "large blocks of bytes, or hand such blocks of whole pages "
+                        "to the extract processes to parse (default=%(default)s)")
+    groupP.add_argument("--template-store", metavar="FILE",
+                        help="use or create a binary store of templates, "
+                        "rebuilt when it does not match the input dump")
+    groupP.add_argument("--parsed-templates", action="store_true",
+                        help="save templates also parsed in the template store")
+    groupP.add_argument("--expansion-cache", type=int, default=10000, metavar="N",
+                        help="number of template expansions cached by each "
+                        "extract process, 0 to disable (default=%(default)s)")
+    groupP.add_argument("--max-expansions", type=int, default=options.max_expansions,
+                        metavar="N",
+                        help="templates expanded in a page, beyond which the "
+                        "rest are dropped, 0 for no limit (default=%(default)s)")
+    groupP.add_argument("--max-expanded-chars", type=int,
+                        default=options.max_expanded_chars, metavar="N",
+                        help="characters produced by template expansion in a "
+                        "page, beyond which the rest are dropped, 0 for no "
+                        "limit (default=%(default)s)")
+    groupP.add_argument("--max-expansion-time", type=float,
+                        default=options.max_expansion_time, metavar="SECONDS",
+                        help="time spent expanding templates in a page, beyond "
+                        "which the rest are dropped, 0 for no limit "
+                        "(default=%(default)s)")
+    groupP.add_argument("--skip-templates", default="", metavar="Infobox,/Coord.*/",
+                        help="comma separated list of templates to drop without "
+                        "expanding them, by title or /regular expression/, "
+                        "whose commas do not separate templates")
+    groupP.add_argument("--stub-templates", default="", metavar="Convert=quantity",
+                        help="comma separated list of templates to replace with a "
+                        "fixed text without expanding them, as title=text or "
+                        "/regular expression/=text, text without commas")
     groupP.add_argument("--no-templates", action="store_false",
                         help="Do not expand templates")
     groupP.add_argument("-r", "--revision", action="store_true", default=options.print_revision,
@@ -3150,6 +4455,18 @@ def main():
         options.keepLinks = True
 
     options.expand_templates = args.no_templates
+    options.max_expansions = args.max_expansions
+    options.max_expanded_chars = args.max_expanded_chars
+    options.max_expansion_time = args.max_expansion_time
+    if args.expansion_cache:
+        options.expansionCache = ExpansionCache(args.expansion_cache)
+    if args.skip_templates or args.stub_templates:
+        try:
+            options.templateStubs = TemplateStubs(TemplateStubs.parse(args.skip_templates),
+                                                  TemplateStubs.parse(args.stub_templates, True))
+        except ValueError as e:
+            logging.error('Invalid templates to skip or stub: %s', e)
+            return
     options.filter_disambig_pages = args.filter_disambig_pages
     options.keep_tables = args.keep_tables
 
@@ -3205,6 +4522,8 @@ def main():
             if os.path.exists(args.templates):
                 with open(args.templates) as file:
                     load_templates(file)
+                resolveRedirects()
+                foldTemplates()
 
         file = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
         for page_data in pages_from(file):
@@ -3222,7 +4541,8 @@ def main():
             return
 
     process_dump(input_file, args.templates, output_path, file_size,
-                 args.compress, args.processes)
+                 args.compress, args.processes, args.index, args.shards,
+                 args.reader, args.template_store, args.parsed_templates)
 
 def createLogger(quiet, debug):
     logger = logging.getLogger()